@@ -1,7 +1,32 @@
 # Instructions to run this script
 # conda env create -n stardist -f stardistpy.yml # only when no environment installed
 # conda activate stardist
-# python stardist_segmentation.py
+# python stardist_segmentation.py --input ./images --output ./masks
+#
+# --input is a folder of images or a manifest: a text file with one image
+# path per line (relative paths are relative to the manifest, # comments).
+# Masks are written as <output>/<imageid>.ome.tif; images whose mask already
+# exists are skipped unless --overwrite. The model is loaded once, the next
+# image is read and normalized in the background while the current one is in
+# predict_instances, and masks are written in the background as well.
+# Per-image timings are printed and, with --timings, appended to a CSV.
+#
+# For whole slides add --block_size 4096: the plane is read lazily (aszarr, or
+# a memory map for uncompressed TIFFs) one block at a time, blocks overlap by
+# --overlap pixels plus the network context, every cell is kept by the one
+# block responsible for it (stardist.big) and gets a new sequential ID, and
+# finished rows of the mask go straight into a tiled, compressed OME-TIFF.
+# Memory grows with the slide width, not its area. --tissue skips blocks that
+# a low-resolution tissue map (Otsu, or --tissue_threshold) marks as glass.
+# With --stitch iou the blocks are plain overlapping tiles instead, and cells
+# cut by their seams are joined by overlap matching (common/label_stitch.py,
+# the stitcher Mesmer uses); --overlap must then exceed twice a nucleus.
+#
+# The 3rd/99.8th normalization percentiles are computed exactly from a
+# histogram of the plane read in strips (--norm exact), from a random pixel
+# sample (--norm sample, with a rank error bound, see common/normalization.py)
+# or from a low-resolution pyramid level (--norm level), and the scaling is
+# applied block by block.
 
 # There are 4 registered models for 'StarDist2D':
 # StarDist2D.from_pretrained() to check all models
@@ -14,59 +39,366 @@
 # '2D_demo'             None
 
 # If you find bugs, contact Ziqi <ziqi.kang@helsinki.fi>. :]
-# This script is based on Ada's script <ada.junquera-mencia@helsinki.fi>. 
+# This script is based on Ada's script <ada.junquera-mencia@helsinki.fi>.
 
 
+import argparse
+import csv
 import math
-import tifffile
 import os
-import math
-from stardist.data import test_image_nuclei_2d
-from stardist.plot import render_label
-from csbdeep.utils import normalize
-import matplotlib.pyplot as plt
-from stardist.models import StarDist2D
-
-# input path must only have the images to segment
-# output path should be an empty folder
-INPUT_PATH = "./images"
-OUTPUT_PATH = "./masks/" # remember to add / in the end
-# x = 8 # x number of tiles
-# y = 8 # y number of tiles
-arr = os.listdir(INPUT_PATH)
-model_name = '2D_versatile_fluo'
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'common'))
+import label_stitch
+import normalization
+import pyramid_tiff
+import tissue_map
+from run_manifest import atomic_output
+
+MODEL_NAME = '2D_versatile_fluo'
+# predict_instances gets n_tiles=(t, t) with t = sqrt(pixels / TILE_PIXELS)
+TILE_PIXELS = 4781712.046875
+IMAGE_EXTENSIONS = ('.tif', '.tiff')
+# csbdeep.utils.normalize defaults (pmin=3, pmax=99.8), as the original normalize(img) call
+PMIN, PMAX = 3, 99.8
+_DONE = object()
+
+
+# Images listed by a folder (sorted) or by a manifest file
+def list_images(source):
+    if os.path.isdir(source):
+        return [os.path.join(source, f) for f in sorted(os.listdir(source))
+                if f.lower().endswith(IMAGE_EXTENSIONS) and not f.startswith('.')]
+    base = os.path.dirname(os.path.abspath(source))
+    images = []
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                images.append(line if os.path.isabs(line) else os.path.join(base, line))
+    return images
+
+
+# <output>/<imageid>.ome.tif, imageid being the file name up to the first '.'
+def mask_path(output_dir, image_path):
+    imageid = os.path.basename(image_path).split('.', 1)[0]
+    return os.path.join(output_dir, imageid + '.ome.tif')
+
+
+def tile_count(shape):
+    return max(1, int(math.sqrt(int(shape[0] * shape[1] / TILE_PIXELS))))
+
+
+# Percentile scaling of an image (exact, from a pixel sample or a pyramid level)
+def image_scale(tif, plane, args):
+    lowres = normalization.lowres_plane(tif, args.channel) if args.norm == 'level' else None
+    (mi, ma), error = normalization.estimate(plane, [PMIN, PMAX], args.norm, args.norm_samples, lowres)
+    if error:
+        print("{}: percentiles {:.1f}-{:.1f} within {:.2f} percentile points".format(
+            tif.filename, mi, ma, 100 * error))
+    return normalization.IntensityScale(mi, ma)
+
+
+def load_image(image_path, args):
+    with tifffile.TiffFile(image_path) as tif:
+        img = tif.asarray(key=args.channel)
+        return image_scale(tif, img, args)(img)
+
+
+# Lazy (Y, X) view of one page: a memory map if uncompressed, else aszarr chunks
+def open_plane(tif, channel):
+    if tif.pages[channel].is_memmappable:
+        return tif.asarray(key=channel, out='memmap')
+    import zarr
+    return zarr.open(tif.aszarr(key=channel), mode='r')
+
+
+def open_image(image_path, args):
+    tif = tifffile.TiffFile(image_path)
+    try:
+        plane = open_plane(tif, args.channel)
+        tissue = None
+        if args.tissue:
+            lowres = tissue_map.lowres_nuclear(tif, plane, args.channel)
+            tissue = tissue_map.TissueMap(lowres, plane.shape, args.tissue_threshold, args.tissue_margin)
+        return tif, plane, image_scale(tif, plane, args), tissue
+    except Exception:
+        tif.close()
+        raise
+
+
+# Loader thread: read and normalize images (or open them and compute their
+# percentiles) ahead of the GPU into a bounded queue
+def prefetch_images(jobs, load, args, out):
+    for image_path, output_path in jobs:
+        start = time.time()
+        try:
+            item = (image_path, output_path, load(image_path, args), None)
+        except Exception as e:
+            item = (image_path, output_path, None, e)
+        out.put(item + (time.time() - start,))
+    out.put(_DONE)
+
+
+def read_block(block, plane):
+    return np.asarray(block.read(plane, axes='YX'))
 
-if __name__ == '__main__':
- 
-    model = StarDist2D.from_pretrained(model_name)
-    print("Image list: {}".format(arr)) # verify you only have the desired images here
 
+# Cells of each block are kept only by the block responsible for them
+# (stardist.big, as in StarDist2D.predict_instances_big) and relabelled
+# sequentially; mask rows above the write region of the current block are
+# final and are handed to the tiled writer. Blocks without tissue are skipped.
+def segment_blocks(model, plane, scale, tissue, output_path, args):
+    from stardist.big import BlockND
+    h, w = plane.shape
+    grid = model._axes_div_by('YX')
+    context = model._axes_tile_overlap('YX') if args.context is None else (args.context, args.context)
+    block_size = [min(args.block_size, s // g * g) for s, g in zip(plane.shape, grid)]
+    blocks = BlockND.cover(plane.shape, 'YX', block_size, args.overlap, context, grid)
+    occupied = [tissue is None or tissue.occupied(ys.start, ys.stop, xs.start, xs.stop)
+                for ys, xs in (b.slice_read('YX') for b in blocks)]
+    todo = iter([b for b, o in zip(blocks, occupied) if o])
+    band_rows = max(b.slice_write('YX')[0].stop - b.slice_write('YX')[0].start for b in blocks) + args.tile
+    band = np.zeros((band_rows, w), np.int32)
+    band_y0, next_id = 0, 1
+    stats = tissue_map.TriageStats()
+
+    with atomic_output(output_path) as tmp, ThreadPoolExecutor(1) as reader, \
+            pyramid_tiff.TileRowWriter(tmp, (h, w), np.int32, args.tile, args.levels, args.compression,
+                                       downsample='nearest') as writer:
+        block = next(todo, None)
+        future = reader.submit(read_block, block, plane) if block is not None else None
+        for block, run in zip(blocks, occupied):
+            ys, xs = block.slice_write('YX')
+            done = (ys.start - band_y0) // args.tile * args.tile
+            if done:
+                writer.write(band[:done].copy())
+                band[:-done] = band[done:]
+                band[-done:] = 0
+                band_y0 += done
+            if not run:
+                stats.skip()
+                continue
+
+            img = future.result()
+            following = next(todo, None)
+            if following is not None:
+                future = reader.submit(read_block, following, plane)
+            with stats.timed():
+                labels, polys = model.predict_instances(scale(img), axes='YX',
+                                                        n_tiles=(tile_count(img.shape),) * 2,
+                                                        show_tile_progress=False)
+            labels = block.crop_context(labels, axes='YX')
+            labels, _ = block.filter_objects(labels, polys, axes='YX')
+            ids = np.unique(labels)
+            ids = ids[ids > 0]
+            if len(ids):
+                cells = labels > 0
+                region = band[ys.start - band_y0:ys.stop - band_y0, xs]
+                region[cells] = np.searchsorted(ids, labels[cells]) + next_id
+                next_id += len(ids)
+        writer.write(band[:h - band_y0])
+    return stats, next_id - 1
+
+
+def read_tile(tile, plane):
+    (y0, y1), (x0, x1) = tile
+    return np.asarray(plane[y0:y1, x0:x1])
+
+
+# Overlapping tiles of --block_size segmented independently; label_stitch joins
+# cells across seams by IoU in a union-find, numbers them sequentially and
+# hands finished rows to the tiled writer. Tiles without tissue are skipped.
+def segment_tiles(model, plane, scale, tissue, output_path, args):
+    h, w = plane.shape
+    rows = label_stitch.tile_grid(h, args.block_size, args.overlap)
+    cols = label_stitch.tile_grid(w, args.block_size, args.overlap)
+    tiles = [(ys, xs) for ys in rows for xs in cols]
+    occupied = [tissue is None or tissue.occupied(y0, y1, x0, x1) for (y0, y1), (x0, x1) in tiles]
+    todo = iter([t for t, o in zip(tiles, occupied) if o])
+    stats = tissue_map.TriageStats()
+
+    with atomic_output(output_path) as tmp, ThreadPoolExecutor(1) as reader, \
+            pyramid_tiff.TileRowWriter(tmp, (h, w), np.int32, args.tile, args.levels, args.compression,
+                                       downsample='nearest') as writer:
+        stitcher = label_stitch.LabelStitcher(writer, rows, cols, args.iou_threshold)
+        tile = next(todo, None)
+        future = reader.submit(read_tile, tile, plane) if tile is not None else None
+        for run in occupied:
+            if not run:
+                stats.skip()
+                stitcher.add(None)
+                continue
+            img = future.result()
+            following = next(todo, None)
+            if following is not None:
+                future = reader.submit(read_tile, following, plane)
+            with stats.timed():
+                labels, _ = model.predict_instances(scale(img), axes='YX', n_tiles=(tile_count(img.shape),) * 2,
+                                                    show_tile_progress=False)
+            stitcher.add(labels)
+        cells = stitcher.close()
+    print("{} cells joined across tile seams".format(stitcher.merged))
+    return stats, cells
+
+
+# Writer thread: save masks atomically and report per-image timings
+def write_masks(pending, timings, failures):
     while True:
-        a = input("Do you want to proceed? [y/n]")
-        if a=="y":
-            for image in arr:
-
-                image_name = image
-                sep = '.'
-                imageid = image_name.split(sep, 1)[0]
-                print("Imageid = {}".format(imageid))
-
-                IMAGE_PATH = os.path.join(INPUT_PATH, image_name)
-                print("reading image {}".format(IMAGE_PATH))
-                img = tifffile.imread(IMAGE_PATH, key=0)
-                print("Finish reading image {}".format(IMAGE_PATH))
-                print("Image has a shape of {}".format(img.shape))
-
-                tiles = int(math.sqrt(int(img.shape[0]*img.shape[1]/(4781712.046875))))
-                print("Calculate tiles = {}".format(tiles))
-                labels, _ = model.predict_instances(normalize(img), n_tiles=(tiles, tiles))
-                labels = labels.astype("int32")
-                output_name = OUTPUT_PATH + imageid + ".ome.tif"
-                tifffile.imsave(output_name, labels)
-                print("Finish image {}".format(IMAGE_PATH))
+        item = pending.get()
+        if item is _DONE:
+            return
+        image_path, output_path, labels, times = item
+        start = time.time()
+        try:
+            # block-wise masks are already on disk
+            if labels is not None:
+                with atomic_output(output_path) as tmp:
+                    tifffile.imwrite(tmp, labels.astype('int32'))
+        except Exception as e:
+            print("Failed writing {}: {}".format(output_path, e))
+            failures.append(image_path)
+            continue
+        times['write_s'] = time.time() - start
+        print("Finish image {} (read {read_s:.1f}s, waited {wait_s:.1f}s, predict {predict_s:.1f}s, "
+            "write {write_s:.1f}s)".format(image_path, **times))
+        if timings is not None:
+            timings.append(dict(image=image_path, mask=output_path, **times))
+
+
+def save_timings(path, rows):
+    fields = ['image', 'mask', 'height', 'width', 'tiles', 'skipped', 'read_s', 'wait_s', 'predict_s', 'write_s',
+              'saved_s']
+    new = not os.path.exists(path)
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval='')
+        if new:
+            writer.writeheader()
+        writer.writerows(rows)
+
 
+def main():
+    parser = argparse.ArgumentParser(description="Segment nuclei with StarDist2D, unattended")
+    parser.add_argument('--input', required=True, help="Folder of images, or a manifest file with one image path per line")
+    parser.add_argument('--output', required=True, help="Folder for the <imageid>.ome.tif masks")
+    parser.add_argument('--model', default=MODEL_NAME, help="Pretrained StarDist2D model")
+    parser.add_argument('--channel', type=int, default=0, help="Page/channel with the nuclear stain")
+    parser.add_argument('--prefetch', type=int, default=1, help="Images read and normalized ahead of the GPU")
+    parser.add_argument('--overwrite', action='store_true', help="Segment images even if their mask exists")
+    parser.add_argument('--timings', default=None, help="Append per-image timings to this CSV")
+    parser.add_argument('--norm', default='exact', choices=normalization.METHODS,
+                        help="Percentiles from all pixels, a random sample or a pyramid level")
+    parser.add_argument('--norm_samples', type=int, default=normalization.DEFAULT_SAMPLE_SIZE,
+                        help="Pixels sampled with --norm sample")
+    parser.add_argument('--block_size', type=int, default=0,
+                        help="Segment in blocks of this size read lazily from the TIFF (e.g. 4096), 0 for the whole plane")
+    parser.add_argument('--overlap', type=int, default=128, help="Minimum block overlap, larger than any nucleus")
+    parser.add_argument('--stitch', default='objects', choices=('objects', 'iou'),
+                        help="Block-wise: keep each cell in the block responsible for it (stardist.big), "
+                             "or join cells across the seams of overlapping tiles (label_stitch)")
+    parser.add_argument('--iou_threshold', type=float, default=0.5,
+                        help="IoU in the overlap above which --stitch iou joins two labels")
+    parser.add_argument('--context', type=int, default=None, help="Context around blocks (default: network field of view)")
+    parser.add_argument('--tile', type=int, default=pyramid_tiff.DEFAULT_TILE, help="Tile size of block-wise masks")
+    parser.add_argument('--compression', default=pyramid_tiff.DEFAULT_COMPRESSION, choices=pyramid_tiff.COMPRESSIONS)
+    parser.add_argument('--levels', type=int, default=1, help="Resolutions of block-wise masks (nearest downsampling)")
+    parser.add_argument('--tissue', action='store_true',
+                        help="With --block_size, skip blocks without tissue on a low-resolution map of the plane")
+    parser.add_argument('--tissue_threshold', type=float, default=None,
+                        help="Raw nuclear intensity of tissue on the low-resolution map (default: Otsu)")
+    parser.add_argument('--tissue_margin', type=int, default=64, help="Pixels of glass kept around tissue")
+    args = parser.parse_args()
+    if args.tissue and not args.block_size:
+        parser.error("--tissue needs --block_size")
+    if args.stitch == 'iou' and not args.block_size:
+        parser.error("--stitch iou needs --block_size")
+
+    images = list_images(args.input)
+    os.makedirs(args.output, exist_ok=True)
+    jobs = []
+    for image_path in images:
+        output_path = mask_path(args.output, image_path)
+        if os.path.exists(output_path) and not args.overwrite:
+            print("Skipping {}, {} exists".format(image_path, output_path))
             continue
-        elif a=="n":
+        jobs.append((image_path, output_path))
+    print("{} images, {} to segment".format(len(images), len(jobs)))
+    if not jobs:
+        return
+
+    from stardist.models import StarDist2D
+    model = StarDist2D.from_pretrained(args.model)
+
+    loaded = queue.Queue(maxsize=max(1, args.prefetch))
+    pending = queue.Queue(maxsize=1)
+    timings = [] if args.timings else None
+    failures = []
+    load = open_image if args.block_size else load_image
+    loader = threading.Thread(target=prefetch_images, args=(jobs, load, args, loaded), daemon=True)
+    writer = threading.Thread(target=write_masks, args=(pending, timings, failures), daemon=True)
+    loader.start()
+    writer.start()
+
+    batch_start = time.time()
+    while True:
+        wait_start = time.time()
+        item = loaded.get()
+        if item is _DONE:
             break
-        else:
-            print("Enter either [y/n]")
\ No newline at end of file
+        image_path, output_path, img, error, read_time = item
+        waited = time.time() - wait_start
+        if error is not None:
+            print("Failed reading {}: {}".format(image_path, error))
+            failures.append(image_path)
+            continue
+
+        shape = img[1].shape if args.block_size else img.shape
+        start = time.time()
+        try:
+            if args.block_size:
+                tif, plane, scale, tissue = img
+                print("Segmenting {} {} in blocks of {}, {}".format(image_path, shape, args.block_size, scale))
+                if tissue is not None:
+                    print("Tissue above {:.0f} on {:.0%} of the slide".format(tissue.threshold, tissue.fraction))
+                try:
+                    segment = segment_tiles if args.stitch == 'iou' else segment_blocks
+                    stats, cells = segment(model, plane, scale, tissue, output_path, args)
+                finally:
+                    tif.close()
+                print("{} cells in {} blocks, {}".format(cells, stats.total, stats))
+                tiles, triage = stats.total, dict(skipped=stats.skipped, saved_s=stats.saved_seconds)
+                labels = None
+            else:
+                tiles, triage = tile_count(shape), {}
+                print("Segmenting {} {} with {}x{} tiles".format(image_path, shape, tiles, tiles))
+                labels, _ = model.predict_instances(img, n_tiles=(tiles, tiles))
+        except Exception as e:
+            print("Failed segmenting {}: {}".format(image_path, e))
+            failures.append(image_path)
+            continue
+        times = dict(height=shape[0], width=shape[1], tiles=tiles,
+            read_s=read_time, wait_s=waited, predict_s=time.time() - start, **triage)
+        del img
+        pending.put((image_path, output_path, labels, times))
+
+    pending.put(_DONE)
+    writer.join()
+    if timings:
+        save_timings(args.timings, timings)
+    print("Segmented {} of {} images in {:.1f} min".format(
+        len(jobs) - len(failures), len(jobs), (time.time() - batch_start) / 60))
+    if failures:
+        print("Failed: {}".format(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
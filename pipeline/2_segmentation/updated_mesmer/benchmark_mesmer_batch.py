@@ -0,0 +1,84 @@
+"""
+Benchmark batched Mesmer inference (TileProcessor in mesmer.py) per batch
+size, on CPU by default, the way our GPU-less nodes run it.
+
+    python benchmark_mesmer_batch.py --batch_sizes 1 2 4 8 16
+    python benchmark_mesmer_batch.py --image /notebooks/tif/slide.tif --tiles 32 --gpu
+
+The nuclear plane (synthetic, or channel 0 of --image) is preprocessed as in
+mesmer.py and cut into --tiles 1024x1024 tiles. For every batch size, it
+prints tiles/s and the speedup over batch size 1, and checks that the masks
+are identical to those of batch size 1.
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+
+def synthetic_nuclei(shape, seed=0):
+    """
+    uint16 plane with dim background and round, bright nuclei.
+    """
+    from skimage.draw import disk
+    rng = np.random.default_rng(seed)
+    image = rng.normal(300, 60, shape)
+    for _ in range(shape[0] * shape[1] // 1500):
+        rr, cc = disk((rng.integers(0, shape[0]), rng.integers(0, shape[1])), rng.integers(8, 16), shape=shape)
+        image[rr, cc] += rng.integers(2000, 8000)
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mesmer tiles/s per inference batch size")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--tiles", type=int, default=16, help="1024x1024 tiles to segment per batch size")
+    parser.add_argument("--image", default=None, help="Benchmark on channel 0 of a real TIFF instead")
+    parser.add_argument("--mpp", type=float, default=0.325)
+    parser.add_argument("--gpu", action="store_true", help="Allow TensorFlow to use a GPU")
+    args = parser.parse_args()
+    if not args.gpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"  # before TensorFlow is imported by mesmer.py
+
+    import tifffile
+    import zarr
+    import mesmer
+    import tissue_map
+
+    side = int(np.ceil(np.sqrt(args.tiles))) * 1024
+    if args.image:
+        with tifffile.TiffFile(args.image) as tif:
+            nuc = zarr.open(tif.aszarr(key=0), mode='r')[:side, :side]
+    else:
+        nuc = synthetic_nuclei((side, side))
+    proc = mesmer.apply_preprocessing(nuc)
+    tiles = [proc[y:y + 1024, x:x + 1024] for y in range(0, proc.shape[0], 1024)
+             for x in range(0, proc.shape[1], 1024)][:args.tiles]
+    print(f"{len(tiles)} tiles of {tiles[0].shape}, {'GPU' if args.gpu else 'CPU'}")
+
+    app = mesmer.Mesmer()
+    reference, base = None, None
+    for batch_size in args.batch_sizes:
+        stats = tissue_map.TriageStats()
+        processor = mesmer.TileProcessor(app, len(tiles), args.mpp, stats, batch_size)
+        processor.process(tiles[:batch_size])  # warm-up: graph building for this batch shape
+        stats = processor.stats = tissue_map.TriageStats()
+        t = time.perf_counter()
+        masks = []
+        for i in range(0, len(tiles), batch_size):
+            masks.extend(processor.process(tiles[i:i + batch_size]))
+        elapsed = time.perf_counter() - t
+        processor.pbar.close()
+        rate = len(tiles) / elapsed
+        base = base or rate
+        same = "" if reference is None else \
+            ("identical masks" if all(np.array_equal(a, b) for a, b in zip(reference, masks)) else "MASKS DIFFER")
+        reference = reference or masks
+        print(f"batch size {batch_size:3d}: {rate:6.2f} tiles/s ({stats.tiles_per_second:.2f} in predict), "
+              f"x{rate / base:.2f}  {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,9 @@ import numpy as np
 import cv2
 import gc
 import time
-import subprocess
-import shutil
+import sys
+import queue
+import threading
 import tensorflow as tf
 from pathlib import Path
 from dask.diagnostics import ProgressBar
@@ -14,8 +15,15 @@ from tqdm import tqdm
 
 # DeepCell & DeepTile Imports
 from deepcell.applications import Mesmer
-from deeptile import load, lift
-from deeptile.extensions import stitch
+from deeptile import load
+
+# Shared pipeline modules (mount the repository's pipeline/ folder in the container)
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'common'))
+import label_stitch
+import normalization
+import pyramid_tiff
+import tissue_map
+from run_manifest import atomic_output
 
 # --- 1. Environment & Setup ---
 os.environ.update({"DEEPCELL_ACCESS_TOKEN": "YOURTOKEN"})
@@ -25,163 +33,273 @@ physical_devices = tf.config.experimental.list_physical_devices('GPU')
 for device in physical_devices:
     tf.config.experimental.set_memory_growth(device, True)
 
-def run_ome_conversion(input_tif, final_ome_tif):
-    """Calls external OME tools to create a QuPath-optimized pyramid."""
-    temp_zarr = str(Path(input_tif).with_suffix('')) + "_zarr_temp"
-    
-    try:
-        print(f"--- Generating Pyramid (Zarr) ---")
-        subprocess.run([
-            "bioformats2raw",
-            "--resolutions", "5",
-            "--downsample-type", "SIMPLE", 
-            "--compression", "zlib",
-            "--series", "0",
-            "--tile_width", "512",
-            "--tile_height", "512",
-            "--overwrite",
-            input_tif,
-            temp_zarr
-        ], check=True)
-
-        print(f"--- Transcoding to OME-TIFF ---")
-        subprocess.run([
-            "raw2ometiff",
-            "--compression", "zlib",
-            temp_zarr,
-            final_ome_tif
-        ], check=True)
-        
-    except subprocess.CalledProcessError as e:
-        print(f"Error during conversion: {e}")
-        raise
-    finally:
-        # Cleanup temp Zarr if it exists
-        if os.path.exists(temp_zarr):
-            shutil.rmtree(temp_zarr)
-        # Only delete the flat temp TIFF if the final file exists
-        if os.path.exists(final_ome_tif) and os.path.exists(input_tif):
-            os.remove(input_tif)
-
 # --- 2. Helper Functions ---
 
-def apply_preprocessing(image, gamma=1.5, sigma=1.0, strength=1.5):
-    """Gamma correction and unsharp mask to boost nuclear signal."""
-    # Normalize to 0-1
-    img_float = (image - image.min()) / (image.max() - image.min())
-    # Gamma
-    gamma_corr = np.power(img_float, 1/gamma)
-    # Convert back to uint16
-    img_u16 = (gamma_corr * 65535).astype(np.uint16)
-    # Unsharp Mask
-    blurred = cv2.GaussianBlur(img_u16.astype(np.float32), (0, 0), sigma)
-    sharpened = cv2.addWeighted(img_u16.astype(np.float32), 1 + strength, blurred, -strength, 0)
-    return np.clip(sharpened, 0, 65535).astype(np.uint16)
+def intensity_scale(tif, plane, method="exact"):
+    """Min/max scaling of the nuclear plane, see pipeline/common/normalization.py."""
+    lowres = normalization.lowres_plane(tif) if method == "level" else None
+    (lo, hi), error = normalization.estimate(plane, [0, 100], method, lowres=lowres)
+    if error:
+        print(f"Intensity range {lo:g}-{hi:g} ({method}), at most {100 * error:.2f}% of pixels outside")
+    return normalization.IntensityScale(lo, hi, clip=True, dtype=np.float64)
+
+def gamma_u16(x, gamma):
+    """Gamma of a 0-1 image, as uint16."""
+    return (np.power(x, 1/gamma) * 65535).astype(np.uint16)
+
+def apply_preprocessing(image, scale=None, gamma=1.5, sigma=1.0, strength=1.5, chunk=2048):
+    """Gamma correction and unsharp mask to boost nuclear signal, chunk by chunk.
+
+    Only the uint16 output is full size; temporaries are about 14 bytes per pixel of a
+    chunk x chunk tile plus halo. `image` may be lazy (zarr, memmap)."""
+    if scale is None:
+        scale = normalization.IntensityScale(*normalization.strip_range(image), clip=True, dtype=np.float64)
+    # Normalize to 0-1 and gamma into uint16, through a lookup table of every value for 8/16-bit images
+    if image.dtype.kind == 'u' and image.dtype.itemsize <= 2:
+        lut = gamma_u16(scale(np.arange(1 << (8 * image.dtype.itemsize), dtype=image.dtype)), gamma)
+        to_u16 = lambda x: lut[x]
+    else:
+        to_u16 = lambda x: gamma_u16(scale(x), gamma)
+    # Unsharp Mask per tile; the halo covers the Gaussian kernel (cv2: radius 4 sigma), and tile bounds on
+    # multiples of 64 give cv2's SIMD loops the same column layout as the whole plane, so tiles match it exactly
+    halo = int(np.ceil(4 * sigma)) + 1
+    h, w = image.shape
+    out = np.empty((h, w), dtype=np.uint16)
+    for y in range(0, h, chunk):
+        for x in range(0, w, chunk):
+            y0, x0 = max(0, y - halo) // 64 * 64, max(0, x - halo) // 64 * 64
+            y1, x1 = -(-(y + chunk + halo) // 64) * 64, -(-(x + chunk + halo) // 64) * 64
+            tile = to_u16(np.asarray(image[y0:y1, x0:x1])).astype(np.float32)
+            blurred = cv2.GaussianBlur(tile, (0, 0), sigma)
+            sharpened = cv2.addWeighted(tile, 1 + strength, blurred, -strength, 0)
+            out[y:y + chunk, x:x + chunk] = np.clip(sharpened[y - y0:y - y0 + chunk, x - x0:x - x0 + chunk],
+                                                    0, 65535).astype(np.uint16)
+    return out
 
 class TileProcessor:
-    """Stateful processor to handle Mesmer inference and tqdm updates."""
-    def __init__(self, app, total_tiles, mpp):
-        self.app, self.mpp, self.pbar = app, mpp, tqdm(total=total_tiles, desc="Tiles")
+    """Stateful processor to handle batched Mesmer inference and tqdm updates."""
+    def __init__(self, app, total_tiles, mpp, stats, batch_size=4):
+        self.app, self.mpp, self.stats, self.batch_size = app, mpp, stats, batch_size
+        self.pbar = tqdm(total=total_tiles, desc="Tiles")
     
-    def process(self, tile):
-        tile_arr = np.array(tile)
-        h, w = tile_arr.shape
-        
-        # Pad to multiple of 256 (Mesmer's native window)
-        new_h = int(np.ceil(h / 256) * 256)
-        new_w = int(np.ceil(w / 256) * 256)
+    def process(self, tiles):
+        """Predict a batch of tiles (deeptile's vectorized lift), one app.predict per padded shape."""
+        tiles = [np.asarray(tile) for tile in tiles]
+        results = np.empty(len(tiles), dtype=object)
         
-        if new_h != h or new_w != w:
-            tile_arr = np.pad(tile_arr, ((0, new_h - h), (0, new_w - w)), mode='constant')
-
-        if np.mean(tile_arr) < 600: # TODO: Change filtering of background tiles
-            res = np.zeros(tile_arr.shape, dtype=np.uint32)
-        else:
-            input_data = np.stack([tile_arr, tile_arr], axis=-1).astype(np.float32) / 65535.0
-            preds = self.app.predict(input_data[None, ...], image_mpp=self.mpp, compartment='nuclear')
-            res = preds[0, ..., 0].astype(np.uint32)
-        
-        self.pbar.update(1)
+        # Pad to multiple of 256 (Mesmer's native window); tiles padded to the same shape share a call
+        shapes = {}
+        for i, tile in enumerate(tiles):
+            h, w = tile.shape
+            shapes.setdefault((int(np.ceil(h / 256) * 256), int(np.ceil(w / 256) * 256)), []).append(i)
+
+        # Background tiles never get here, see the tissue map in main()
+        for (new_h, new_w), batch in shapes.items():
+            tile_arr = np.stack([np.pad(tiles[i], ((0, new_h - tiles[i].shape[0]), (0, new_w - tiles[i].shape[1])),
+                                        mode='constant') for i in batch])
+            with self.stats.timed(len(batch)):
+                input_data = np.stack([tile_arr, tile_arr], axis=-1).astype(np.float32) / 65535.0
+                preds = self.app.predict(input_data, batch_size=len(batch), image_mpp=self.mpp, compartment='nuclear')
+            
+            # Crop back to original tile size
+            for k, i in enumerate(batch):
+                h, w = tiles[i].shape
+                results[i] = preds[k, :h, :w, 0].astype(np.uint32)
         
-        # Crop back to original tile size
-        return res[:h, :w]
+        self.pbar.update(len(tiles))
+        return results
+
+def infer_rows(proc_obj, tiled, occupied, batch_size):
+    """Tile masks of each row of tiles (None for background tiles), predicted in batches across rows."""
+    n_rows, n_cols = occupied.shape
+    rows = [[None] * n_cols for _ in range(n_rows)]
+    remaining = occupied.sum(axis=1)
+    todo = [(i, j) for i in range(n_rows) for j in range(n_cols) if occupied[i, j]]
+    next_row = 0
+    for k in range(0, len(todo), batch_size):
+        batch = todo[k:k + batch_size]
+        for (i, j), mask in zip(batch, proc_obj.process([tiled[i, j] for i, j in batch])):
+            rows[i][j] = mask
+            remaining[i] -= 1
+        # Batches run in row-major order, so finished rows come out in order
+        while next_row < n_rows and remaining[next_row] == 0:
+            yield rows[next_row]
+            rows[next_row] = None
+            next_row += 1
+    for i in range(next_row, n_rows):
+        yield rows[i]
+
+# --- 3. Pipeline Stages ---
+# Slides flow through load/preprocess (thread) -> inference (main thread, TensorFlow) -> stitch/write
+# (thread), with bounded queues between them, so the next slide is read and the previous one is written
+# while the GPU works on the current one. Tile masks go to the writer a row of tiles at a time and are
+# stitched into the mask file as they come (pipeline/common/label_stitch.py).
 
-# --- 3. Main Loop ---
+_DONE = object()
+
+def load_slide(img_path, norm_method, tissue_threshold):
+    """Read the nuclear plane, preprocess it and build its tissue map."""
+    # Load Raw Channel (handles multi-channel or 2D)
+    with tifffile.TiffFile(img_path) as tif:
+        data = zarr.open(tif.aszarr(), mode='r')
+        raw = data[0] if isinstance(data, zarr.Group) else data
+        # Logic for channel extraction (assumes channel 0 is nuclear)
+        nuc = raw[0, :, :] if raw.ndim == 3 else raw[:]
+        scale = intensity_scale(tif, nuc, norm_method)
+        tissue = tissue_map.TissueMap(tissue_map.lowres_nuclear(tif, nuc), nuc.shape, tissue_threshold)
+    return apply_preprocessing(nuc, scale), tissue
+
+def load_stage(fnames, input_dir, norm_method, tissue_threshold, loaded):
+    """Producer: load and preprocess slides ahead of inference."""
+    for fname in fnames:
+        times = {'start': time.time()}
+        try:
+            item = (fname,) + load_slide(os.path.join(input_dir, fname), norm_method, tissue_threshold) + (None,)
+        except Exception as e:
+            item = (fname, None, None, e)
+        times['load_s'] = time.time() - times['start']
+        loaded.put(item + (times,))
+    loaded.put(_DONE)
+
+def write_stage(pending, output_dir, image_mpp, mask_downsample, done, failures):
+    """Consumer: stitch the rows of tile masks of each slide into its mask pyramid, behind inference."""
+    while True:
+        item = pending.get()
+        if item is _DONE:
+            return
+        fname, shape, (row_bounds, col_bounds), tile_rows, times = item
+        start = time.time()
+        times['queued_s'] = start - times.pop('handoff')
+        times['stitch_s'] = 0.0
+        # Strip all extensions to get a clean ID
+        image_id = fname.split('.')[0] 
+        final_path = Path(output_dir) / f"{image_id}.ome.tif"
+        rows_iter, upstream = iter(tile_rows.get, _DONE), None
+        try:
+            # Tiled, zlib-compressed OME-TIFF with 5 resolutions in SubIFDs (QuPath-ready), filled with
+            # finished rows of the stitched mask; renamed into place when complete
+            with atomic_output(str(final_path)) as tmp, pyramid_tiff.TileRowWriter(
+                    tmp,
+                    shape,
+                    np.uint32,
+                    tile=512,
+                    levels=5,
+                    compression='zlib',
+                    downsample=mask_downsample,
+                    channel_names=['Nuclei Labels'],
+                    # This is a signed 32-bit int: (Alpha=255, R=0, G=255, B=255)
+                    channel_colors=[-16711681],
+                    physical_size=image_mpp) as writer:
+                stitcher = label_stitch.LabelStitcher(writer, row_bounds, col_bounds)
+                for row in rows_iter:
+                    if isinstance(row, Exception):
+                        upstream = row
+                        raise row
+                    stitch_start = time.time()
+                    for mask in row:
+                        stitcher.add(mask)
+                    times['stitch_s'] += time.time() - stitch_start
+                last_row = time.time()
+                cells = stitcher.close()
+        except Exception as e:
+            if e is not upstream:
+                print(f"❌ Failed writing {fname}: {e}")
+            failures.append(fname)
+            for _ in rows_iter:  # let inference finish the slide
+                pass
+            continue
+        times['write_s'] = time.time() - last_row
+        done.append(times)
+        print(f"✅ Saved {cells} nuclei ({stitcher.merged} joined across tiles) to {final_path} in "
+              f"{(time.time()-times['start'])/60:.1f}m (load {times['load_s']:.0f}s, waited {times['wait_s']:.0f}s, "
+              f"inference {times['infer_s']:.0f}s, queued {times['queued_s']:.0f}s, stitch {times['stitch_s']:.0f}s, "
+              f"write after inference {times['write_s']:.0f}s; {pending.qsize()} waiting to be written)")
+        gc.collect()
+
+# --- 4. Main Loop ---
 
 def main():
     input_dir, output_dir = '/notebooks/tif/', '/notebooks/seg/'
     image_mpp = 0.325 # TODO: Set your actual resolution here
+    norm_method = "exact" # "sample" or "level" to estimate the intensity range, see normalization.py
+    tissue_threshold = None # None: Otsu on a low-res nuclear plane, or a fixed raw nuclear intensity
+    batch_size = 4 # tiles per Mesmer predict call, see benchmark_mesmer_batch.py
+    mask_downsample = "nearest" # or "mode"; label-safe sub-resolutions, never averaged
+    prefetch = 1 # slides loaded and preprocessed ahead of inference, each a uint16 plane in memory
     os.makedirs(output_dir, exist_ok=True)
     
     print("Loading Mesmer...")
     app = Mesmer()
 
-    for fname in [f for f in os.listdir(input_dir) if f.endswith(".tif")]:
-        start_time = time.time()
-        img_path = os.path.join(input_dir, fname)
-        
-        # Load Raw Channel (handles multi-channel or 2D)
-        with tifffile.TiffFile(img_path) as tif:
-            data = zarr.open(tif.aszarr(), mode='r')
-            raw = data[0] if isinstance(data, zarr.Group) else data
-            # Logic for channel extraction (assumes channel 0 is nuclear)
-            nuc = raw[0, :, :] if raw.ndim == 3 else raw[:]
-
-        print(f"Processing {fname} ({nuc.shape})")
-        proc = apply_preprocessing(nuc)
-
-        # Setup DeepTile
-        dt = load(proc)
-        tiled = dt.get_tiles(tile_size=(1024, 1024), overlap=(0.1, 0.1))
-        
-        # Inference
-        proc_obj = TileProcessor(app, len(tiled.flat), image_mpp)
-        @lift
-        def run_mesmer(tile): return proc_obj.process(tile)
-        
-        masks = run_mesmer(tiled)
-        proc_obj.pbar.close()
+    fnames = [f for f in os.listdir(input_dir) if f.endswith(".tif")]
+    loaded = queue.Queue(maxsize=prefetch)
+    pending = queue.Queue(maxsize=1)
+    done, failures = [], []
+    loader = threading.Thread(target=load_stage, args=(fnames, input_dir, norm_method, tissue_threshold, loaded),
+                              daemon=True)
+    writer = threading.Thread(target=write_stage, args=(pending, output_dir, image_mpp, mask_downsample,
+                                                        done, failures), daemon=True)
+    run_start = time.time()
+    loader.start()
+    writer.start()
 
-        # Stitch and Save
-        print("Stitching...")
-        final_mask = np.array(stitch.stitch_masks(masks)).astype(np.uint32) 
+    while True:
+        wait_start = time.time()
+        item = loaded.get()
+        if item is _DONE:
+            break
+        fname, proc, tissue, error, times = item
+        times['wait_s'] = time.time() - wait_start
+        if error is not None:
+            print(f"❌ Failed loading {fname}: {error}")
+            failures.append(fname)
+            continue
 
-        # Verify the type in your logs
-        print(f"Final Mask Data Type: {final_mask.dtype}")
-        
-        # Save Pipeline
-        # Strip all extensions to get a clean ID
-        image_id = fname.split('.')[0] 
-        temp_path = Path(output_dir) / f"{image_id}_flat.tif"
-        final_path = Path(output_dir) / f"{image_id}.ome.tif"
+        print(f"Processing {fname} ({proc.shape}), loaded in {times['load_s']:.0f}s, waited {times['wait_s']:.0f}s; "
+              f"queues: {loaded.qsize()} loaded, {pending.qsize()} waiting to be written")
+        tile_rows = queue.Queue(maxsize=2) # rows of tile masks on their way to the writer
+        handed_off = False
+        try:
+            # Setup DeepTile
+            dt = load(proc)
+            tiled = dt.get_tiles(tile_size=(1024, 1024), overlap=(0.1, 0.1))
+            
+            # Inference on tiles with tissue only
+            occupied = tissue.grid(*tiled.tile_indices)
+            stats = tissue_map.TriageStats()
+            stats.skip(int((~occupied).sum()))
+            print(f"Tissue above {tissue.threshold:.0f} on {tissue.fraction:.0%} of the slide, "
+                  f"{occupied.sum()} of {occupied.size} tiles")
 
-        # Save tiled flat TIFF
-        tifffile.imwrite(
-            str(temp_path), 
-            final_mask, 
-            tile=(512, 512), 
-            compression='deflate',
-            metadata={
-                'PhysicalSizeX': image_mpp, 
-                'PhysicalSizeY': image_mpp, 
-                'PhysicalSizeXUnit': 'µm',
-                'PhysicalSizeYUnit': 'µm',
-                # Define axes explicitly to avoid confusion
-                'axes': 'YX',
-                # Name the channel
-                'Channel': {
-                    'Name': 'Nuclei Labels',
-                    # This is a signed 32-bit int: (Alpha=255, R=0, G=255, B=255)
-                    'Color': -16711681 
-                }
-            }
-        )
+            # Blocks while the writer is busy with the previous slide
+            times['handoff'] = time.time()
+            pending.put((fname, proc.shape, tiled.tile_indices, tile_rows, times))
+            handed_off, infer_start = True, time.time()
+            proc_obj = TileProcessor(app, int(occupied.sum()), image_mpp, stats, batch_size)
+            for row in infer_rows(proc_obj, tiled, occupied, batch_size):
+                tile_rows.put(row)
+            proc_obj.pbar.close()
+            print(stats)
+        except Exception as e:
+            print(f"❌ Failed segmenting {fname}: {e}")
+            if handed_off:
+                tile_rows.put(e)
+            else:
+                failures.append(fname)
+        if handed_off:
+            times['infer_s'] = time.time() - infer_start
+            tile_rows.put(_DONE)
+        proc = dt = tiled = None
 
-        # Convert to OME-TIFF Pyramid
-        run_ome_conversion(str(temp_path), str(final_path))
-        
-        print(f"✅ Saved to {final_path} in {(time.time()-start_time)/60:.1f}m")
-        gc.collect()
+    pending.put(_DONE)
+    writer.join()
+    if done:
+        total = {k: sum(t[k] for t in done) / 60 for k in ('load_s', 'wait_s', 'infer_s', 'stitch_s', 'write_s')}
+        print(f"{len(done)} slides in {(time.time()-run_start)/60:.1f}m; stage totals: load {total['load_s']:.1f}m, "
+              f"inference {total['infer_s']:.1f}m (waited {total['wait_s']:.1f}m for slides), "
+              f"stitch {total['stitch_s']:.1f}m, write {total['write_s']:.1f}m")
+    if failures:
+        print(f"❌ {len(failures)} slides failed: {', '.join(failures)}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -7,17 +7,24 @@
 # This script is based on Julia's script <julia.casado@helsinki.fi>. 
 
 import os
+import sys
+import shutil
 import argparse
 from pathlib import Path
-import csv
 import time
-import skimage.io
 import pandas as pd
 import numpy as np
-import skimage.measure as measure
 import multiprocessing as mp
 import tifffile
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'common'))
+import batch_schedule
+import label_quant
+import run_manifest
+import shared_mask
+import table_io
 
 dir2 = '/home/oncosys/Public/NKI_images/masks' # replace it with your own mask dir
 dir1 = '/home/oncosys/Public/NKI_images/image' # replace it with your own image dir
@@ -26,12 +33,10 @@ global iPath
 global mPath
 ips =[]
 mps =[]
-global CHANNEL_PROPS
-CHANNEL_PROPS=['mean_intensity']
-global MORPH_PROPS
-MORPH_PROPS=['label','centroid','area','eccentricity']
 global IMAGEPATH
-global CURRENT_MASK
+global CURRENT_MASKS
+CURRENT_MASKS = {}
+ATTACHED_SLIDES = 2 # slides overlap in the pool, so workers keep the masks of the most recent ones mapped
 global CHANNELS
 
 for filename in os.listdir(dir1):
@@ -45,53 +50,171 @@ for maskname in os.listdir(dir2):
                 mPath = os.path.join(dir2, maskname)
                 mps.append(mPath)
 
-def channelQuantification(channelNamesFile, maskPaths, imagePath, channel):
+def attachCompartments(compartments):
+	# Workers of the run-wide pool map the published masks of a slide once; the oldest slide is dropped so its pages can be freed
+	key = tuple(maskFile for _name, maskFile, _indexFile, _orderPrefix in compartments)
+	if key not in CURRENT_MASKS:
+		while len(CURRENT_MASKS) >= ATTACHED_SLIDES:
+			CURRENT_MASKS.pop(next(iter(CURRENT_MASKS)))
+		CURRENT_MASKS[key] = [(name, shared_mask.attach_mask(maskFile), label_quant.LabelIndex.load(indexFile),
+			label_quant.LabelOrder.load(orderPrefix) if orderPrefix else None) for name, maskFile, indexFile, orderPrefix in compartments]
+	return CURRENT_MASKS[key]
+
+def channelQuantification(channelNamesFile, imagePath, compartments, stats, channel):
 	channel_image_loaded = tifffile.imread(imagePath, key = channel)
 	print("channelQuantification step, channel names file is {}, read in channel {}".format(channelNamesFile, channel))
 
-	mask_loaded = tifffile.imread(maskPaths)
+	# The channel plane is read once and reduced against every compartment; rows follow the nuclear CellIDs
+	loaded = attachCompartments(compartments)
+	nuclei = loaded[0][2]
+	marker = checkChannelNames(channelNamesFile)[channel]
+	columns = {}
+	for name, mask, index, order in loaded:
+		column = label_quant.marker_column(marker, name, len(loaded) > 1)
+		values = index.intensity_stats(mask, channel_image_loaded, stats, order, labels=nuclei.labels)
+		columns[column] = values.pop('mean')
+		for stat in stats:
+			columns[label_quant.stat_column(column, stat)] = values[stat]
+	result = pd.DataFrame(columns)
 	if channel == 0:
-		props = MORPH_PROPS + CHANNEL_PROPS
-	else:
-		props = CHANNEL_PROPS
-	properties = measure.regionprops_table(mask_loaded, channel_image_loaded, properties=props)
-	result = pd.DataFrame(properties)
-	result.rename(columns={'mean_intensity':checkChannelNames(channelNamesFile)[channel], 'label':'CellID', 'centroid-0':'Y_centroid', 'centroid-1':'X_centroid', 'area':'Area', 'eccentricity':'Eccentricity'},inplace=True)
+		areas = pd.DataFrame({'Area_{}'.format(name): index.area(nuclei.labels) for name, mask, index, order in loaded[1:]})
+		result = pd.concat([nuclei.morphology_table(), areas, result], axis=1)
 
 	return result
 
-def imageQuantification(masks_loaded,threads):
-	mask_names = list(masks_loaded.keys())
-	result = {m_name: [] for m_name in mask_names}
-	pool = mp.Pool(threads)
-	print('Length of channels: {}'.format(len(checkChannelNames(args.channelNamesFile))))
+def hullStrip(maskFile, y0, y1):
+	# Convex hull chains of the cells in one row strip of the nuclear mask, merged in the parent for Solidity
+	return label_quant.strip_hulls(shared_mask.attach_mask(maskFile)[y0:y1], y0)
+
+def shapeFeatures(compartments, hulls, strips):
+	# MajorAxisLength, MinorAxisLength and Extent come from the nuclear index, Solidity from the merged strip hulls
+	nuclei = label_quant.LabelIndex.load(compartments[0][2])
+	convex = label_quant.ConvexArea(nuclei.bbox[2])
+	for (y0, y1), pieces in zip(strips, hulls):
+		convex.add(y1, pieces)
+	return nuclei.shape_table(convex.area)
 
-	res = pool.map(partial(channelQuantification, args.channelNamesFile, maskPaths, imagePath), 
+def indexMask(maskFile):
+	# Build the label index (and the label-sorted pixel order for order statistics) once in the parent and publish it next to the shared mask
+	indexFile = maskFile.replace('.mask.npy', '.index.npy')
+	label_quant.LabelIndex.from_mask(shared_mask.attach_mask(maskFile)).save(indexFile)
+	orderPrefix = None
+	if label_quant.needs_order(STATS):
+		orderPrefix = maskFile.replace('.mask.npy', '')
+		label_quant.LabelOrder.from_mask(shared_mask.attach_mask(maskFile)).save(orderPrefix)
+	return indexFile, orderPrefix
+
+def publishCompartments(im_name, maskPaths, shareDir):
+	# Each mask is decoded once into a shared memory-mapped file, derived compartments are dilated from the nuclei strip by strip
+	compartments = []
+	for name, m in maskPaths.items():
+		print('{} mask is {}'.format(name, m))
+		compartments.append((name, shared_mask.publish_mask(m, shareDir, '{}_{}'.format(im_name, name))))
+	if args.compartments:
+		nuclei = shared_mask.attach_mask(compartments[0][1])
+		outputs = {}
+		for name in args.compartments:
+			maskFile, outputs[name] = shared_mask.create_mask(shareDir, '{}_{}'.format(im_name, name), nuclei.shape, nuclei.dtype)
+			compartments.append((name, maskFile))
+		label_quant.write_derived_compartments(nuclei, outputs, args.expand, args.ringWidth)
+		for arr in outputs.values():
+			arr.flush()
+		outputs, nuclei = None, None
+	return [(name, maskFile) + indexMask(maskFile) for name, maskFile in compartments]
+
+def submitImageQuantification(compartments, imagePath, pool):
+	# Queue the hull strips and channel reductions of one slide without waiting; returns a function that gathers the table
+	print('Length of channels: {}'.format(len(checkChannelNames(args.channelNamesFile))))
+	height, width = shared_mask.attach_mask(compartments[0][1]).shape
+	strips = list(label_quant.iter_row_strips(height, label_quant.strip_rows_for(width)))
+	hulls = pool.starmap_async(hullStrip, [(compartments[0][1], y0, y1) for y0, y1 in strips])
+	res = pool.map_async(partial(channelQuantification, args.channelNamesFile, imagePath, compartments, STATS), 
 		range(len(checkChannelNames(args.channelNamesFile))))
-	pool.close()
-	pool.join()
+	def gather():
+		return pd.concat(res.get() + [shapeFeatures(compartments, hulls.get(), strips)],axis=1)
+	return gather
 
-	result[mask_names[0]] = pd.concat(res,axis=1)
-		
-	#Iterate through number of masks to extract single cell data
-	if len(mask_names) > 1:
-		print('THIS PRINT SHOULD NOT SHOW')
-		for mask in range(len(mask_names)):
-			CURRENT_MASK = masks_loaded[mask_names[mask]] 
-				# New pool for each time we modify the global variable: 'CURRENT_MASK'
-			pool = mp.Pool(threads)
-			res = pool.map(partial(channelQuantification, args.channelNamesFile, maskPaths, imagePath), 
-		  range(len(checkChannelNames(args.channelNamesFile))))
-			pool.close()
-			pool.join()
-			result[mask] = pd.concat(res)
-			#Concatenate all data from all masks to return
-		merged_data = pd.concat([result[mask] for mask in mask_names],axis=1)
-		merged_data = merged_data.reindex(columns = merged_data.columns.tolist() + ['MajorAxisLength','MinorAxisLength','Solidity', 'Extent'])
-	else:
-		merged_data = result[mask_names[0]]
-		merged_data = merged_data.reindex(columns = merged_data.columns.tolist() + ['MajorAxisLength','MinorAxisLength','Solidity', 'Extent'])
-	return merged_data
+def streamQuantification(channelNamesFile, maskPaths, imagePath, derived, expand, ringWidth, stats, channels):
+	# Out-of-core: mask and channel planes are read strip by strip, cells cut by strip boundaries merge exactly
+	names = checkChannelNames(channelNamesFile)
+	print("streamQuantification step, channels {}".format([names[c] for c in channels]))
+	masks = list(maskPaths.items())
+	result = label_quant.quantify_stream(masks[0][1], {names[c]: (imagePath, c) for c in channels},
+		derived=derived, extra_masks=dict(masks[1:]), expand=expand, ring_width=ringWidth, stats=stats, shape=0 in channels)
+	if 0 not in channels:
+		n_compartments = len(masks) + len(derived)
+		result = result.iloc[:, -len(channels) * n_compartments * (1 + len(stats)):]
+	return result
+
+def submitStreamQuantification(maskPaths, imagePath, pool):
+	# Each worker streams the mask once for its own contiguous group of channels
+	groups = [list(g) for g in np.array_split(np.arange(len(CHANNELS)), args.threads) if len(g)]
+	res = pool.map_async(partial(streamQuantification, args.channelNamesFile, maskPaths, imagePath, args.compartments, args.expand, args.ringWidth, STATS), groups)
+	def gather():
+		merged_data = pd.concat(res.get(),axis=1)
+		# the group holding channel 0 also returns the shape features, they stay the last columns
+		return merged_data[[c for c in merged_data.columns if c not in label_quant.SHAPE_COLUMNS] + label_quant.SHAPE_COLUMNS]
+	return gather
+
+def slideBytes(maskPaths):
+	# Shared memory one in-flight slide holds: its published masks, derived compartments and the label order for order statistics
+	if args.streaming:
+		return 0
+	total = 0
+	for name, m in maskPaths.items():
+		height, width, dtype, _planes = batch_schedule.tiff_plane_info(m)
+		total += height * width * dtype.itemsize * (1 + (len(args.compartments) if name == label_quant.PRIMARY_COMPARTMENT else 0))
+		if label_quant.needs_order(STATS):
+			total += height * width * 8
+	return total
+
+def workerBytes(imagePath):
+	# What one pool worker holds for a channel task: the plane, plus the packed sort keys of order statistics
+	height, width, dtype, _planes = batch_schedule.tiff_plane_info(imagePath)
+	if args.streaming:
+		return label_quant.DEFAULT_STRIP_PIXELS * (dtype.itemsize + 8) * (1 + len(args.compartments) + len(EXTRA_MASK_DIRS))
+	return height * width * (dtype.itemsize + (8 if label_quant.needs_order(STATS) else 0))
+
+def prepareSlide(slide, shareDir, budget):
+	# Loader thread: waits for room in the memory budget, then decodes, derives and indexes the masks while the pool works on earlier slides
+	imagePath, im_name, maskPaths = slide
+	cost = slideBytes(maskPaths)
+	budget.acquire(cost)
+	try:
+		if args.streaming:
+			return None, cost
+		slideDir = os.path.join(shareDir, im_name)
+		os.makedirs(slideDir, exist_ok=True)
+		return publishCompartments(im_name, maskPaths, slideDir), cost
+	except BaseException:
+		budget.release(cost)
+		raise
+
+def slideInputs(slide):
+	imagePath, im_name, maskPaths = slide
+	return [imagePath] + list(maskPaths.values()) + [args.channelNamesFile]
+
+def finishSlide(slide, gather, cost, budget, shareDir, manifest):
+	# Writer thread: waits for the slide's results, writes its table (atomically) and records it in the manifest, then frees its shared masks and budget
+	imagePath, im_name, maskPaths = slide
+	try:
+		scdata = gather()
+		outPath = table_io.write_table(scdata, args.outputFolder, im_name, args.format, args.rowGroupSize)
+		manifest.record(im_name, slideInputs(slide), PARAMS, [outPath])
+		print('Sample {} quantified in {:.2f} seconds'.format(im_name, time.time() - t))
+	finally:
+		shutil.rmtree(os.path.join(shareDir, im_name), ignore_errors=True)
+		budget.release(cost)
+
+def findMasks(im_name):
+	# Masks are paired with images by sample name (<name>.tif, <name>.ome.tif, ...) instead of sort order
+	maskPaths = {}
+	for name, paths in [(label_quant.PRIMARY_COMPARTMENT, mps)] + [(n, [os.path.join(d, f) for f in os.listdir(d)]) for n, d in EXTRA_MASK_DIRS.items()]:
+		matches = sorted(m for m in paths if m.endswith((".tif", ".tiff")) and os.path.basename(m).split('.')[0] == im_name)
+		if not matches:
+			return None
+		maskPaths[name] = matches[0]
+	return maskPaths
 
 def checkChannelNames(channel_names):
 	channel_names_loaded = pd.read_csv(channel_names, header = None)
@@ -114,36 +237,76 @@ if __name__ == '__main__':
 	parser.add_argument('--channelNamesFile','-ch')
 	parser.add_argument('--outputFolder','-o')
 	parser.add_argument('--threads','-c',type=int)
+	parser.add_argument('--shareDir', default=None, help='Where decoded masks are shared with workers (default /dev/shm)')
+	parser.add_argument('--streaming', action='store_true', help='Read mask and channels in row strips, memory bounded by strip size')
+	parser.add_argument('--format', default='csv', choices=table_io.FORMATS, help='csv: <sample>.csv, parquet: Sample=<sample>/<sample>.parquet dataset')
+	parser.add_argument('--rowGroupSize', type=int, default=table_io.DEFAULT_ROW_GROUP_SIZE, help='Rows per Parquet row group')
+	parser.add_argument('--masks', nargs='*', default=[], help='Extra compartment masks with nuclear IDs as name=dir, e.g. cell=/path/to/cell_masks')
+	parser.add_argument('--compartments', nargs='*', default=[], choices=label_quant.DERIVED_COMPARTMENTS, help='Compartments derived by dilating the nuclear mask')
+	parser.add_argument('--expand', type=float, default=label_quant.DEFAULT_EXPAND, help='Pixels the nuclei are grown by for derived compartments')
+	parser.add_argument('--ringWidth', type=float, default=label_quant.DEFAULT_RING_WIDTH, help='Width in pixels of the ring (membrane) compartment')
+	parser.add_argument('--stats', nargs='*', default=[], help=label_quant.STATS_HELP)
+	parser.add_argument('--force', action='store_true', help='Recompute every slide even if the manifest says its table is up to date')
+	parser.add_argument('--hashInputs', action='store_true', help='Also record sha256 of inputs, so touched but unchanged files are not recomputed')
+	parser.add_argument('--memoryBudget', default=None, help='Memory for slides in flight and worker planes, e.g. 64G (default: half of the available memory)')
 	args = parser.parse_args() 
 	# print(args.channelNamesFile)
 
+	EXTRA_MASK_DIRS = dict(m.split('=', 1) for m in args.masks)
+	STATS = label_quant.parse_stats(args.stats)
 	t = time.time()
 	CHANNELS = checkChannelNames(args.channelNamesFile)
 	print('Channels are {}'.format(CHANNELS))
 
-	for i in range(len(ips)):	
-		maskPaths = [sorted(mps)[i]]
-		imagePath = ips[i]
-		print('imagePath is {}'.format(imagePath))
-
-		masks_loaded = {}
-		for m in maskPaths:
-			print('maskpath is {}'.format(m))
-			m_full_name = os.path.basename(m)
-			m_name = m_full_name.split('.')[0]
-			print('m name is {}'.format(m_name))
-			masks_loaded.update({str(m_name):skimage.io.imread(m,plugin='tifffile')})
-		CURRENT_MASK = masks_loaded[list(masks_loaded.keys())[0]] # load first mask to run by default unless there are more
-		print('Current mask is {}'.format(CURRENT_MASK))
-
-		IMAGEPATH = imagePath
-		scdata = imageQuantification(masks_loaded, args.threads)
-		output = Path(args.outputFolder)
-		im_full_name = os.path.basename(imagePath)
-		print(imagePath)
-
-		im_name = im_full_name.split('.')[0]
-		scdata.to_csv(str(Path(os.path.join(str(args.outputFolder),str(im_name+".csv")))),index=False)
-		print('Sample {} quantified in {:.2f} seconds'.format(im_name, time.time() - t))
+	# Everything that changes a table; a slide whose inputs and parameters match its manifest entry is not recomputed
+	PARAMS = {'channels': CHANNELS, 'masks': sorted(EXTRA_MASK_DIRS), 'compartments': args.compartments, 'expand': args.expand,
+		'ringWidth': args.ringWidth, 'stats': STATS, 'format': args.format}
+	os.makedirs(args.outputFolder, exist_ok=True)
+	manifest = run_manifest.stage_manifest(args.outputFolder, 'quantify', args.hashInputs, args.force)
+
+	slides = []
+	for imagePath in ips:
+		im_name = os.path.basename(imagePath).split('.')[0]
+		maskPaths = findMasks(im_name)
+		if maskPaths is None:
+			print('Masks not found for {}, skipping.'.format(im_name))
+			continue
+		slide = (imagePath, im_name, maskPaths)
+		if manifest.is_current(im_name, slideInputs(slide), PARAMS):
+			print('Sample {} is up to date, skipping.'.format(im_name))
+			continue
+		for p in manifest.unrecorded_outputs(im_name, [table_io.table_path(args.outputFolder, im_name, args.format)]):
+			print('Overwriting {}, it is not recorded in the manifest'.format(p))
+		slides.append(slide)
+
+	# Slides overlap: the loader publishes the next slide's masks while the pool reduces the current one and the writer saves the previous table.
+	# How many slides are in flight is bounded by the memory budget, after setting aside what the workers hold.
+	limit = batch_schedule.parse_bytes(args.memoryBudget) if args.memoryBudget else (batch_schedule.available_memory() // 2 or None)
+	budget = batch_schedule.MemoryBudget(limit)
+	if slides:
+		budget.reserve(args.threads * max(workerBytes(imagePath) for imagePath, _n, _m in slides))
+	print('Memory budget {} bytes, {} reserved for {} workers'.format(limit, budget.reserved, args.threads))
+
+	# One pool for the whole run; workers re-map masks when a new slide arrives
+	pool = mp.Pool(args.threads)
+	with shared_mask.share_dir(args.shareDir) as shareDir, ThreadPoolExecutor(1) as loader, ThreadPoolExecutor(1) as writer:
+		written = []
+		prepared = loader.submit(prepareSlide, slides[0], shareDir, budget) if slides else None
+		for k, slide in enumerate(slides):
+			imagePath, im_name, maskPaths = slide
+			compartments, cost = prepared.result()
+			if k + 1 < len(slides):
+				prepared = loader.submit(prepareSlide, slides[k + 1], shareDir, budget)
+			print('imagePath is {}'.format(imagePath))
+			IMAGEPATH = imagePath
+			if args.streaming:
+				gather = submitStreamQuantification(maskPaths, imagePath, pool)
+			else:
+				gather = submitImageQuantification(compartments, imagePath, pool)
+			written.append(writer.submit(finishSlide, slide, gather, cost, budget, shareDir, manifest))
+		for f in written:
+			f.result()
+	pool.close()
+	pool.join()
 
 	#EOF
\ No newline at end of file
@@ -0,0 +1,202 @@
+"""
+Regression check of the quantification in filter_image_script.py against the
+previous implementation (one regionprops record per cell per marker, joined
+with pd.merge on CellID), on a synthetic slide.
+
+    python check_quantify_regression.py
+    python check_quantify_regression.py --shape 3000 3000 --cells 20000 --markers 8
+
+The synthetic slide has gaps in the label IDs, cells cut by the image border
+and single-pixel cells. Tables from the in-memory path, the streaming path
+and a parallel `run_quantify` over several copies of the slide are compared
+column by column with the reference; the script exits with status 1 if a
+column or a value differs beyond --rtol.
+
+The filter stage is checked on multi-page raw slides (one page per marker):
+`run_filter_all` with --workers threads reads several pages of one file at a
+time, and is run --repeats times; every tophat image must equal the plane
+filtered on its own. The fused pipeline is run the same way on the raw
+slides, and its tables must equal the quantification of those images.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+import numpy as np
+import pandas as pd
+import tifffile
+from skimage.measure import regionprops
+from skimage.segmentation import expand_labels
+
+import filter_image_script as fis
+
+
+def synthetic_slide(shape, cells, n_markers, seed=0):
+    """
+    Label mask (uint32, sparse IDs) and uint16 marker planes.
+    """
+    rng = np.random.default_rng(seed)
+    seeds = np.zeros(shape, np.uint32)
+    ys, xs = rng.integers(0, shape[0], cells), rng.integers(0, shape[1], cells)
+    seeds[ys, xs] = rng.choice(np.arange(1, 4 * cells), cells, replace=False)
+    mask = expand_labels(seeds, 6)
+    mask[rng.integers(0, shape[0], 20), rng.integers(0, shape[1], 20)] = 4 * cells + np.arange(20)
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    planes = []
+    for c in range(n_markers):
+        smooth = 1000 + 800 * np.sin(yy / (50.0 + 10 * c)) * np.cos(xx / 70.0)
+        planes.append(np.clip(smooth + rng.normal(0, 300, shape), 0, 65535).astype(np.uint16))
+    return mask, planes
+
+
+def reference_quantify_slide(marker_image_paths, mask_path):
+    """
+    The quantify_slide implementation this check guards against.
+    """
+    mask = tifffile.imread(mask_path)
+    all_data = None
+    for i, (marker, img_path) in enumerate(marker_image_paths.items()):
+        img = tifffile.imread(img_path)
+        records = []
+        for p in regionprops(mask, intensity_image=img):
+            rec = {'CellID': p.label, marker: float(p.intensity_mean)}
+            if i == 0:
+                rec.update({
+                    'Y_centroid': float(p.centroid[0]),
+                    'X_centroid': float(p.centroid[1]),
+                    'Area': int(p.area),
+                    'Eccentricity': float(p.eccentricity)
+                })
+            records.append(rec)
+        df = pd.DataFrame(records)
+        all_data = df if i == 0 else pd.merge(all_data, df[['CellID', marker]], on='CellID', how='left')
+    return all_data
+
+
+def write_raw_slides(raw_dir, planes, slides):
+    """
+    Multi-page raw slides S<s>.tif, one page per marker, shifted per slide.
+    """
+    os.makedirs(raw_dir)
+    for s in range(slides):
+        with tifffile.TiffWriter(os.path.join(raw_dir, f"S{s}.tif")) as tif:
+            for plane in planes:
+                tif.write(np.roll(plane, 37 * s, axis=1), contiguous=False)
+
+
+def check_filter_all(raw_dir, planes, names, slides, workers, size, repeats):
+    """
+    Filter the raw slides with `run_filter_all` on `workers` threads and
+    compare every tophat image with `tophat.white_tophat` of its plane.
+    """
+    markers = {name: c for c, name in enumerate(names)}
+    worst = 0
+    for _ in range(repeats):
+        fis.run_filter_all(raw_dir, markers, size, workers, force=True)
+        for s in range(slides):
+            for c, name in enumerate(names):
+                expected = fis.tophat.white_tophat(np.roll(planes[c], 37 * s, axis=1), size).astype(np.uint16)
+                path = fis.tophat_output_path(os.path.join(raw_dir, name), f"S{s}.tif", name)
+                got = tifffile.imread(path) if os.path.exists(path) else None
+                if got is None or got.shape != expected.shape:
+                    worst = np.inf
+                else:
+                    worst = max(worst, int(np.abs(got.astype(np.int64) - expected).max()))
+    ok = worst == 0
+    print(f"{'ok  ' if ok else 'FAIL'} run_filter_all --workers {workers} x {repeats} runs: "
+          f"max difference {worst}")
+    return ok
+
+
+def check_fused(raw_dir, mask_dir, out_dir, names, slides, workers, size, repeats, rtol):
+    """
+    Run the fused pipeline on the raw slides with `workers` threads and
+    compare its tables with `quantify_slide` on the tophat images of
+    `check_filter_all`.
+    """
+    markers = {name: c for c, name in enumerate(names)}
+    ok = True
+    for r in range(repeats):
+        fis.run_fused(raw_dir, markers, size, workers, mask_dir, out_dir, force=True)
+        for s in range(slides):
+            marker_imgs = {n: fis.tophat_output_path(os.path.join(raw_dir, n), f"S{s}.tif", n) for n in names}
+            ref = fis.quantify_slide(f"S{s}", marker_imgs, os.path.join(mask_dir, f"S{s}.tif"))
+            table = pd.read_csv(os.path.join(out_dir, f"S{s}.csv"))
+            ok &= compare(f"run_fused --workers {workers} run {r + 1} S{s}", ref, table, rtol)
+    return ok
+
+
+def compare(name, ref, out, rtol):
+    """
+    Print and return whether `out` matches `ref` column by column.
+    """
+    if list(out.columns) != list(ref.columns) or len(out) != len(ref):
+        print(f"FAIL {name}: columns {list(out.columns)} / {len(out)} rows, expected {list(ref.columns)} / {len(ref)}")
+        return False
+    worst = 0.0
+    for col in ref.columns:
+        a, b = ref[col].to_numpy(np.float64), out[col].to_numpy(np.float64)
+        err = np.abs(a - b) / np.maximum(np.abs(a), 1.0)
+        worst = max(worst, float(err.max()) if err.size else 0.0)
+    ok = worst <= rtol
+    print(f"{'ok  ' if ok else 'FAIL'} {name}: max relative difference {worst:.2e}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantification regression check on a synthetic slide")
+    parser.add_argument("--shape", type=int, nargs=2, default=[1200, 1500])
+    parser.add_argument("--cells", type=int, default=3000)
+    parser.add_argument("--markers", type=int, default=4)
+    parser.add_argument("--slides", type=int, default=3, help="Copies of the slide for the parallel run")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--rtol", type=float, default=1e-9)
+    parser.add_argument("--size", type=int, default=10, help="Tophat radius for the filter check")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of the multi-threaded filter check")
+    args = parser.parse_args()
+
+    mask, planes = synthetic_slide(tuple(args.shape), args.cells, args.markers)
+    names = [f"M{c}" for c in range(args.markers)]
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        tif_base, mask_dir, out_dir = (os.path.join(tmp, d) for d in ("tif", "masks", "out"))
+        os.makedirs(mask_dir)
+        for s in range(args.slides):
+            slide = f"S{s}"
+            tifffile.imwrite(os.path.join(mask_dir, f"{slide}.tif"), mask)
+            for name, plane in zip(names, planes):
+                path = fis.tophat_output_path(os.path.join(tif_base, name), f"{slide}.tif", name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tifffile.imwrite(path, plane)
+        marker_imgs = {n: fis.tophat_output_path(os.path.join(tif_base, n), "S0.tif", n) for n in names}
+        mask_path = os.path.join(mask_dir, "S0.tif")
+
+        t = time.perf_counter()
+        ref = reference_quantify_slide(marker_imgs, mask_path)
+        t_ref = time.perf_counter() - t
+        t = time.perf_counter()
+        out = fis.quantify_slide("S0", marker_imgs, mask_path)
+        t_new = time.perf_counter() - t
+        print(f"{len(ref)} cells x {args.markers} markers: reference {t_ref:.2f}s, quantify_slide {t_new:.2f}s")
+
+        ok &= compare("quantify_slide", ref, out, args.rtol)
+        ok &= compare("quantify_slide --streaming", ref, fis.quantify_slide("S0", marker_imgs, mask_path, True),
+                      args.rtol)
+        fis.run_quantify(tif_base, mask_dir, out_dir, slide_workers=args.workers)
+        for s in range(args.slides):
+            table = pd.read_csv(os.path.join(out_dir, f"S{s}.csv"))
+            ok &= compare(f"run_quantify --slide_workers {args.workers} S{s}", ref, table[ref.columns], args.rtol)
+        raw_dir = os.path.join(tmp, "raw")
+        write_raw_slides(raw_dir, planes, args.slides)
+        workers = max(2, args.workers)
+        ok &= check_filter_all(raw_dir, planes, names, args.slides, workers, args.size, args.repeats)
+        ok &= check_fused(raw_dir, mask_dir, os.path.join(tmp, "fused"), names, args.slides, workers, args.size,
+                          args.repeats, args.rtol)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
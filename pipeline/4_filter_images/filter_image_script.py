@@ -1,323 +1,939 @@
-
-"""
-=====================================================
- End-to-End Filter Image Script and Quantification Tool
-=====================================================
-Run with quantification
-This script performs two main steps:
-
-1. **Filtering (White Tophat)**: Enhances small bright structures by removing smooth background.Runs per marker/channel using a user-supplied JSON dictionary.
-2. **Quantification**:  Computes per-cell mean intensities (and shape features) for each marker. Uses pre-computed cell masks.
-
------------------------------------------------------
- Input / Output Structure
------------------------------------------------------
-
-Raw images:
-    <tif_dir>/*.tif or *.tiff
-    (multi-channel TIFFs; use 'key' = channel index, 0-based)
-
-Filtered images (produced here):
-    <tif_dir>/<MARKER>/<SLIDE>.ome_<MARKER>_tophat.tif
-    Raw images will NOT be modified, instead they will be separately stored
-
-Masks:
-    <mask_dir>/<SLIDE>.tif or <SLIDE>.tiff
-    (integer-labeled masks, one cell per label)
-
-Outputs (quantification):
-    <output_dir>/<SLIDE>.csv
-    (merged intensities across all markers for each cell)
-
------------------------------------------------------
- Parameters
------------------------------------------------------
-- `markers`: JSON string mapping marker names to channel indices.
-   Example: '{"Ki67":7,"DNA1":1,"CD3":4}'
-- `size`:    Disk radius (px) for white tophat. Default = 10.
-- `workers`: Number of parallel jobs for filtering. Default = 0 (sequential).
-
------------------------------------------------------
- Usage Examples
------------------------------------------------------
-
-# Run full pipeline (filter all markers, then quantify)
-# - Step 1: Apply white tophat filtering to all raw TIFFs
-# - Step 2: Quantify per-cell mean intensities using masks
-# - Output: One CSV per slide in /path/to/csv_out
-python filter_image_script.py pipeline \
-    --tif_dir /path/to/raw_tifs \
-    --markers '{"Ki67":7,"DNA1":1,"CD3":4}' \
-    --size 10 --workers 8 \
-    --mask_dir /path/to/masks \
-    --output_dir /path/to/csv_out
-
-# Filter all markers only
-# - Saves filtered TIFFs into subfolders /path/to/raw_tifs/<MARKER>/
-python filter_image_script.py filter \
-    --tif_dir /path/to/raw_tifs \
-    --markers '{"Ki67":7,"DNA1":1,"CD3":4}' \
-    --size 10 --workers 8
-
-# Quantify only (skip filtering; assumes filtered images already exist)
-# - Exports one CSV per slide into /path/to/csv_out
-python filter_image_script.py quantify \
-    --tif_dir /path/to/raw_tifs \
-    --mask_dir /path/to/masks \
-    --output_dir /path/to/csv_out
-"""
-
-import os
-import re
-import json
-import argparse
-from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, Tuple
-
-import numpy as np
-import pandas as pd
-import tifffile
-from skimage.io import imread, imsave
-from skimage.morphology import white_tophat, disk
-from skimage.measure import regionprops
-
-
-# -----------------------------
-# Filtering (white tophat)
-# -----------------------------
-
-def process_image(filename: str,
-                  base_path: str,
-                  output_folder: str,
-                  marker_name: str,
-                  key: int,
-                  size: int = 10) -> str:
-    """
-    Process a single TIFF image by applying white tophat filtering.
-    """
-    try:
-        if not filename.lower().endswith((".tif", ".tiff")):
-            return f"SKIP: {filename} (not TIFF)"
-
-        input_path = os.path.join(base_path, filename)
-        try:
-            image = imread(input_path, key=key)
-        except Exception as e:
-            return f"❌ {filename} - imread failed: {e}"
-
-        selem = disk(size)
-        filtered = white_tophat(image, selem)
-
-        # Output naming compatible with quantifier regex:
-        # <SLIDE>.ome_<MARKER>_tophat.tif
-        base, _ext = os.path.splitext(os.path.basename(filename))
-        new_filename = f"{base}.ome_{marker_name}_tophat.tif"
-        os.makedirs(output_folder, exist_ok=True)
-        output_path = os.path.join(output_folder, new_filename)
-
-        imsave(output_path, filtered.astype(np.uint16))
-        return f"✅ {filename} -> {output_path}"
-    except Exception as e:
-        return f"❌ {filename} crashed: {e}"
-
-
-def run_filter_for_marker(tif_dir: str, marker: str, key: int, size: int, workers: int = 0) -> None:
-    """
-    Run white tophat filtering over all TIFFs in `tif_dir` for one marker/channel.
-    Outputs to: <tif_dir>/<MARKER>/<SLIDE>.ome_<MARKER>_tophat.tif
-    """
-    input_dir = Path(tif_dir)
-    output_dir = input_dir / marker
-    files = [f for f in os.listdir(input_dir) if f.lower().endswith((".tif", ".tiff"))]
-
-    if not files:
-        print(f"[filter:{marker}] No TIFF files found to process.")
-        return
-
-    print(f"[filter:{marker}] key={key} size={size}  n_files={len(files)}")
-    if workers and workers > 1:
-        with ThreadPoolExecutor(max_workers=workers) as ex:
-            futures = [
-                ex.submit(process_image, f, str(input_dir), str(output_dir), marker, key, size)
-                for f in files
-            ]
-            for fut in as_completed(futures):
-                print(fut.result())
-    else:
-        for f in files:
-            msg = process_image(f, str(input_dir), str(output_dir), marker, key, size)
-            print(msg)
-
-
-def run_filter_all(tif_dir: str, markers: Dict[str, int], size: int, workers: int) -> None:
-    """
-    Filter ALL markers in the provided dictionary.
-    """
-    for marker, key in markers.items():
-        run_filter_for_marker(tif_dir, marker, int(key), size, workers)
-
-
-# -----------------------------
-# Quantification
-# -----------------------------
-
-def extract_slide_and_marker(filename: str) -> Tuple[str, str]:
-    """
-    Parse filenames like <SLIDE>.ome_<MARKER>_tophat.tif
-    Returns (SLIDE, MARKER) or (None, None) if no match.
-    """
-    match = re.match(r"(.+?)\.ome_(.+?)_tophat\.tif$", filename)
-    if match:
-        return match.group(1), match.group(2)
-    return None, None
-
-
-def load_all_marker_images(base_dir: str) -> Dict[str, Dict[str, str]]:
-    """
-    Scan per-marker subfolders under base_dir and build:
-        { SLIDENAME: { MARKER: image_path } }
-    """
-    marker_data: Dict[str, Dict[str, str]] = {}
-
-    for marker_folder in os.listdir(base_dir):
-        marker_path = os.path.join(base_dir, marker_folder)
-        if not os.path.isdir(marker_path):
-            continue
-
-        for fname in os.listdir(marker_path):
-            if fname.endswith(".tif") and ".ome_" in fname and "_tophat.tif" in fname:
-                slide, marker = extract_slide_and_marker(fname)
-                if slide and marker:
-                    marker_data.setdefault(slide, {})[marker] = os.path.join(marker_path, fname)
-    return marker_data
-
-
-def quantify_slide(slide_name: str,
-                   marker_image_paths: Dict[str, str],
-                   mask_path: str) -> pd.DataFrame:
-    """
-    Compute per-cell mean intensity for each marker, using a labeled cell mask.
-    """
-    print(f"Quantifying {slide_name}...")
-    mask = tifffile.imread(mask_path)
-
-    all_data = None
-    for i, (marker, img_path) in enumerate(marker_image_paths.items()):
-        img = tifffile.imread(img_path)
-        props = regionprops(mask, intensity_image=img)
-
-        records = []
-        for p in props:
-            rec = {
-                'CellID': p.label,
-                marker: float(p.mean_intensity)
-            }
-            if i == 0:
-                rec.update({
-                    'Y_centroid': float(p.centroid[0]),
-                    'X_centroid': float(p.centroid[1]),
-                    'Area': int(p.area),
-                    'Eccentricity': float(p.eccentricity)
-                })
-            records.append(rec)
-
-        df = pd.DataFrame(records)
-
-        if i == 0:
-            all_data = df
-        else:
-            all_data = pd.merge(all_data, df[['CellID', marker]], on='CellID', how='left')
-
-    return all_data
-
-
-def run_quantify(tif_base: str, mask_dir: str, output_dir: str) -> None:
-    """
-    Quantify all slides present under `tif_base` (expects per-marker subfolders).
-    """
-    os.makedirs(output_dir, exist_ok=True)
-    marker_map = load_all_marker_images(tif_base)
-
-    if not marker_map:
-        print("No corrected marker images found. Expected: <tif_base>/<MARKER>/<SLIDE>.ome_<MARKER>_tophat.tif")
-        return
-
-    for slide, marker_imgs in marker_map.items():
-        mask_file_tif = os.path.join(mask_dir, f"{slide}.tif")
-        mask_file_tiff = os.path.join(mask_dir, f"{slide}.tiff")
-        mask_file = mask_file_tif if os.path.exists(mask_file_tif) else mask_file_tiff
-
-        if not os.path.exists(mask_file):
-            print(f"Mask not found for {slide}, skipping.")
-            continue
-
-        result_df = quantify_slide(slide, marker_imgs, mask_file)
-        out_csv = os.path.join(output_dir, f"{slide}.csv")
-        result_df.to_csv(out_csv, index=False)
-        print(f"Saved: {out_csv}")
-
-
-# -----------------------------
-# CLI
-# -----------------------------
-
-def parse_markers_arg(markers_arg: str) -> Dict[str, int]:
-    """
-    Parse markers mapping from JSON only.
-    Example: '{"Ki67":7,"DNA1":1}'
-    """
-    try:
-        markers = json.loads(markers_arg)
-        return {k: int(v) for k, v in markers.items()}
-    except Exception as e:
-        raise ValueError(f"Invalid markers JSON: {e}")
-
-
-def main():
-    parser = argparse.ArgumentParser(
-        description="Filter all markers (JSON dict) then quantify."
-    )
-    sub = parser.add_subparsers(dest="cmd", required=True)
-
-    # filter-all
-    p_filter = sub.add_parser("filter", help="Filter ALL markers from a JSON dict")
-    p_filter.add_argument("--tif_dir", required=True, help="Folder with raw TIFFs")
-    p_filter.add_argument("--markers", required=True,
-                          help='Marker→channel dict in JSON, e.g. \'{"Ki67":7,"DNA1":1}\'')
-    p_filter.add_argument("--size", type=int, default=10, help="Disk radius (px) for white tophat")
-    p_filter.add_argument("--workers", type=int, default=0, help="Parallel workers (0/1 = sequential)")
-
-    # quantify-only
-    p_quant = sub.add_parser("quantify", help="Quantify per-cell intensities from corrected TIFFs")
-    p_quant.add_argument("--tif_dir", required=True, help="Base folder containing per-marker subfolders")
-    p_quant.add_argument("--mask_dir", required=True, help="Folder with per-slide label masks (SLIDE.tif/.tiff)")
-    p_quant.add_argument("--output_dir", required=True, help="Where to save CSV results")
-
-    # pipeline
-    p_pipe = sub.add_parser("pipeline", help="Run filter (all markers) then quantify")
-    p_pipe.add_argument("--tif_dir", required=True, help="Folder with raw TIFFs (input for filtering)")
-    p_pipe.add_argument("--markers", required=True,
-                        help='Marker→channel dict in JSON, e.g. \'{"Ki67":7,"DNA1":1}\'')
-    p_pipe.add_argument("--size", type=int, default=10, help="Disk radius (px) for white tophat")
-    p_pipe.add_argument("--workers", type=int, default=0, help="Parallel workers (0/1 = sequential)")
-    p_pipe.add_argument("--mask_dir", required=True, help="Folder with per-slide label masks (SLIDE.tif/.tiff)")
-    p_pipe.add_argument("--output_dir", required=True, help="Where to save CSV results")
-
-    args = parser.parse_args()
-
-    if args.cmd == "filter":
-        markers = parse_markers_arg(args.markers)
-        run_filter_all(args.tif_dir, markers, args.size, args.workers)
-
-    elif args.cmd == "quantify":
-        run_quantify(args.tif_dir, args.mask_dir, args.output_dir)
-
-    elif args.cmd == "pipeline":
-        markers = parse_markers_arg(args.markers)
-        run_filter_all(args.tif_dir, markers, args.size, args.workers)
-        run_quantify(args.tif_dir, args.mask_dir, args.output_dir)
-
-
-if __name__ == "__main__":
-    main()
+
+"""
+=====================================================
+ End-to-End Filter Image Script and Quantification Tool
+=====================================================
+Run with quantification
+This script performs two main steps:
+
+1. **Filtering (White Tophat)**: Enhances small bright structures by removing smooth background.Runs per marker/channel using a user-supplied JSON dictionary.
+2. **Quantification**:  Computes per-cell mean intensities (and shape features) for each marker. Uses pre-computed cell masks.
+
+-----------------------------------------------------
+ Input / Output Structure
+-----------------------------------------------------
+
+Raw images:
+    <tif_dir>/*.tif or *.tiff
+    (multi-channel TIFFs; use 'key' = channel index, 0-based)
+
+Filtered images (produced here):
+    <tif_dir>/<MARKER>/<SLIDE>.ome_<MARKER>_tophat.tif
+    or, with --stack, all markers of a slide as named channels of ONE file:
+    <tif_dir>/filtered/<SLIDE>.ome.tif or <SLIDE>.ome.zarr
+    Raw images will NOT be modified, instead they will be separately stored
+    `quantify` reads the stacks when present (markers by name, --channels to
+    select), otherwise the per-marker folders.
+
+Masks:
+    <mask_dir>/<SLIDE>.tif or <SLIDE>.tiff
+    (integer-labeled masks, one cell per label)
+
+Outputs (quantification):
+    <output_dir>/<SLIDE>.csv
+    (merged intensities across all markers for each cell)
+    or, with --format parquet, a dataset partitioned by sample:
+    <output_dir>/Sample=<SLIDE>/<SLIDE>.parquet
+
+-----------------------------------------------------
+ Parameters
+-----------------------------------------------------
+- `markers`: JSON string mapping marker names to channel indices.
+   Example: '{"Ki67":7,"DNA1":1,"CD3":4}'
+- `size`:    Disk radius (px) for white tophat. Default = 10.
+- `backend`: White tophat implementation (see common/tophat.py). Default =
+             vhgw, bit-identical to skimage and O(size) instead of O(size^2)
+             per pixel; opencv is exact and faster if OpenCV is installed;
+             skimage is the reference; decomposed is approximate.
+             benchmark_tophat.py validates and times them per radius.
+- `workers`: Number of parallel (slide, channel) filtering jobs. Each slide is
+             opened once and all markers are read from it. Default = 0 (sequential).
+- `slide_workers`: Slides quantified at once, in separate processes. Each
+             holds a whole mask and marker plane, so raise it only if memory
+             allows. Default = 1.
+- `compression`, `levels`: Filtered images are tiled OME-TIFFs (see
+             common/pyramid_tiff.py), zlib-compressed by default, with
+             `levels` resolutions for napari/QuPath (default 1, 0 = full
+             pyramid). They open lazily with aszarr.
+- `tile`:    Tiled filtering (e.g. 1024). Tiles are filtered with a 2*size
+             halo in `workers` processes and written straight into a tiled
+             output TIFF; memory is one block per worker and the output is
+             bit-identical to full-plane filtering. Default = 0 (full planes).
+
+-----------------------------------------------------
+ Usage Examples
+-----------------------------------------------------
+
+# Run full pipeline (filter all markers, then quantify)
+# - Step 1: Apply white tophat filtering to all raw TIFFs
+# - Step 2: Quantify per-cell mean intensities using masks
+# - Output: One CSV per slide in /path/to/csv_out
+python filter_image_script.py pipeline \
+    --tif_dir /path/to/raw_tifs \
+    --markers '{"Ki67":7,"DNA1":1,"CD3":4}' \
+    --size 10 --workers 8 \
+    --mask_dir /path/to/masks \
+    --output_dir /path/to/csv_out
+
+# Filter all markers only
+# - Saves filtered TIFFs into subfolders /path/to/raw_tifs/<MARKER>/
+python filter_image_script.py filter \
+    --tif_dir /path/to/raw_tifs \
+    --markers '{"Ki67":7,"DNA1":1,"CD3":4}' \
+    --size 10 --workers 8
+
+# Quantify only (skip filtering; assumes filtered images already exist)
+# - Exports one CSV per slide into /path/to/csv_out
+python filter_image_script.py quantify \
+    --tif_dir /path/to/raw_tifs \
+    --mask_dir /path/to/masks \
+    --output_dir /path/to/csv_out
+
+# Add --streaming to quantify or pipeline to read masks and filtered images
+# in row strips; memory is then bounded by the strip size, not the slide.
+
+# Fused pipeline: filter each channel and reduce it against the mask in
+# memory, no <MARKER>/<SLIDE>.ome_<MARKER>_tophat.tif round trip
+# (add --write_filtered to keep the filtered images as well)
+python filter_image_script.py pipeline --fused \
+    --tif_dir /path/to/raw_tifs \
+    --markers '{"Ki67":7,"DNA1":1,"CD3":4}' \
+    --size 10 --workers 8 \
+    --mask_dir /path/to/masks \
+    --output_dir /path/to/csv_out
+
+# Add --stats to quantify or pipeline for extra per-cell columns
+# <MARKER>_<stat>, e.g. --stats median std p90
+
+# Re-running a command skips every slide/marker whose inputs and parameters
+# are unchanged since it was last written (manifests _filter_manifest.json in
+# <tif_dir> and _quantify_manifest.json in <output_dir>). Outputs are written
+# to a temporary file and renamed, so an interrupted run can simply be
+# started again. --force recomputes everything; --hash_inputs also records
+# sha256 of the inputs, so touched but unchanged files are not recomputed.
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+from pathlib import Path
+from collections import deque
+from contextlib import ExitStack
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import tifffile
+import zarr
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "common"))
+import label_quant
+import pyramid_tiff
+import run_manifest
+import slide_stack
+import table_io
+import tophat
+
+
+# -----------------------------
+# Filtering (white tophat)
+# -----------------------------
+
+def tophat_output_path(output_folder: str, filename: str, marker_name: str) -> str:
+    """
+    Output naming compatible with quantifier regex:
+    <output_folder>/<SLIDE>.ome_<MARKER>_tophat.tif
+    """
+    base, _ext = os.path.splitext(os.path.basename(filename))
+    return os.path.join(output_folder, f"{base}.ome_{marker_name}_tophat.tif")
+
+
+def slide_name(filename: str) -> str:
+    """
+    <SLIDE> of a raw image, as used in tophat and stack file names.
+    """
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def stack_output_path(tif_dir: str, filename: str, stack: str) -> str:
+    """
+    <tif_dir>/filtered/<SLIDE>.ome.tif or .ome.zarr
+    """
+    return slide_stack.stack_path(os.path.join(tif_dir, slide_stack.STACK_FOLDER), slide_name(filename), stack)
+
+
+def stack_params(markers: Dict[str, int], base_params: Dict[str, object], stack: str) -> Dict[str, object]:
+    return dict(base_params, markers=markers, stack=stack)
+
+
+def save_filtered(output_path: str, data, marker_name: str, params: Dict[str, object],
+                  shape: Optional[Tuple[int, int]] = None) -> None:
+    """
+    Atomically write a filtered plane (array, or tile stream with `shape`)
+    as a tiled OME-TIFF with params["compression"] and params["levels"]
+    resolutions (see common/pyramid_tiff.py).
+    """
+    with run_manifest.atomic_output(output_path) as tmp:
+        pyramid_tiff.write_pyramid(tmp, data, shape, np.uint16, [marker_name],
+                                   tile=params.get("tile") or pyramid_tiff.DEFAULT_TILE,
+                                   levels=params["levels"] or None, compression=params["compression"])
+
+
+def process_image(filename: str,
+                  base_path: str,
+                  output_folder: str,
+                  marker_name: str,
+                  key: int,
+                  size: int = 10,
+                  manifest: Optional[run_manifest.Manifest] = None,
+                  backend: str = tophat.DEFAULT_BACKEND,
+                  compression: str = pyramid_tiff.DEFAULT_COMPRESSION,
+                  levels: int = 1) -> str:
+    """
+    Process a single TIFF image by applying white tophat filtering.
+    With a `manifest`, images filtered before with the same inputs and
+    parameters are skipped and new results are recorded.
+    """
+    try:
+        if not filename.lower().endswith((".tif", ".tiff")):
+            return f"SKIP: {filename} (not TIFF)"
+
+        input_path = os.path.join(base_path, filename)
+        output_path = tophat_output_path(output_folder, filename, marker_name)
+        entry = f"{marker_name}/{filename}"
+        params = {"marker": marker_name, "key": key, "size": size, "backend": backend,
+                  "compression": compression, "levels": levels}
+        if manifest is not None and manifest.is_current(entry, [input_path], params):
+            return f"SKIP: {filename} (up to date)"
+
+        try:
+            image = tifffile.imread(input_path, key=key)
+        except Exception as e:
+            return f"❌ {filename} - imread failed: {e}"
+
+        filtered = tophat.white_tophat(image, size, backend)
+
+        save_filtered(output_path, filtered.astype(np.uint16), marker_name, params)
+        if manifest is not None:
+            manifest.record(entry, [input_path], params, [output_path])
+        return f"✅ {filename} -> {output_path}"
+    except Exception as e:
+        return f"❌ {filename} crashed: {e}"
+
+
+def run_filter_for_marker(tif_dir: str, marker: str, key: int, size: int, workers: int = 0,
+                          manifest: Optional[run_manifest.Manifest] = None,
+                          backend: str = tophat.DEFAULT_BACKEND,
+                          compression: str = pyramid_tiff.DEFAULT_COMPRESSION,
+                          levels: int = 1) -> None:
+    """
+    Run white tophat filtering over all TIFFs in `tif_dir` for one marker/channel.
+    Outputs to: <tif_dir>/<MARKER>/<SLIDE>.ome_<MARKER>_tophat.tif
+    """
+    input_dir = Path(tif_dir)
+    output_dir = input_dir / marker
+    files = [f for f in os.listdir(input_dir) if f.lower().endswith((".tif", ".tiff"))]
+
+    if not files:
+        print(f"[filter:{marker}] No TIFF files found to process.")
+        return
+
+    print(f"[filter:{marker}] key={key} size={size} backend={backend}  n_files={len(files)}")
+    if workers and workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [
+                ex.submit(process_image, f, str(input_dir), str(output_dir), marker, key, size, manifest, backend,
+                          compression, levels)
+                for f in files
+            ]
+            for fut in as_completed(futures):
+                print(fut.result())
+    else:
+        for f in files:
+            msg = process_image(f, str(input_dir), str(output_dir), marker, key, size, manifest, backend,
+                                compression, levels)
+            print(msg)
+
+
+def filter_page(page: tifffile.TiffPage,
+                filename: str,
+                input_path: str,
+                output_path: str,
+                marker_name: str,
+                params: Dict[str, object],
+                manifest: Optional[run_manifest.Manifest] = None) -> str:
+    """
+    Filter one channel page of an already opened slide and save it.
+    """
+    try:
+        image = page.asarray()
+        filtered = tophat.white_tophat(image, params["size"], params["backend"])
+        save_filtered(output_path, filtered.astype(np.uint16), marker_name, params)
+        if manifest is not None:
+            manifest.record(f"{marker_name}/{filename}", [input_path], params, [output_path])
+        return f"✅ {filename} [{marker_name}] -> {output_path}"
+    except Exception as e:
+        return f"❌ {filename} [{marker_name}] crashed: {e}"
+
+
+def pending_markers(manifest: run_manifest.Manifest, filename: str, input_path: str,
+                    markers: Dict[str, int], base_params: Dict[str, object],
+                    stack: Optional[str] = None) -> Dict[str, Dict[str, object]]:
+    """
+    Filter parameters of the markers of one slide that are not up to date.
+    With `stack`, the slide's container is one unit: all markers or none.
+    """
+    if stack is not None:
+        if manifest.is_current(f"stack/{filename}", [input_path], stack_params(markers, base_params, stack)):
+            print(f"SKIP: {filename} [{stack}] (up to date)")
+            return {}
+        return {marker: dict(base_params, marker=marker, key=int(key)) for marker, key in markers.items()}
+    todo = {}
+    for marker, key in markers.items():
+        params = dict(base_params, marker=marker, key=int(key))
+        if manifest.is_current(f"{marker}/{filename}", [input_path], params):
+            print(f"SKIP: {filename} [{marker}] (up to date)")
+        else:
+            todo[marker] = params
+    return todo
+
+
+def filter_stack(ex: ThreadPoolExecutor,
+                 tif: tifffile.TiffFile,
+                 filename: str,
+                 input_path: str,
+                 output_path: str,
+                 todo: Dict[str, Dict[str, object]],
+                 params: Dict[str, object],
+                 manifest: run_manifest.Manifest) -> str:
+    """
+    Filter the channels `todo` of an opened slide on `ex` into one
+    multi-channel container (see common/slide_stack.py).
+    """
+    try:
+        pages = {marker: tif.pages[p["key"]] for marker, p in todo.items()}
+        shape = next(iter(pages.values())).shape[-2:]
+        with slide_stack.StackWriter(output_path, list(pages), shape, np.uint16, levels=params["levels"] or None,
+                                     compression=params["compression"]) as writer:
+            futures = [ex.submit(lambda m, page: writer.write(
+                           m, tophat.white_tophat(page.asarray(), params["size"], params["backend"]).astype(np.uint16)),
+                           marker, page) for marker, page in pages.items()]
+            errors = [fut.exception() for fut in futures]
+            for marker, error in zip(pages, errors):
+                if error is not None:
+                    raise RuntimeError(f"[{marker}] {error}")
+        manifest.record(f"stack/{filename}", [input_path], params, [output_path])
+        return f"✅ {filename} [{len(pages)} markers] -> {output_path}"
+    except Exception as e:
+        return f"❌ {filename} crashed: {e}"
+
+
+def run_filter_all(tif_dir: str, markers: Dict[str, int], size: int, workers: int,
+                   force: bool = False, hash_inputs: bool = False, backend: str = tophat.DEFAULT_BACKEND,
+                   tile: int = 0, compression: str = pyramid_tiff.DEFAULT_COMPRESSION, levels: int = 1,
+                   stack: Optional[str] = None) -> None:
+    """
+    Filter ALL markers in the provided dictionary, slide by slide.
+
+    Each TIFF is opened and its pages indexed ONCE; every requested channel
+    is read from that handle. (slide, channel) tasks run on `workers`
+    threads, and the next slide is opened while the channels of the
+    previous one are still being filtered (at most two slides open).
+    With `tile`, see `run_filter_tiled`. Outputs are tiled OME-TIFFs with
+    `compression` and `levels` resolutions, one per marker folder, or with
+    `stack` one multi-channel container per slide in <tif_dir>/filtered/.
+    Images that are up to date in <tif_dir>/_filter_manifest.json are
+    skipped unless `force`.
+    """
+    manifest = run_manifest.stage_manifest(tif_dir, "filter", hash_inputs, force)
+    files = sorted(f for f in os.listdir(tif_dir) if f.lower().endswith((".tif", ".tiff")))
+    if not files:
+        print("[filter] No TIFF files found to process.")
+        return
+
+    print(f"[filter] {len(files)} slides x {len(markers)} markers  size={size} backend={backend} tile={tile or 'off'}")
+    if tile:
+        run_filter_tiled(tif_dir, files, markers, size, workers, manifest, backend, tile, compression, levels, stack)
+        return
+    base_params = {"size": size, "backend": backend, "compression": compression, "levels": levels}
+    # stacked slides are driven from their own thread, their channels run on `ex`
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex, ThreadPoolExecutor(max_workers=2) as slides:
+        in_flight = deque()
+
+        def finish_oldest():
+            tif, futures = in_flight.popleft()
+            for fut in futures:
+                print(fut.result())
+            tif.close()
+
+        for filename in files:
+            input_path = os.path.join(tif_dir, filename)
+            todo = pending_markers(manifest, filename, input_path, markers, base_params, stack)
+            if not todo:
+                continue
+
+            try:
+                tif = tifffile.TiffFile(input_path)
+                tif.filehandle.set_lock(True)
+            except Exception as e:
+                print(f"❌ {filename} - open failed: {e}")
+                continue
+            futures = []
+            if stack is not None:
+                futures.append(slides.submit(filter_stack, ex, tif, filename, input_path,
+                                             stack_output_path(tif_dir, filename, stack), todo,
+                                             stack_params(markers, base_params, stack), manifest))
+                todo = {}
+            # index every page before the first task reads one: parsing a page is not under the file lock
+            pages = {}
+            for marker, params in todo.items():
+                try:
+                    pages[marker] = tif.pages[params["key"]]
+                except Exception as e:
+                    print(f"❌ {filename} [{marker}] - no page {params['key']}: {e}")
+            for marker, page in pages.items():
+                params = todo[marker]
+                futures.append(ex.submit(filter_page, page, filename, input_path,
+                                         tophat_output_path(os.path.join(tif_dir, marker), filename, marker),
+                                         marker, params, manifest))
+            in_flight.append((tif, futures))
+            if len(in_flight) > 1:
+                finish_oldest()
+        while in_flight:
+            finish_oldest()
+
+
+# Tiled mode: worker processes keep the zarr view of the pages they read
+_TILE_SOURCES: Dict[Tuple[str, int], Tuple[tifffile.TiffFile, object]] = {}
+_MAX_TILE_SOURCES = 4
+
+
+def _tile_source(path: str, key: int):
+    if (path, key) not in _TILE_SOURCES:
+        while len(_TILE_SOURCES) >= _MAX_TILE_SOURCES:
+            _TILE_SOURCES.pop(next(iter(_TILE_SOURCES)))[0].close()
+        tif = tifffile.TiffFile(path)
+        _TILE_SOURCES[(path, key)] = (tif, zarr.open(tif.pages[key].aszarr(), mode="r"))
+    return _TILE_SOURCES[(path, key)][1]
+
+
+def filter_tile(path: str, key: int, bounds: Tuple[int, int, int, int], shape: Tuple[int, int],
+                size: int, backend: str) -> np.ndarray:
+    """
+    Worker task: white tophat of one output tile, read with its halo.
+    """
+    plane = _tile_source(path, key)
+    return tophat.tophat_tile(lambda y0, y1, x0, x1: plane[y0:y1, x0:x1], bounds, shape, size,
+                              backend).astype(np.uint16)
+
+
+def run_filter_tiled(tif_dir: str, files, markers: Dict[str, int], size: int, workers: int,
+                     manifest: run_manifest.Manifest, backend: str, tile: int,
+                     compression: str = pyramid_tiff.DEFAULT_COMPRESSION, levels: int = 1,
+                     stack: Optional[str] = None) -> None:
+    """
+    Tiled filtering with bounded memory: every output tile is filtered in a
+    worker process from a block with a 2*size halo (bit-identical to the
+    full plane), and the parent streams the tiles, in order, straight into
+    a tiled output TIFF (or the slide's `stack` container); sub-resolution
+    levels are reduced from that stream. Tiles of (slide, channel) jobs are
+    queued back to back, so workers never wait for an output to be closed.
+    """
+    if tile % 16:
+        raise ValueError(f"--tile must be a multiple of 16, got {tile}")
+    base_params = {"size": size, "backend": backend, "tile": tile, "compression": compression, "levels": levels}
+    jobs = []
+    for filename in files:
+        input_path = os.path.join(tif_dir, filename)
+        todo = pending_markers(manifest, filename, input_path, markers, base_params, stack)
+        if not todo:
+            continue
+        slide_jobs = []
+        with tifffile.TiffFile(input_path) as tif:
+            for marker, params in todo.items():
+                try:
+                    shape = tif.pages[params["key"]].shape[-2:]
+                except Exception as e:
+                    print(f"❌ {filename} [{marker}] - no page {params['key']}: {e}")
+                    continue
+                slide_jobs.append((filename, input_path, marker, params, shape,
+                                   list(tophat.iter_tiles(shape, tile))))
+        if stack is not None and (len(slide_jobs) < len(todo) or len({job[4] for job in slide_jobs}) > 1):
+            print(f"❌ {filename} - {stack} needs every marker, all of the same shape; skipped")
+            continue
+        jobs.extend(slide_jobs)
+
+    def ordered_tiles(ex):
+        # keep a few tiles per worker queued; results come back in submission order
+        window = deque()
+        for _filename, input_path, _marker, params, shape, grid in jobs:
+            for bounds in grid:
+                window.append(ex.submit(filter_tile, input_path, params["key"], bounds, shape, size, backend))
+                if len(window) > 4 * max(1, workers):
+                    yield window.popleft()
+        while window:
+            yield window.popleft()
+
+    def stream(grid, taken, i):
+        for _ in grid:
+            fut = next(results)
+            taken[i] += 1
+            yield fut.result()
+
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as ex:
+        results = ordered_tiles(ex)
+        for filename, group in groupby(jobs, key=lambda job: job[0]):
+            group = list(group)
+            input_path = group[0][1]
+            taken = [0] * len(group)
+            if stack is not None:
+                output_path = stack_output_path(tif_dir, filename, stack)
+                try:
+                    with slide_stack.StackWriter(output_path, [job[2] for job in group], group[0][4], np.uint16,
+                                                 tile, levels or None, compression) as writer:
+                        for i, (_f, _p, marker, _params, _shape, grid) in enumerate(group):
+                            writer.write(marker, stream(grid, taken, i))
+                    manifest.record(f"stack/{filename}", [input_path], stack_params(markers, base_params, stack),
+                                    [output_path])
+                    print(f"✅ {filename} [{len(group)} markers] -> {output_path}")
+                except Exception as e:
+                    print(f"❌ {filename} crashed: {e}")
+                for i, job in enumerate(group):
+                    for _ in range(len(job[5]) - taken[i]):
+                        next(results)  # drop what is left of a failed slide, keeping the stream aligned
+            else:
+                for i, (_f, _p, marker, params, shape, grid) in enumerate(group):
+                    output_path = tophat_output_path(os.path.join(tif_dir, marker), filename, marker)
+                    try:
+                        save_filtered(output_path, stream(grid, taken, i), marker, params, shape)
+                        manifest.record(f"{marker}/{filename}", [input_path], params, [output_path])
+                        print(f"✅ {filename} [{marker}] -> {output_path}")
+                    except Exception as e:
+                        print(f"❌ {filename} [{marker}] crashed: {e}")
+                    for _ in range(len(grid) - taken[i]):
+                        next(results)  # drop what is left of a failed output, keeping the stream aligned
+
+
+# -----------------------------
+# Quantification
+# -----------------------------
+
+def extract_slide_and_marker(filename: str) -> Tuple[str, str]:
+    """
+    Parse filenames like <SLIDE>.ome_<MARKER>_tophat.tif
+    Returns (SLIDE, MARKER) or (None, None) if no match.
+    """
+    match = re.match(r"(.+?)\.ome_(.+?)_tophat\.tif$", filename)
+    if match:
+        return match.group(1), match.group(2)
+    return None, None
+
+
+def load_all_marker_images(base_dir: str) -> Dict[str, Dict[str, str]]:
+    """
+    Scan per-marker subfolders under base_dir and build:
+        { SLIDENAME: { MARKER: image_path } }
+    """
+    marker_data: Dict[str, Dict[str, str]] = {}
+
+    for marker_folder in os.listdir(base_dir):
+        marker_path = os.path.join(base_dir, marker_folder)
+        if not os.path.isdir(marker_path):
+            continue
+
+        for fname in os.listdir(marker_path):
+            if fname.endswith(".tif") and ".ome_" in fname and "_tophat.tif" in fname:
+                slide, marker = extract_slide_and_marker(fname)
+                if slide and marker:
+                    marker_data.setdefault(slide, {})[marker] = os.path.join(marker_path, fname)
+    return marker_data
+
+
+def slide_table(index: label_quant.LabelIndex,
+                reduced: Dict[str, Dict[str, np.ndarray]],
+                stats: Tuple[str, ...] = ()) -> pd.DataFrame:
+    """
+    Assemble per-marker `intensity_stats` results into one table without
+    merges: CellID, first marker (+stats), Y_centroid, X_centroid, Area,
+    Eccentricity, then the remaining markers (+stats).
+    """
+    columns = {'CellID': index.labels}
+    for i, (marker, values) in enumerate(reduced.items()):
+        columns[marker] = values['mean']
+        for stat in stats:
+            columns[label_quant.stat_column(marker, stat)] = values[stat]
+        if i == 0:
+            morphology = index.morphology_table()
+            for col in label_quant.MORPHOLOGY_COLUMNS[1:]:
+                columns[col] = morphology[col].values
+    return pd.DataFrame(columns)
+
+
+def quantify_slide(slide_name: str,
+                   marker_image_paths: Dict[str, Union[str, Tuple[str, int]]],
+                   mask_path: str,
+                   streaming: bool = False,
+                   stats: Tuple[str, ...] = ()) -> pd.DataFrame:
+    """
+    Compute per-cell mean intensity for each marker, using a labeled cell mask.
+    The mask is indexed once (label_quant.LabelIndex) and every marker is one
+    vectorized reduction against it, so the cost does not grow with Python
+    work per cell. Images are single-marker paths or (stack path, channel)
+    pairs from `slide_stack.channel_sources`. With `streaming`, mask and
+    images are read in row strips instead of whole planes. `stats` adds
+    <MARKER>_<stat> columns (see label_quant.parse_stats).
+    """
+    print(f"Quantifying {slide_name}...")
+    stats = label_quant.parse_stats(stats)
+    sources = {m: src if isinstance(src, tuple) else (src, None) for m, src in marker_image_paths.items()}
+    if streaming:
+        table = label_quant.quantify_stream(mask_path, sources, stats=stats)
+        markers = [[m] + [label_quant.stat_column(m, s) for s in stats] for m in marker_image_paths]
+        first, rest = markers[0], [c for m in markers[1:] for c in m]
+        return table[['CellID'] + first + label_quant.MORPHOLOGY_COLUMNS[1:] + rest]
+
+    mask = tifffile.imread(mask_path)
+    index = label_quant.LabelIndex.from_mask(mask)
+    order = label_quant.LabelOrder.from_mask(mask) if label_quant.needs_order(stats) else None
+    reduced = {}
+    for marker, (path, key) in sources.items():
+        reduced[marker] = index.intensity_stats(mask, label_quant.read_plane(path, key), stats, order)
+    return slide_table(index, reduced, stats)
+
+
+def find_mask(mask_dir: str, slide: str) -> Optional[str]:
+    """
+    <mask_dir>/<SLIDE>.tif or .tiff, None if neither exists.
+    """
+    for ext in (".tif", ".tiff"):
+        path = os.path.join(mask_dir, f"{slide}{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def slide_sources(tif_base: str, channels: Optional[List[str]] = None) -> Dict[str, Dict[str, object]]:
+    """
+    { SLIDE: { MARKER: image } } of the filtered images under `tif_base`: the
+    channels of the multi-channel stacks in <tif_base>/filtered/ when there
+    are any, found by name, otherwise the per-marker subfolders. `channels`
+    restricts (and orders) the markers by name.
+    """
+    stacks = slide_stack.find_stacks(os.path.join(tif_base, slide_stack.STACK_FOLDER))
+    if stacks:
+        marker_map = {slide: slide_stack.channel_sources(path) for slide, path in stacks.items()}
+    else:
+        marker_map = load_all_marker_images(tif_base)
+    if not channels:
+        return marker_map
+    selected = {}
+    for slide, images in marker_map.items():
+        missing = [m for m in channels if m not in images]
+        if missing:
+            print(f"{slide} has no {missing}, skipping.")
+            continue
+        selected[slide] = {m: images[m] for m in channels}
+    return selected
+
+
+def quantify_and_write(slide: str, marker_imgs: Dict[str, object], mask_file: str, output_dir: str,
+                       streaming: bool = False, fmt: str = "csv", stats: Tuple[str, ...] = ()) -> str:
+    """
+    Quantify one slide and write its table; returns the table path.
+    """
+    result_df = quantify_slide(slide, marker_imgs, mask_file, streaming, stats)
+    return table_io.write_table(result_df, output_dir, slide, fmt)
+
+
+def run_quantify(tif_base: str, mask_dir: str, output_dir: str, streaming: bool = False, fmt: str = "csv",
+                 stats: Tuple[str, ...] = (), force: bool = False, hash_inputs: bool = False,
+                 slide_workers: int = 1, channels: Optional[List[str]] = None) -> None:
+    """
+    Quantify all slides present under `tif_base`: multi-channel stacks in
+    <tif_base>/filtered/, or per-marker subfolders (see `slide_sources`).
+    With `slide_workers` > 1, slides are quantified in that many processes at
+    once; each holds one mask and one marker plane (or strips with
+    `streaming`), so memory grows with `slide_workers`.
+    Slides that are up to date in <output_dir>/_quantify_manifest.json are
+    skipped unless `force`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = run_manifest.stage_manifest(output_dir, "quantify", hash_inputs, force)
+    marker_map = slide_sources(tif_base, channels)
+
+    if not marker_map:
+        print("No corrected marker images found. Expected: <tif_base>/filtered/<SLIDE>.ome.tif|.ome.zarr "
+              "or <tif_base>/<MARKER>/<SLIDE>.ome_<MARKER>_tophat.tif")
+        return
+
+    jobs = []
+    for slide, marker_imgs in sorted(marker_map.items()):
+        mask_file = find_mask(mask_dir, slide)
+        if mask_file is None:
+            print(f"Mask not found for {slide}, skipping.")
+            continue
+
+        inputs = [mask_file] + sorted({src[0] if isinstance(src, tuple) else src for src in marker_imgs.values()})
+        params = {"markers": list(marker_imgs), "stats": label_quant.parse_stats(stats), "format": fmt}
+        if manifest.is_current(slide, inputs, params):
+            print(f"{slide} is up to date, skipping.")
+            continue
+        for path in manifest.unrecorded_outputs(slide, [table_io.table_path(output_dir, slide, fmt)]):
+            print(f"Overwriting {path}, it is not recorded in the manifest")
+        jobs.append((slide, marker_imgs, mask_file, inputs, params))
+
+    def done(slide, inputs, params, out_path):
+        manifest.record(slide, inputs, params, [out_path])
+        print(f"Saved: {out_path}")
+
+    if slide_workers <= 1 or len(jobs) <= 1:
+        for slide, marker_imgs, mask_file, inputs, params in jobs:
+            done(slide, inputs, params,
+                 quantify_and_write(slide, marker_imgs, mask_file, output_dir, streaming, fmt, stats))
+        return
+
+    with ProcessPoolExecutor(max_workers=min(slide_workers, len(jobs))) as ex:
+        futures = {ex.submit(quantify_and_write, slide, marker_imgs, mask_file, output_dir, streaming, fmt, stats):
+                   (slide, inputs, params) for slide, marker_imgs, mask_file, inputs, params in jobs}
+        for fut in as_completed(futures):
+            slide, inputs, params = futures[fut]
+            try:
+                done(slide, inputs, params, fut.result())
+            except Exception as e:
+                print(f"❌ {slide} crashed: {e}")
+
+
+# -----------------------------
+# Fused filter + quantify
+# -----------------------------
+
+def fused_slide(filename: str,
+                input_path: str,
+                mask_path: str,
+                markers: Dict[str, int],
+                size: int,
+                backend: str = tophat.DEFAULT_BACKEND,
+                stats: Tuple[str, ...] = (),
+                workers: int = 0,
+                filtered_dir: Optional[str] = None,
+                filter_manifest: Optional[run_manifest.Manifest] = None,
+                compression: str = pyramid_tiff.DEFAULT_COMPRESSION,
+                levels: int = 1,
+                stack: Optional[str] = None) -> pd.DataFrame:
+    """
+    Filter every marker channel of one slide and reduce it against the mask
+    right away, without writing and re-reading tophat TIFFs. The mask is
+    indexed once, the slide opened once, and channels run on `workers`
+    threads. With `filtered_dir` the filtered planes are saved as well, per
+    marker folder or, with `stack`, as one container per slide.
+    Columns and values match `quantify_slide` on the saved tophat images.
+    """
+    stats = label_quant.parse_stats(stats)
+    mask = tifffile.imread(mask_path)
+    index = label_quant.LabelIndex.from_mask(mask)
+    order = label_quant.LabelOrder.from_mask(mask) if label_quant.needs_order(stats) else None
+
+    base_params = {"size": size, "backend": backend, "compression": compression, "levels": levels}
+    writer = None
+    with tifffile.TiffFile(input_path) as tif, ExitStack() as outputs:
+        tif.filehandle.set_lock(True)
+        if filtered_dir is not None and stack is not None:
+            stack_path = stack_output_path(filtered_dir, filename, stack)
+            writer = outputs.enter_context(slide_stack.StackWriter(
+                stack_path, list(markers), mask.shape, np.uint16, levels=levels or None, compression=compression))
+
+        # pages are indexed here, parsing one is not under the file lock; the threads only read them
+        pages = {marker: tif.pages[int(key)] for marker, key in markers.items()}
+
+        def reduce_marker(marker):
+            key = markers[marker]
+            filtered = tophat.white_tophat(pages[marker].asarray(), size, backend).astype(np.uint16)
+            if filtered.shape != mask.shape:
+                raise ValueError(f"{filename} [{marker}]: plane {filtered.shape} does not match mask {mask.shape}")
+            if writer is not None:
+                writer.write(marker, filtered)
+            elif filtered_dir is not None:
+                output_path = tophat_output_path(os.path.join(filtered_dir, marker), filename, marker)
+                params = dict(base_params, marker=marker, key=int(key))
+                save_filtered(output_path, filtered, marker, params)
+                if filter_manifest is not None:
+                    filter_manifest.record(f"{marker}/{filename}", [input_path], params, [output_path])
+            return index.intensity_stats(mask, filtered, stats, order)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+            reduced = list(ex.map(reduce_marker, pages))
+
+    if writer is not None and filter_manifest is not None:
+        filter_manifest.record(f"stack/{filename}", [input_path], stack_params(markers, base_params, stack),
+                               [stack_path])
+    return slide_table(index, dict(zip(markers, reduced)), stats)
+
+
+def run_fused(tif_dir: str, markers: Dict[str, int], size: int, workers: int, mask_dir: str, output_dir: str,
+              fmt: str = "csv", stats: Tuple[str, ...] = (), force: bool = False, hash_inputs: bool = False,
+              backend: str = tophat.DEFAULT_BACKEND, write_filtered: bool = False,
+              compression: str = pyramid_tiff.DEFAULT_COMPRESSION, levels: int = 1,
+              stack: Optional[str] = None) -> None:
+    """
+    Fused pipeline: per slide, filter and quantify every marker in memory
+    (see `fused_slide`). Filtered TIFFs are only written with `write_filtered`.
+    Slides that are up to date in <output_dir>/_quantify_manifest.json are
+    skipped unless `force`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = run_manifest.stage_manifest(output_dir, "quantify", hash_inputs, force)
+    filter_manifest = run_manifest.stage_manifest(tif_dir, "filter", hash_inputs, force) if write_filtered else None
+    files = sorted(f for f in os.listdir(tif_dir) if f.lower().endswith((".tif", ".tiff")))
+    print(f"[fused] {len(files)} slides x {len(markers)} markers  size={size} backend={backend}")
+
+    for filename in files:
+        slide = slide_name(filename)
+        mask_file = find_mask(mask_dir, slide)
+        if mask_file is None:
+            print(f"Mask not found for {slide}, skipping.")
+            continue
+
+        input_path = os.path.join(tif_dir, filename)
+        inputs = [input_path, mask_file]
+        params = {"markers": markers, "size": size, "backend": backend,
+                  "stats": label_quant.parse_stats(stats), "format": fmt}
+        if manifest.is_current(slide, inputs, params):
+            print(f"{slide} is up to date, skipping.")
+            continue
+        for path in manifest.unrecorded_outputs(slide, [table_io.table_path(output_dir, slide, fmt)]):
+            print(f"Overwriting {path}, it is not recorded in the manifest")
+
+        print(f"Filtering and quantifying {slide}...")
+        result_df = fused_slide(filename, input_path, mask_file, markers, size, backend, stats, workers,
+                                tif_dir if write_filtered else None, filter_manifest, compression, levels, stack)
+        out_path = table_io.write_table(result_df, output_dir, slide, fmt)
+        manifest.record(slide, inputs, params, [out_path])
+        print(f"Saved: {out_path}")
+
+
+# -----------------------------
+# CLI
+# -----------------------------
+
+def parse_markers_arg(markers_arg: str) -> Dict[str, int]:
+    """
+    Parse markers mapping from JSON only.
+    Example: '{"Ki67":7,"DNA1":1}'
+    """
+    try:
+        markers = json.loads(markers_arg)
+        return {k: int(v) for k, v in markers.items()}
+    except Exception as e:
+        raise ValueError(f"Invalid markers JSON: {e}")
+
+
+def add_output_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--compression", default=pyramid_tiff.DEFAULT_COMPRESSION, choices=pyramid_tiff.COMPRESSIONS,
+                        help="Compression of the filtered OME-TIFFs (zstd/lzw need imagecodecs)")
+    parser.add_argument("--levels", type=int, default=1,
+                        help="Resolution levels of the filtered OME-TIFFs (1 = no pyramid, 0 = down to one tile)")
+    parser.add_argument("--stack", default=None, choices=slide_stack.STACK_FORMATS,
+                        help="Write all markers of a slide as channels of <tif_dir>/filtered/<SLIDE>.ome.tif|.ome.zarr")
+
+
+def add_resume_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--force", action="store_true", help="Recompute outputs even if the manifest says they are up to date")
+    parser.add_argument("--hash_inputs", action="store_true", help="Record sha256 of inputs (touched but unchanged files are not recomputed)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Filter all markers (JSON dict) then quantify."
+    )
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    # filter-all
+    p_filter = sub.add_parser("filter", help="Filter ALL markers from a JSON dict")
+    p_filter.add_argument("--tif_dir", required=True, help="Folder with raw TIFFs")
+    p_filter.add_argument("--markers", required=True,
+                          help='Marker→channel dict in JSON, e.g. \'{"Ki67":7,"DNA1":1}\'')
+    p_filter.add_argument("--size", type=int, default=10, help="Disk radius (px) for white tophat")
+    p_filter.add_argument("--workers", type=int, default=0, help="Parallel workers (0/1 = sequential)")
+    p_filter.add_argument("--backend", default=tophat.DEFAULT_BACKEND, choices=sorted(tophat.BACKENDS),
+                          help="White tophat implementation (see benchmark_tophat.py)")
+    p_filter.add_argument("--tile", type=int, default=0,
+                          help="Filter in tiles of this size (multiple of 16) on a process pool; writes tiled TIFFs")
+    add_output_args(p_filter)
+    add_resume_args(p_filter)
+
+    # quantify-only
+    p_quant = sub.add_parser("quantify", help="Quantify per-cell intensities from corrected TIFFs")
+    p_quant.add_argument("--tif_dir", required=True, help="Base folder containing per-marker subfolders")
+    p_quant.add_argument("--mask_dir", required=True, help="Folder with per-slide label masks (SLIDE.tif/.tiff)")
+    p_quant.add_argument("--output_dir", required=True, help="Where to save CSV results")
+    p_quant.add_argument("--streaming", action="store_true", help="Read masks/images in row strips (bounded memory)")
+    p_quant.add_argument("--format", default="csv", choices=table_io.FORMATS, help="Output table format")
+    p_quant.add_argument("--stats", nargs="*", default=[], help=label_quant.STATS_HELP)
+    p_quant.add_argument("--slide_workers", type=int, default=1,
+                         help="Slides quantified at once in separate processes, each holding a whole mask (default 1)")
+    p_quant.add_argument("--channels", nargs="*", default=None,
+                         help="Marker names to quantify, in column order (default: all)")
+    add_resume_args(p_quant)
+
+    # pipeline
+    p_pipe = sub.add_parser("pipeline", help="Run filter (all markers) then quantify")
+    p_pipe.add_argument("--tif_dir", required=True, help="Folder with raw TIFFs (input for filtering)")
+    p_pipe.add_argument("--markers", required=True,
+                        help='Marker→channel dict in JSON, e.g. \'{"Ki67":7,"DNA1":1}\'')
+    p_pipe.add_argument("--size", type=int, default=10, help="Disk radius (px) for white tophat")
+    p_pipe.add_argument("--workers", type=int, default=0, help="Parallel workers (0/1 = sequential)")
+    p_pipe.add_argument("--slide_workers", type=int, default=1,
+                        help="Slides quantified at once in separate processes, each holding a whole mask (default 1)")
+    p_pipe.add_argument("--backend", default=tophat.DEFAULT_BACKEND, choices=sorted(tophat.BACKENDS),
+                        help="White tophat implementation (see benchmark_tophat.py)")
+    p_pipe.add_argument("--tile", type=int, default=0,
+                        help="Filter in tiles of this size (multiple of 16) on a process pool; writes tiled TIFFs")
+    p_pipe.add_argument("--mask_dir", required=True, help="Folder with per-slide label masks (SLIDE.tif/.tiff)")
+    p_pipe.add_argument("--output_dir", required=True, help="Where to save CSV results")
+    p_pipe.add_argument("--streaming", action="store_true", help="Read masks/images in row strips (bounded memory)")
+    p_pipe.add_argument("--format", default="csv", choices=table_io.FORMATS, help="Output table format")
+    p_pipe.add_argument("--stats", nargs="*", default=[], help=label_quant.STATS_HELP)
+    p_pipe.add_argument("--fused", action="store_true",
+                        help="Filter and quantify each slide in memory, without intermediate tophat TIFFs "
+                             "(whole planes: cannot be combined with --tile, --streaming or --slide_workers)")
+    p_pipe.add_argument("--write_filtered", action="store_true",
+                        help="With --fused, also save the filtered images to <tif_dir>/<MARKER>/")
+    add_output_args(p_pipe)
+    add_resume_args(p_pipe)
+
+    args = parser.parse_args()
+    if args.cmd == "pipeline" and args.fused:
+        unsupported = [flag for flag, used in (("--tile", args.tile), ("--streaming", args.streaming),
+                                               ("--slide_workers", args.slide_workers > 1)) if used]
+        if unsupported:
+            parser.error(f"--fused filters and quantifies whole planes; it cannot be combined with "
+                         f"{', '.join(unsupported)}")
+
+    if args.cmd == "filter":
+        markers = parse_markers_arg(args.markers)
+        run_filter_all(args.tif_dir, markers, args.size, args.workers, args.force, args.hash_inputs, args.backend,
+                       args.tile, args.compression, args.levels, args.stack)
+
+    elif args.cmd == "quantify":
+        run_quantify(args.tif_dir, args.mask_dir, args.output_dir, args.streaming, args.format, args.stats,
+                     args.force, args.hash_inputs, args.slide_workers, args.channels)
+
+    elif args.cmd == "pipeline" and args.fused:
+        markers = parse_markers_arg(args.markers)
+        run_fused(args.tif_dir, markers, args.size, args.workers, args.mask_dir, args.output_dir, args.format,
+                  args.stats, args.force, args.hash_inputs, args.backend, args.write_filtered,
+                  args.compression, args.levels, args.stack)
+
+    elif args.cmd == "pipeline":
+        markers = parse_markers_arg(args.markers)
+        run_filter_all(args.tif_dir, markers, args.size, args.workers, args.force, args.hash_inputs, args.backend,
+                       args.tile, args.compression, args.levels, args.stack)
+        run_quantify(args.tif_dir, args.mask_dir, args.output_dir, args.streaming, args.format, args.stats,
+                     args.force, args.hash_inputs, args.slide_workers, list(markers))
+
+if __name__ == "__main__":
+    main()
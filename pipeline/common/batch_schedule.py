@@ -0,0 +1,104 @@
+"""
+=====================================================
+ Memory-budgeted batch scheduling helpers
+=====================================================
+Batch runs overlap slides: while the worker pool reduces the channels of one
+slide, the next slide is already being decoded and published, and the
+finished table of the previous one is written. What may be in flight at
+once is limited by a byte budget instead of a fixed number of slides:
+
+    budget = MemoryBudget(parse_bytes("64G"))
+    budget.reserve(threads * plane_bytes)     # working set of the pool
+    budget.acquire(slide_bytes)               # loader: blocks until it fits
+    ...
+    budget.release(slide_bytes)               # writer: slide done
+
+A request larger than the whole budget is still admitted when nothing else
+is held, so one oversized slide slows the batch down instead of stalling it.
+Sizes are estimated from TIFF headers only (`tiff_plane_info`).
+"""
+
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import tifffile
+
+_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_bytes(text: str) -> int:
+    """
+    '512M', '64G', '1.5T' or a plain number of bytes.
+    """
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*", str(text), flags=re.IGNORECASE)
+    if not m:
+        raise ValueError(f"Cannot parse memory size {text!r}, use e.g. 512M or 64G")
+    return int(float(m.group(1)) * _UNITS[m.group(2).upper()])
+
+
+def available_memory() -> int:
+    """
+    Physical memory currently available, 0 if the platform does not say.
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def tiff_plane_info(path: str) -> Tuple[int, int, np.dtype, int]:
+    """
+    (height, width, dtype, number of planes) of the full-resolution first
+    series of a TIFF, from its header.
+    """
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        shape, dtype = series.shape, np.dtype(series.dtype)
+    planes = int(np.prod(shape[:-2])) if len(shape) > 2 else 1
+    return int(shape[-2]), int(shape[-1]), dtype, planes
+
+
+class MemoryBudget:
+    """
+    Byte budget shared by the threads of a batch run.
+    """
+
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+        self.reserved = 0
+        self.held = 0
+        self._cond = threading.Condition()
+
+    def reserve(self, n: int) -> None:
+        """
+        Set aside `n` bytes for the whole run (e.g. the planes the pool
+        workers hold); they never block an otherwise idle budget.
+        """
+        with self._cond:
+            self.reserved += n
+
+    def acquire(self, n: int) -> None:
+        """
+        Block until `n` more bytes fit, or until nothing else is held.
+        """
+        with self._cond:
+            while self.limit is not None and self.held > 0 and self.reserved + self.held + n > self.limit:
+                self._cond.wait()
+            self.held += n
+
+    def release(self, n: int) -> None:
+        with self._cond:
+            self.held -= n
+            self._cond.notify_all()
+
+    @contextmanager
+    def hold(self, n: int) -> Iterator[None]:
+        self.acquire(n)
+        try:
+            yield
+        finally:
+            self.release(n)
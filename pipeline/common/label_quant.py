@@ -0,0 +1,893 @@
+"""
+=====================================================
+ Label-indexed single-cell quantification
+=====================================================
+Shared quantification engine for the pipeline scripts.
+
+regionprops rebuilds every region object and walks the whole mask once per
+channel. Here the mask is indexed ONCE: the labels present, their pixel
+counts and their coordinate moments are accumulated in a single pass. Each
+channel is then reduced against the mask with a label-weighted
+`np.bincount`, which is one linear pass over the plane.
+
+All accumulation is done over row strips of bounded size, so temporaries
+never grow with the slide. Accumulators are dense arrays indexed by label
+value (pixel count, intensity sums, coordinate sums and sums of squares),
+which means partial sums from different strips merge exactly and cells
+cut by a strip boundary need no special handling.
+
+`quantify_stream` reads the mask and the channel planes strip by strip
+through tifffile's `aszarr` interface, so memory is bounded by the strip
+size instead of the slide size. For integer-valued planes every
+accumulator holds exact integers, so its table is identical to the
+in-memory result.
+
+Output columns match `regionprops_table` as used by the quantifiers:
+    CellID, Y_centroid, X_centroid, Area, Eccentricity, <marker means>
+
+Compartments: besides the nuclear mask, cell / cytoplasm / ring masks can be
+derived by label-aware dilation of the nuclei (`derive_compartments`), or
+given as extra mask files with matching IDs. Every compartment is reduced
+against the same channel strip, and columns get a `_<compartment>` suffix.
+
+Shape features (`SHAPE_COLUMNS`): axis lengths come from the same central
+moments as the eccentricity and extent from a per-label bounding box that
+is accumulated over the horizontal label runs of each strip. Solidity needs
+the convex area: every cell's hull is built only from its own runs (the
+pixel outlines of its bounding-box crop), strip pieces of a hull merge, and
+a hull is rasterized as soon as the strip holding its last row is done
+(`ConvexArea`). Values match regionprops' axis_major_length,
+axis_minor_length, solidity and extent.
+
+Extended statistics (opt-in, see `parse_stats`): std and integrated
+intensity come from the same bincounts as the mean (plus a sum of squares);
+min, max, median and percentiles come from a `LabelOrder`, the foreground
+pixels sorted by label ONCE per mask and reused by every channel. Columns are
+`<marker>_<stat>`.
+"""
+
+import os
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import tifffile
+import zarr
+from skimage.segmentation import expand_labels
+
+# Pixels per strip; strip height is derived from the plane width.
+DEFAULT_STRIP_PIXELS = 1 << 24
+
+MORPHOLOGY_COLUMNS = ['CellID', 'Y_centroid', 'X_centroid', 'Area', 'Eccentricity']
+SHAPE_COLUMNS = ['MajorAxisLength', 'MinorAxisLength', 'Solidity', 'Extent']
+
+PRIMARY_COMPARTMENT = 'nucleus'
+DERIVED_COMPARTMENTS = ('cell', 'cytoplasm', 'ring')
+DEFAULT_EXPAND = 5        # px the nuclei are grown by to get the cell
+DEFAULT_RING_WIDTH = 2    # px of the outer cell rim used as membrane proxy
+
+SUM_STATS = ('std', 'integrated')
+ORDER_STATS = ('median', 'min', 'max')
+STATS_HELP = "Extra per-cell intensity stats: median std min max integrated pNN (e.g. p10 p90)"
+
+
+def strip_rows_for(width: int, strip_pixels: int = DEFAULT_STRIP_PIXELS) -> int:
+    """
+    Number of rows per strip so that a strip holds about `strip_pixels` pixels.
+    """
+    return max(1, int(strip_pixels) // max(1, int(width)))
+
+
+def iter_row_strips(height: int, rows: int) -> Iterator[Tuple[int, int]]:
+    """
+    Yield (y0, y1) bounds of consecutive row strips covering `height` rows.
+    """
+    for y0 in range(0, height, rows):
+        yield y0, min(y0 + rows, height)
+
+
+def _label_bins(mask_strip: np.ndarray) -> np.ndarray:
+    """
+    Flatten a mask strip into an array `np.bincount` accepts.
+    """
+    flat = mask_strip.ravel()
+    if flat.dtype.kind not in 'iu' or not np.can_cast(flat.dtype, np.intp):
+        flat = flat.astype(np.intp)
+    return flat
+
+
+def _grow(arr: np.ndarray, n: int, fill: float = 0) -> np.ndarray:
+    """
+    Extend a dense per-label accumulator with `fill` up to length `n`.
+    """
+    if arr.shape[-1] >= n:
+        return arr
+    pad = [(0, 0)] * (arr.ndim - 1) + [(0, n - arr.shape[-1])]
+    return np.pad(arr, pad, constant_values=fill)
+
+
+def parse_stats(stats: Optional[Iterable[str]]) -> List[str]:
+    """
+    Validate requested statistics: median, std, min, max, integrated and
+    percentiles written as pNN (0 <= NN <= 100, e.g. p10, p99.5).
+    """
+    out = []
+    for stat in stats or ():
+        stat = stat.strip()
+        if stat in SUM_STATS or stat in ORDER_STATS:
+            out.append(stat)
+        elif re.fullmatch(r"p\d+(\.\d+)?", stat) and float(stat[1:]) <= 100:
+            out.append(stat)
+        else:
+            raise ValueError(f"Unknown statistic {stat!r}. {STATS_HELP}")
+    return list(dict.fromkeys(out))
+
+
+def needs_order(stats: Sequence[str]) -> bool:
+    """
+    True when `stats` include min/max/median/percentiles.
+    """
+    return any(s not in SUM_STATS for s in stats)
+
+
+def stat_column(column: str, stat: str) -> str:
+    return f"{column}_{stat}"
+
+
+def _align(own_labels: np.ndarray, values: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """
+    Re-order `values` (one per `own_labels`, sorted) to `labels`, NaN where missing.
+    """
+    out = np.full(labels.shape[0], np.nan)
+    if own_labels.shape[0] == 0:
+        return out
+    pos = np.clip(np.searchsorted(own_labels, labels), 0, own_labels.shape[0] - 1)
+    hit = own_labels[pos] == labels
+    out[hit] = values[pos[hit]]
+    return out
+
+
+class LabelOrder:
+    """
+    Foreground pixels of a mask sorted by label.
+
+    One stable argsort per mask; every channel is then gathered in this order
+    and reduced per contiguous label segment, so min/max need no sort at all
+    and median/percentiles only sort values inside each segment.
+    """
+
+    def __init__(self, order: np.ndarray, labels: np.ndarray, counts: np.ndarray):
+        self.order = order
+        self.labels = labels
+        self.counts = counts
+        self.starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+
+    @classmethod
+    def from_mask(cls, mask: np.ndarray) -> "LabelOrder":
+        flat = np.asarray(mask).ravel()
+        fg = np.flatnonzero(flat)
+        lab = flat[fg]
+        perm = np.argsort(lab, kind='stable')
+        order, lab = fg[perm], lab[perm]
+        if lab.shape[0] == 0:
+            return cls(order, lab.astype(np.int64), np.zeros(0, dtype=np.int64))
+        starts = np.flatnonzero(np.r_[True, lab[1:] != lab[:-1]])
+        return cls(order, lab[starts].astype(np.int64), np.diff(np.r_[starts, lab.shape[0]]))
+
+    def save(self, prefix: str) -> None:
+        np.save(f"{prefix}.order.npy", self.order)
+        np.save(f"{prefix}.segments.npy", np.vstack([self.labels, self.counts]).astype(np.int64))
+
+    @classmethod
+    def load(cls, prefix: str, mmap_mode: Optional[str] = 'r') -> "LabelOrder":
+        segments = np.load(f"{prefix}.segments.npy")
+        return cls(np.load(f"{prefix}.order.npy", mmap_mode=mmap_mode), segments[0], segments[1])
+
+    def _sorted_within_segments(self, vals: np.ndarray) -> np.ndarray:
+        seg = np.repeat(np.arange(self.labels.shape[0], dtype=np.int64), self.counts)
+        if vals.dtype.kind in 'iu' and vals.dtype.itemsize <= 4:
+            # (segment, value) packed in one int64 key: a plain sort, no argsort
+            lo = int(vals.min())
+            key = (seg << 32) | (vals.astype(np.int64) - lo)
+            key.sort()
+            return (key & 0xFFFFFFFF) + lo
+        return vals[np.lexsort((vals, seg))]
+
+    def _percentile(self, srt: np.ndarray, q: float) -> np.ndarray:
+        # linear interpolation, as np.percentile's default
+        pos = q / 100 * (self.counts - 1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, self.counts - 1)
+        a = srt[self.starts + lo].astype(np.float64)
+        b = srt[self.starts + hi].astype(np.float64)
+        return a + (b - a) * (pos - lo)
+
+    def reduce(self, image: np.ndarray, stats: Sequence[str]) -> Dict[str, np.ndarray]:
+        """
+        Order statistics of `image` per label, ordered like `self.labels`.
+        """
+        stats = [s for s in stats if s not in SUM_STATS]
+        if not stats:
+            return {}
+        if self.labels.shape[0] == 0:
+            return {s: np.zeros(0) for s in stats}
+        vals = np.asarray(image).ravel()[self.order]
+        out = {}
+        if 'min' in stats:
+            out['min'] = np.minimum.reduceat(vals, self.starts).astype(np.float64)
+        if 'max' in stats:
+            out['max'] = np.maximum.reduceat(vals, self.starts).astype(np.float64)
+        quantiles = [s for s in stats if s not in ('min', 'max')]
+        if quantiles:
+            srt = self._sorted_within_segments(vals)
+            for s in quantiles:
+                out[s] = self._percentile(srt, 50.0 if s == 'median' else float(s[1:]))
+        return out
+
+
+def eccentricity_from_moments(n: np.ndarray,
+                              mu_yy: np.ndarray,
+                              mu_xx: np.ndarray,
+                              mu_xy: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Inertia tensor eigenvalues (l1 >= l2) and eccentricity from central
+    moments, following skimage's `inertia_tensor_eigvals` / `eccentricity`.
+    """
+    a = mu_xx / n
+    c = mu_yy / n
+    b = -mu_xy / n
+    half_trace = (a + c) / 2
+    disc = np.sqrt(((a - c) / 2) ** 2 + b ** 2)
+    l1 = np.clip(half_trace + disc, 0, None)
+    l2 = np.clip(half_trace - disc, 0, None)
+    ratio = np.divide(l2, l1, out=np.ones_like(l1), where=l1 > 0)
+    ecc = np.where(l1 > 0, np.sqrt(np.clip(1 - ratio, 0, None)), 0.0)
+    return l1, l2, ecc
+
+
+def marker_column(marker: str, compartment: str, suffixed: bool) -> str:
+    """
+    Output column of a marker, `<marker>_<compartment>` when several
+    compartments are quantified.
+    """
+    return f"{marker}_{compartment}" if suffixed else marker
+
+
+def derive_compartments(nuclei: np.ndarray,
+                        names: Iterable[str],
+                        expand: float = DEFAULT_EXPAND,
+                        ring_width: float = DEFAULT_RING_WIDTH) -> Dict[str, np.ndarray]:
+    """
+    Derive compartments from a nuclear label block by label-aware dilation
+    (`expand_labels`, touching cells never merge). IDs follow the nuclei.
+        cell:      nuclei grown by `expand` px
+        cytoplasm: cell minus nucleus
+        ring:      outer `ring_width` px of the cell (membrane proxy)
+    """
+    names = set(names)
+    unknown = names - set(DERIVED_COMPARTMENTS)
+    if unknown:
+        raise ValueError(f"Cannot derive compartments {sorted(unknown)}; choose from {DERIVED_COMPARTMENTS}")
+    cell = expand_labels(nuclei, distance=expand)
+    out = {}
+    if 'cell' in names:
+        out['cell'] = cell
+    if 'cytoplasm' in names:
+        out['cytoplasm'] = np.where(nuclei == 0, cell, 0)
+    if 'ring' in names:
+        inner = expand_labels(nuclei, distance=max(expand - ring_width, 0))
+        out['ring'] = np.where(inner == 0, cell, 0)
+    return out
+
+
+def iter_derived_strips(read, height: int, rows: int, names: Iterable[str],
+                        expand: float = DEFAULT_EXPAND,
+                        ring_width: float = DEFAULT_RING_WIDTH):
+    """
+    Yield (y0, y1, nuclei_strip, {name: derived_strip}) over row strips.
+    `read(a, b)` returns nuclear rows a:b; each strip is derived from a block
+    with a halo of `expand` rows so the dilation is the same as on the full mask.
+    """
+    names = list(names)
+    halo = int(np.ceil(expand)) if names else 0
+    for y0, y1 in iter_row_strips(height, rows):
+        a, b = max(0, y0 - halo), min(height, y1 + halo)
+        block = np.asarray(read(a, b))
+        derived = derive_compartments(block, names, expand, ring_width) if names else {}
+        crop = slice(y0 - a, y1 - a)
+        yield y0, y1, block[crop], {name: arr[crop] for name, arr in derived.items()}
+
+
+def write_derived_compartments(nuclei: np.ndarray,
+                               outputs: Dict[str, np.ndarray],
+                               expand: float = DEFAULT_EXPAND,
+                               ring_width: float = DEFAULT_RING_WIDTH,
+                               strip_pixels: int = DEFAULT_STRIP_PIXELS) -> None:
+    """
+    Fill preallocated `outputs` (name -> array shaped like `nuclei`, e.g.
+    memory-mapped) with derived compartments, strip by strip.
+    """
+    rows = strip_rows_for(nuclei.shape[1], strip_pixels)
+    for y0, y1, _nuc, derived in iter_derived_strips(lambda a, b: nuclei[a:b], nuclei.shape[0], rows,
+                                                     list(outputs), expand, ring_width):
+        for name, arr in derived.items():
+            outputs[name][y0:y1] = arr
+
+
+def _accumulate_morphology(counts: np.ndarray, moments: np.ndarray, y0: int, flat: np.ndarray, width: int) -> None:
+    """
+    Add pixel counts and coordinate moments of one strip in place.
+    """
+    h = flat.shape[0] // width
+    size = counts.shape[0]
+    ys = np.repeat(np.arange(y0, y0 + h, dtype=np.float64), width)
+    xs = np.tile(np.arange(width, dtype=np.float64), h)
+    counts += np.bincount(flat, minlength=size)
+    moments[0] += np.bincount(flat, weights=ys, minlength=size)
+    moments[1] += np.bincount(flat, weights=xs, minlength=size)
+    moments[2] += np.bincount(flat, weights=ys * ys, minlength=size)
+    moments[3] += np.bincount(flat, weights=xs * xs, minlength=size)
+    moments[4] += np.bincount(flat, weights=ys * xs, minlength=size)
+
+
+def _accumulate_channel(sums: np.ndarray, flat: np.ndarray, image_strip: np.ndarray) -> None:
+    """
+    Add per-label intensity sums of one strip in place.
+    """
+    part = np.bincount(flat, weights=image_strip.ravel().astype(np.float64, copy=False),
+                       minlength=sums.shape[0])
+    sums += part[:sums.shape[0]]
+
+
+def _row_runs(strip: np.ndarray, y0: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (label, row, first x, last x) of every horizontal run of one label in a
+    strip, background excluded. Runs are far fewer than pixels.
+    """
+    strip = np.asarray(strip)
+    h, w = strip.shape
+    start = np.ones((h, w), dtype=bool)
+    start[:, 1:] = strip[:, 1:] != strip[:, :-1]
+    ys, xs = np.nonzero(start)
+    xe = np.empty_like(xs)
+    xe[:-1] = xs[1:] - 1
+    xe[np.r_[ys[1:] != ys[:-1], True]] = w - 1
+    lab = strip[ys, xs]
+    fg = lab != 0
+    return lab[fg].astype(np.int64), ys[fg].astype(np.int64) + y0, xs[fg].astype(np.int64), xe[fg].astype(np.int64)
+
+
+def _empty_bbox(n: int = 1) -> np.ndarray:
+    # rows: min_y, min_x, max_y, max_x
+    return np.vstack([np.full((2, n), np.inf), np.full((2, n), -np.inf)])
+
+
+def _grow_bbox(bbox: np.ndarray, n: int) -> np.ndarray:
+    if bbox.shape[1] >= n:
+        return bbox
+    return np.vstack([_grow(bbox[:2], n, np.inf), _grow(bbox[2:], n, -np.inf)])
+
+
+def _accumulate_bbox(bbox: np.ndarray, runs: Tuple[np.ndarray, ...]) -> None:
+    """
+    Widen per-label bounding boxes in place by the runs of one strip.
+    """
+    lab, rows, x0, x1 = runs
+    if lab.shape[0] == 0:
+        return
+    # runs come in row order, so a stable sort by label keeps rows sorted per label
+    order = np.argsort(lab, kind='stable')
+    lab, rows, x0, x1 = lab[order], rows[order], x0[order], x1[order]
+    first = np.flatnonzero(np.r_[True, lab[1:] != lab[:-1]])
+    last = np.r_[first[1:], lab.shape[0]] - 1
+    ids = lab[first]
+    bbox[0, ids] = np.minimum(bbox[0, ids], rows[first])
+    bbox[1, ids] = np.minimum(bbox[1, ids], np.minimum.reduceat(x0, first))
+    bbox[2, ids] = np.maximum(bbox[2, ids], rows[last])
+    bbox[3, ids] = np.maximum(bbox[3, ids], np.maximum.reduceat(x1, first))
+
+
+# Hull chains are (label, level, x) arrays sorted by label then level, where
+# level 2*row is the pixel row and 2*row -/+ 1 its top/bottom pixel edges.
+# A pixel contributes the midpoints of its four edges, like the
+# `offset_coordinates` of skimage's `convex_hull_image`.
+
+def _lower_envelope(lab: np.ndarray, lev: np.ndarray, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Keep, per label, the points of the convex chain bounding x from below.
+    Points that are not hull vertices are peeled in vectorized rounds.
+    """
+    while lab.shape[0] >= 3:
+        inner = (lab[1:-1] == lab[:-2]) & (lab[1:-1] == lab[2:])
+        cross = (lev[2:] - lev[:-2]) * (x[1:-1] - x[:-2]) - (x[2:] - x[:-2]) * (lev[1:-1] - lev[:-2])
+        drop = np.zeros(lab.shape[0], dtype=bool)
+        drop[1:-1] = inner & (cross >= 0)
+        if not drop.any():
+            break
+        keep = ~drop
+        lab, lev, x = lab[keep], lev[keep], x[keep]
+    return lab, lev, x
+
+
+def _chain(lab: np.ndarray, lev: np.ndarray, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Left hull chain of a point set: min x per (label, level), then the envelope.
+    """
+    if lab.shape[0] == 0:
+        return lab, lev, x
+    order = np.lexsort((lev, lab))
+    lab, lev, x = lab[order], lev[order], x[order]
+    first = np.flatnonzero(np.r_[True, (lab[1:] != lab[:-1]) | (lev[1:] != lev[:-1])])
+    return _lower_envelope(lab[first], lev[first].astype(np.float64), np.minimum.reduceat(x, first))
+
+
+def strip_hulls(strip: np.ndarray, y0: int) -> Tuple[Tuple[np.ndarray, ...], Tuple[np.ndarray, ...]]:
+    """
+    Left and right hull chains of every label in a strip starting at row
+    `y0`. Chains of the strips of one mask merge in `ConvexArea.add`. The
+    right chain is stored mirrored (x negated) so both use the same envelope.
+    """
+    lab, rows, x0, x1 = _row_runs(strip, y0)
+    lab3 = np.concatenate([lab, lab, lab])
+    lev3 = np.concatenate([2 * rows, 2 * rows - 1, 2 * rows + 1])
+    left = _chain(lab3, lev3, np.concatenate([x0 - 0.5, x0, x0]).astype(np.float64))
+    right = _chain(lab3, lev3, -np.concatenate([x1 + 0.5, x1, x1]).astype(np.float64))
+    return left, right
+
+
+def _chain_x(chain: Tuple[np.ndarray, ...], qlab: np.ndarray, qlev: np.ndarray) -> np.ndarray:
+    """
+    x of a chain at each (label, level) query, interpolated between vertices.
+    """
+    lab, lev, x = chain
+    span = int(lev.max()) + 3
+    key = lab * span + lev.astype(np.int64) + 1
+    qkey = qlab * span + qlev + 1
+    i = np.searchsorted(key, qkey, side='right') - 1
+    j = np.minimum(i + 1, key.shape[0] - 1)
+    exact = key[i] == qkey
+    step = np.where(exact, 1.0, lev[j] - lev[i])
+    return np.where(exact, x[i], x[i] + (qlev - lev[i]) / step * (x[j] - x[i]))
+
+
+class ConvexArea:
+    """
+    Convex hull area per label (pixel centres inside or on the hull, as
+    regionprops' area_convex), from strip hull chains added top to bottom.
+
+    A label is rasterized and its chains dropped once the strip holding its
+    last row (`max_y` from the label bounding boxes) is in, so only cells
+    crossing the current strip boundary stay pending.
+    """
+
+    def __init__(self, max_y: np.ndarray):
+        self.max_y = max_y
+        self.area = np.zeros(max_y.shape[0], dtype=np.float64)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+        self._left, self._right = empty, empty
+
+    def add(self, y1: int, hulls) -> None:
+        """
+        Merge the chains of the strip ending at row `y1` (exclusive).
+        """
+        (left, right) = hulls
+        self._left = _chain(*(np.concatenate([a, b]) for a, b in zip(self._left, left)))
+        self._right = _chain(*(np.concatenate([a, b]) for a, b in zip(self._right, right)))
+        done = self.max_y[self._left[0]] < y1
+        if done.any():
+            self._rasterize(tuple(a[done] for a in self._left),
+                            tuple(a[self.max_y[self._right[0]] < y1] for a in self._right))
+            self._left = tuple(a[~done] for a in self._left)
+            self._right = tuple(a[self.max_y[self._right[0]] >= y1] for a in self._right)
+
+    def add_strip(self, y0: int, strip: np.ndarray) -> None:
+        self.add(y0 + strip.shape[0], strip_hulls(strip, y0))
+
+    def _rasterize(self, left, right) -> None:
+        lab, lev, _x = left
+        first = np.flatnonzero(np.r_[True, lab[1:] != lab[:-1]])
+        last = np.r_[first[1:], lab.shape[0]] - 1
+        top = (lev[first].astype(np.int64) + 1) // 2
+        n_rows = (lev[last].astype(np.int64) - 1) // 2 - top + 1
+        qlab = np.repeat(lab[first], n_rows)
+        qrow = np.repeat(top - np.cumsum(np.r_[0, n_rows[:-1]]), n_rows) + np.arange(n_rows.sum())
+        xl = _chain_x(left, qlab, 2 * qrow)
+        xr = -_chain_x(right, qlab, 2 * qrow)
+        inside = np.clip(np.floor(xr + 1e-9) - np.ceil(xl - 1e-9) + 1, 0, None)
+        self.area[lab[first]] = np.add.reduceat(inside, np.r_[0, np.cumsum(n_rows)[:-1]])
+
+
+class LabelIndex:
+    """
+    Labels present in a mask with their pixel counts, coordinate moments and
+    bounding boxes.
+
+    Built once per mask and shared by every channel reduction. All arrays are
+    dense, indexed by label value (bin 0 is background).
+    """
+
+    def __init__(self, counts: np.ndarray, moments: np.ndarray, bbox: Optional[np.ndarray] = None):
+        self.counts = counts
+        self.moments = moments  # rows: sum_y, sum_x, sum_yy, sum_xx, sum_xy
+        self.bbox = bbox        # rows: min_y, min_x, max_y, max_x
+        self.labels = np.flatnonzero(counts[1:]) + 1
+
+    @property
+    def n_bins(self) -> int:
+        return self.counts.shape[0]
+
+    @property
+    def n_cells(self) -> int:
+        return self.labels.shape[0]
+
+    @classmethod
+    def from_strips(cls, strips: Iterable[Tuple[int, np.ndarray]]) -> "LabelIndex":
+        """
+        Build the index from (y0, mask_strip) pairs covering the mask in any
+        order. Labels may appear in several strips.
+        """
+        counts = np.zeros(1, dtype=np.float64)
+        moments = np.zeros((5, 1), dtype=np.float64)
+        bbox = _empty_bbox()
+        for y0, strip in strips:
+            flat = _label_bins(strip)
+            n = int(flat.max(initial=0)) + 1
+            counts, moments, bbox = _grow(counts, n), _grow(moments, n), _grow_bbox(bbox, n)
+            _accumulate_morphology(counts, moments, y0, flat, strip.shape[1])
+            _accumulate_bbox(bbox, _row_runs(strip, y0))
+        return cls(counts, moments, bbox)
+
+    @classmethod
+    def from_mask(cls, mask: np.ndarray, strip_pixels: int = DEFAULT_STRIP_PIXELS) -> "LabelIndex":
+        """
+        Build the index from an in-memory 2D label mask.
+        """
+        rows = strip_rows_for(mask.shape[1], strip_pixels)
+        return cls.from_strips((y0, mask[y0:y1]) for y0, y1 in iter_row_strips(mask.shape[0], rows))
+
+    def save(self, path: str) -> None:
+        """
+        Store counts, moments and boxes in one .npy so pool workers can map them.
+        """
+        np.save(path, np.vstack([self.counts[None, :], self.moments, self.bbox]))
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = 'r') -> "LabelIndex":
+        """
+        Load an index written by `save`, memory-mapped by default.
+        """
+        arr = np.load(path, mmap_mode=mmap_mode)
+        return cls(arr[0], arr[1:6], arr[6:10])
+
+    def channel_sums_from_strips(self, strips: Iterable[Tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
+        """
+        Per-label intensity sums (dense, length `n_bins`) from
+        (mask_strip, image_strip) pairs.
+        """
+        sums = np.zeros(self.n_bins, dtype=np.float64)
+        for mask_strip, image_strip in strips:
+            _accumulate_channel(sums, _label_bins(mask_strip), image_strip)
+        return sums
+
+    def mean_intensity(self,
+                       mask: np.ndarray,
+                       image: np.ndarray,
+                       strip_pixels: int = DEFAULT_STRIP_PIXELS,
+                       labels: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Mean intensity of `image` per cell, ordered like `self.labels`
+        (or aligned to `labels`, see `per_label`).
+        """
+        if mask.shape != image.shape:
+            raise ValueError(f"Mask shape {mask.shape} does not match image shape {image.shape}")
+        rows = strip_rows_for(mask.shape[1], strip_pixels)
+        sums = self.channel_sums_from_strips(
+            (mask[y0:y1], image[y0:y1]) for y0, y1 in iter_row_strips(mask.shape[0], rows))
+        return self.per_label(sums, labels)
+
+    def intensity_stats(self,
+                        mask: np.ndarray,
+                        image: np.ndarray,
+                        stats: Sequence[str] = (),
+                        order: Optional[LabelOrder] = None,
+                        labels: Optional[np.ndarray] = None,
+                        strip_pixels: int = DEFAULT_STRIP_PIXELS) -> Dict[str, np.ndarray]:
+        """
+        'mean' plus the requested `stats` per cell, aligned like `mean_intensity`.
+        Order statistics use `order` (built from `mask` if not given).
+        """
+        if mask.shape != image.shape:
+            raise ValueError(f"Mask shape {mask.shape} does not match image shape {image.shape}")
+        sums = np.zeros(self.n_bins, dtype=np.float64)
+        sumsq = np.zeros(self.n_bins, dtype=np.float64) if 'std' in stats else None
+        rows = strip_rows_for(mask.shape[1], strip_pixels)
+        for y0, y1 in iter_row_strips(mask.shape[0], rows):
+            flat = _label_bins(mask[y0:y1])
+            _accumulate_channel(sums, flat, image[y0:y1])
+            if sumsq is not None:
+                _accumulate_channel(sumsq, flat, np.square(image[y0:y1], dtype=np.float64))
+        out = self.sum_stats(stats, sums, sumsq, labels)
+        if needs_order(stats):
+            order = order if order is not None else LabelOrder.from_mask(mask)
+            for stat, values in order.reduce(image, stats).items():
+                out[stat] = _align(order.labels, values, self.labels if labels is None else labels)
+        return out
+
+    def sum_stats(self,
+                  stats: Sequence[str],
+                  sums: np.ndarray,
+                  sumsq: Optional[np.ndarray] = None,
+                  labels: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """
+        mean, and std / integrated if requested, from dense per-label sums.
+        """
+        lab = self.labels if labels is None else labels
+        n = self.area(lab).astype(np.float64)
+        out = {'mean': self.per_label(sums, labels)}
+        total = np.where(n > 0, self._take(sums, lab), np.nan)
+        if 'integrated' in stats:
+            out['integrated'] = total
+        if 'std' in stats:
+            var = (self._take(sumsq, lab) - total * out['mean']) / np.where(n > 0, n, np.nan)
+            out['std'] = np.sqrt(np.clip(var, 0, None))
+        return out
+
+    def _take(self, dense: np.ndarray, labels: np.ndarray) -> np.ndarray:
+        out = np.zeros(labels.shape[0], dtype=np.float64)
+        inside = labels < dense.shape[0]
+        out[inside] = dense[labels[inside]]
+        return out
+
+    def per_label(self, dense: np.ndarray, labels: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Per-cell mean of dense per-label sums. With `labels` (e.g. the IDs of
+        the nuclear mask) the result is aligned to them, NaN where a label
+        has no pixels in this mask.
+        """
+        if labels is None:
+            return dense[self.labels] / self.counts[self.labels]
+        out = np.full(labels.shape[0], np.nan)
+        inside = labels < self.n_bins
+        n = self.counts[labels[inside]]
+        out[inside] = np.divide(dense[labels[inside]], n, out=np.full(n.shape, np.nan), where=n > 0)
+        return out
+
+    def area(self, labels: np.ndarray) -> np.ndarray:
+        """
+        Pixel count of each of `labels` in this mask, 0 where absent.
+        """
+        out = np.zeros(labels.shape[0], dtype=np.int64)
+        inside = labels < self.n_bins
+        out[inside] = self.counts[labels[inside]]
+        return out
+
+    def _central_moments(self) -> Tuple[np.ndarray, ...]:
+        n = self.counts[self.labels]
+        sy, sx, syy, sxx, sxy = (m[self.labels] for m in self.moments)
+        cy, cx = sy / n, sx / n
+        return n, cy, cx, syy - sy * cy, sxx - sx * cx, sxy - sy * cx
+
+    def convex_area(self, mask: np.ndarray, strip_pixels: int = DEFAULT_STRIP_PIXELS) -> np.ndarray:
+        """
+        Dense per-label convex hull area of an in-memory mask, see `ConvexArea`.
+        """
+        hull = ConvexArea(self.bbox[2])
+        rows = strip_rows_for(mask.shape[1], strip_pixels)
+        for y0, y1 in iter_row_strips(mask.shape[0], rows):
+            hull.add_strip(y0, mask[y0:y1])
+        return hull.area
+
+    def shape_table(self, convex_area: np.ndarray) -> pd.DataFrame:
+        """
+        MajorAxisLength, MinorAxisLength, Solidity and Extent per cell, given
+        the dense convex areas from `ConvexArea` / `convex_area`.
+        """
+        n, _cy, _cx, mu_yy, mu_xx, mu_xy = self._central_moments()
+        l1, l2, _ecc = eccentricity_from_moments(n, mu_yy, mu_xx, mu_xy)
+        min_y, min_x, max_y, max_x = (b[self.labels] for b in self.bbox)
+        return pd.DataFrame({
+            'MajorAxisLength': 4 * np.sqrt(l1),
+            'MinorAxisLength': 4 * np.sqrt(l2),
+            'Solidity': n / convex_area[self.labels],
+            'Extent': n / ((max_y - min_y + 1) * (max_x - min_x + 1)),
+        })
+
+    def morphology_table(self) -> pd.DataFrame:
+        """
+        CellID, centroid, area and eccentricity per cell.
+        """
+        n, cy, cx, mu_yy, mu_xx, mu_xy = self._central_moments()
+        _l1, _l2, ecc = eccentricity_from_moments(n, mu_yy, mu_xx, mu_xy)
+        return pd.DataFrame({
+            'CellID': self.labels,
+            'Y_centroid': cy,
+            'X_centroid': cx,
+            'Area': n.astype(np.int64),
+            'Eccentricity': ecc,
+        })
+
+
+# -----------------------------
+# Streaming (out-of-core) mode
+# -----------------------------
+
+class PlaneReader:
+    """
+    Lazy row-strip reader for one 2D plane of a TIFF, through `aszarr`.
+
+    `key` selects the plane along the leading (channel) axes of the first
+    series, matching `tifffile.imread(path, key=key)` for channel stacks.
+    Only the chunks that intersect a requested strip are decoded. A .zarr
+    directory (OME-Zarr, see slide_stack.py) is read from its full
+    resolution array '0' the same way.
+    """
+
+    def __init__(self, path: str, key: Optional[int] = None):
+        if os.path.isdir(path):
+            self._tif = None
+            self._z = zarr.open(os.path.join(path, '0'), mode='r')
+        else:
+            self._tif = tifffile.TiffFile(path)
+            self._z = zarr.open(self._tif.aszarr(series=0, level=0), mode='r')
+        lead = self._z.shape[:-2]
+        if key is None:
+            self._prefix = tuple(0 for _ in lead)
+        else:
+            self._prefix = tuple(int(i) for i in np.unravel_index(int(key), lead)) if lead else ()
+        self.shape = tuple(self._z.shape[-2:])
+        self.chunk_rows = int(self._z.chunks[-2])
+
+    def read(self, y0: int, y1: int) -> np.ndarray:
+        return np.asarray(self._z[self._prefix + (slice(y0, y1), slice(None))])
+
+    def close(self) -> None:
+        if self._tif is not None:
+            self._tif.close()
+
+    def __enter__(self) -> "PlaneReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def read_plane(path: str, key: Optional[int] = None) -> np.ndarray:
+    """
+    Whole 2D plane `key` of a TIFF or OME-Zarr, see `PlaneReader`.
+    """
+    with PlaneReader(path, key) as reader:
+        return reader.read(0, reader.shape[0])
+
+
+class _StreamAccumulator:
+    """
+    Growable dense accumulators of one compartment in streaming mode.
+    """
+
+    def __init__(self, n_planes: int, stats: Sequence[str] = ()):
+        self.counts = np.zeros(1, dtype=np.float64)
+        self.moments = np.zeros((5, 1), dtype=np.float64)
+        self.bbox = _empty_bbox()
+        self.sums = np.zeros((n_planes, 1), dtype=np.float64)
+        self.sumsq = np.zeros((n_planes, 1), dtype=np.float64) if 'std' in stats else None
+        self.mins = np.full((n_planes, 1), np.inf) if 'min' in stats else None
+        self.maxs = np.full((n_planes, 1), -np.inf) if 'max' in stats else None
+
+    def add_mask(self, y0: int, strip: np.ndarray) -> np.ndarray:
+        flat = _label_bins(strip)
+        n = int(flat.max(initial=0)) + 1
+        self.counts, self.moments, self.sums = _grow(self.counts, n), _grow(self.moments, n), _grow(self.sums, n)
+        self.bbox = _grow_bbox(self.bbox, n)
+        if self.sumsq is not None:
+            self.sumsq = _grow(self.sumsq, n)
+        if self.mins is not None:
+            self.mins = _grow(self.mins, n, np.inf)
+        if self.maxs is not None:
+            self.maxs = _grow(self.maxs, n, -np.inf)
+        _accumulate_morphology(self.counts, self.moments, y0, flat, strip.shape[1])
+        _accumulate_bbox(self.bbox, _row_runs(strip, y0))
+        return flat
+
+    def add_plane(self, c: int, flat: np.ndarray, image_strip: np.ndarray) -> None:
+        _accumulate_channel(self.sums[c], flat, image_strip)
+        if self.sumsq is not None:
+            _accumulate_channel(self.sumsq[c], flat, np.square(image_strip, dtype=np.float64))
+        if self.mins is not None:
+            np.minimum.at(self.mins[c], flat, image_strip.ravel())
+        if self.maxs is not None:
+            np.maximum.at(self.maxs[c], flat, image_strip.ravel())
+
+    def stats(self, index: LabelIndex, c: int, stats: Sequence[str], labels: np.ndarray) -> Dict[str, np.ndarray]:
+        out = index.sum_stats(stats, self.sums[c], None if self.sumsq is None else self.sumsq[c], labels)
+        for name, dense in (('min', self.mins), ('max', self.maxs)):
+            if dense is not None:
+                values = index._take(dense[c], labels)
+                out[name] = np.where(index.area(labels) > 0, values, np.nan)
+        return out
+
+
+def quantify_stream(mask_path: str,
+                    planes: Dict[str, Tuple[str, Optional[int]]],
+                    strip_pixels: int = DEFAULT_STRIP_PIXELS,
+                    derived: Iterable[str] = (),
+                    extra_masks: Optional[Dict[str, str]] = None,
+                    expand: float = DEFAULT_EXPAND,
+                    ring_width: float = DEFAULT_RING_WIDTH,
+                    stats: Sequence[str] = (),
+                    shape: bool = False) -> pd.DataFrame:
+    """
+    Per-cell morphology and mean intensities without loading full planes.
+
+    `planes` maps output column name -> (tiff_path, key). The mask and each
+    plane are read one row strip at a time; strips are aligned to the mask
+    chunk height so no TIFF tile is decoded twice for the mask.
+
+    `derived` compartments are computed from the nuclear strip plus a halo,
+    `extra_masks` (name -> path) are read strip by strip like the nuclei.
+    Each plane strip is read once and reduced against every compartment.
+
+    `stats` may include std, integrated, min and max, which merge across
+    strips; median and percentiles need whole cells and are not available here.
+
+    With `shape`, the nuclear mask is read a second time to build the convex
+    hulls (their rasterization needs the bounding boxes of the first pass)
+    and `SHAPE_COLUMNS` are appended.
+    """
+    stats = parse_stats(stats)
+    if any(s not in SUM_STATS + ('min', 'max') for s in stats):
+        raise ValueError("median/percentiles need the whole cell in memory; run without streaming")
+    derived = list(derived)
+    extra_masks = extra_masks or {}
+    names = [PRIMARY_COMPARTMENT] + list(extra_masks) + derived
+    readers, extra_readers = {}, {}
+    mask_reader = PlaneReader(mask_path)
+    try:
+        for name, path in extra_masks.items():
+            extra_readers[name] = PlaneReader(path)
+        for name, (path, key) in planes.items():
+            readers[name] = PlaneReader(path, key)
+        for name, reader in list(readers.items()) + list(extra_readers.items()):
+            if reader.shape != mask_reader.shape:
+                raise ValueError(f"{name}: plane shape {reader.shape} "
+                                 f"does not match mask shape {mask_reader.shape}")
+
+        height, width = mask_reader.shape
+        rows = strip_rows_for(width, strip_pixels)
+        rows = max(1, rows // mask_reader.chunk_rows) * mask_reader.chunk_rows
+
+        acc = {name: _StreamAccumulator(len(planes), stats) for name in names}
+        for y0, y1, nuc, blocks in iter_derived_strips(mask_reader.read, height, rows, derived, expand, ring_width):
+            blocks[PRIMARY_COMPARTMENT] = nuc
+            for name, reader in extra_readers.items():
+                blocks[name] = reader.read(y0, y1)
+            flats = {name: acc[name].add_mask(y0, blocks[name]) for name in names}
+            for c, reader in enumerate(readers.values()):
+                strip = reader.read(y0, y1)
+                for name in names:
+                    acc[name].add_plane(c, flats[name], strip)
+        if shape:
+            hull = ConvexArea(acc[PRIMARY_COMPARTMENT].bbox[2])
+            for y0, y1 in iter_row_strips(height, rows):
+                hull.add_strip(y0, mask_reader.read(y0, y1))
+    finally:
+        mask_reader.close()
+        for reader in list(readers.values()) + list(extra_readers.values()):
+            reader.close()
+
+    indices = {name: LabelIndex(acc[name].counts, acc[name].moments, acc[name].bbox) for name in names}
+    labels = indices[PRIMARY_COMPARTMENT].labels
+    columns = {}
+    for name in names[1:]:
+        columns[f"Area_{name}"] = indices[name].area(labels)
+    for c, marker in enumerate(planes):
+        for name in names:
+            column = marker_column(marker, name, len(names) > 1)
+            values = acc[name].stats(indices[name], c, stats, labels)
+            columns[column] = values.pop('mean')
+            for stat in stats:
+                columns[stat_column(column, stat)] = values[stat]
+    tables = [indices[PRIMARY_COMPARTMENT].morphology_table(), pd.DataFrame(columns)]
+    if shape:
+        tables.append(indices[PRIMARY_COMPARTMENT].shape_table(hull.area))
+    return pd.concat(tables, axis=1)
@@ -0,0 +1,211 @@
+"""
+=====================================================
+ Streaming stitching of overlapping tile labels
+=====================================================
+Segmenting a slide in overlapping tiles gives one label image per tile, with
+IDs local to the tile; a nucleus under a tile seam is seen, whole or in part,
+by two to four tiles. `LabelStitcher` merges them into one mask without
+holding the tiles or the slide in memory:
+
+    ownership  every pixel belongs to one tile: overlaps are split at their
+               midpoint (`core_bounds`), and a tile pastes only its core
+    matching   where a new tile overlaps the cores of tiles already placed
+               (the tile row above, the tile to the left), each of its labels
+               is compared with the labels there; an IoU above
+               `iou_threshold` (measured inside that region) unites them in a
+               union-find over provisional IDs, so a nucleus cut by a seam
+               keeps one ID on both sides
+    streaming  rows above the next tile row are never touched again; they get
+               final IDs (sequential from 1, unique over the slide) and go to a
+               `pyramid_tiff.TileRowWriter` in whole file-tile rows
+
+With an IoU threshold of at least 0.5 a label matches at most one label of
+the placed region, so no set with a final ID is ever merged into another.
+Memory is one band of provisional IDs (a tile row plus a file tile high, the
+slide wide) and the union-find arrays (8 bytes per provisional ID).
+
+Tiles come in row-major order, as `(rows, cols)` bounds in the layout of
+deeptile's tile_indices (`tile_grid` builds them); background tiles that were
+never segmented are added as None.
+"""
+
+from typing import Optional
+
+import numpy as np
+
+
+def tile_grid(length: int, size: int, overlap: int) -> np.ndarray:
+    """
+    [start, stop) bounds, shape (n, 2), of tiles of `size` pixels covering
+    `length` pixels, consecutive tiles overlapping by at least `overlap`.
+    """
+    if overlap >= size:
+        raise ValueError(f"Overlap {overlap} must be smaller than the tile size {size}")
+    n = max(1, -(-(length - overlap) // (size - overlap)))
+    starts = np.round(np.linspace(0, max(0, length - size), n)).astype(int)
+    return np.stack([starts, np.minimum(starts + size, length)], axis=1)
+
+
+def core_bounds(bounds: np.ndarray) -> np.ndarray:
+    """
+    The pixels each tile owns: overlaps of consecutive tiles split at their
+    midpoint, so the cores tile the axis without gaps.
+    """
+    bounds = np.asarray(bounds, dtype=int)
+    if np.any(bounds[1:, 0] > bounds[:-1, 1]):
+        raise ValueError("Tiles must overlap or touch, found a gap between them")
+    cuts = (bounds[:-1, 1] + bounds[1:, 0]) // 2
+    return np.stack([np.r_[bounds[0, 0], cuts], np.r_[cuts, bounds[-1, 1]]], axis=1)
+
+
+class LabelStitcher:
+    """
+    Stitches overlapping tile label images, added in row-major order, into the
+    (Y, X) mask of a `pyramid_tiff.TileRowWriter`; see the module docstring.
+    """
+
+    def __init__(self, writer, rows: np.ndarray, cols: np.ndarray, iou_threshold: float = 0.5):
+        self.writer = writer
+        self.rows, self.cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+        self.core_rows, self.core_cols = core_bounds(self.rows), core_bounds(self.cols)
+        h, w = writer.shape
+        if self.rows[0, 0] != 0 or self.rows[-1, 1] != h or self.cols[0, 0] != 0 or self.cols[-1, 1] != w:
+            raise ValueError(f"Tiles must cover the mask of shape {writer.shape}")
+        self.iou_threshold = iou_threshold
+        self.band = np.zeros((int((self.rows[:, 1] - self.rows[:, 0]).max()) + writer.tile, w), np.uint32)
+        self.band_y0 = 0
+        self.parent = np.zeros(1 << 16, np.int64)  # union-find over provisional IDs, 0 is background
+        self.final = np.zeros(1 << 16, np.int64)   # final ID of each flushed root, 0 if not flushed yet
+        self.ids = 1
+        self.cells = 0
+        self.merged = 0
+        self.n = 0
+
+    @property
+    def tiles(self) -> int:
+        return len(self.rows) * len(self.cols)
+
+    def add(self, labels: Optional[np.ndarray]) -> None:
+        """
+        The label image of the next tile (0 background, any other IDs), or
+        None for a tile without cells.
+        """
+        if self.n == self.tiles:
+            raise ValueError(f"All {self.tiles} tiles were added already")
+        i, j = divmod(self.n, len(self.cols))
+        (y0, y1), (x0, x1) = self.rows[i], self.cols[j]
+        (cy0, cy1), (cx0, cx1) = self.core_rows[i], self.core_cols[j]
+        if j == 0:
+            self._flush(y0)
+        self.n += 1
+        if labels is None:
+            return
+        labels = np.asarray(labels)
+        if labels.shape != (y1 - y0, x1 - x0):
+            raise ValueError(f"Tile {i, j} must have shape {(y1 - y0, x1 - x0)}, got {labels.shape}")
+        ids = np.unique(labels)
+        ids = ids[ids > 0]
+        if not len(ids):
+            return
+
+        first = self._provisional(len(ids))
+        tile = np.zeros(labels.shape, np.int64)
+        cells = labels > 0
+        tile[cells] = np.searchsorted(ids, labels[cells]) + first
+
+        # Region of this tile owned by tiles already placed: the tile row above, and the tile to the left
+        by0 = y0 - self.band_y0
+        placed = self.band[by0:by0 + y1 - y0, x0:x1]
+        region = np.zeros(labels.shape, bool)
+        region[:cy0 - y0] = True
+        region[cy0 - y0:cy1 - y0, :cx0 - x0] = True
+        self._match(tile[region], placed[region])
+
+        placed[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = tile[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0]
+
+    def _match(self, new: np.ndarray, old: np.ndarray) -> None:
+        """
+        Unite new and placed labels whose IoU inside the region exceeds the
+        threshold.
+        """
+        both = (new > 0) & (old > 0)
+        if not both.any():
+            return
+        # placed pieces of one nucleus (e.g. from three tiles around a corner) count as one label
+        old = old.astype(np.int64)
+        ids = np.unique(old[old > 0])
+        old[old > 0] = self._find(ids)[np.searchsorted(ids, old[old > 0])]
+        pairs, overlap = np.unique(np.stack([new[both], old[both]]), axis=1, return_counts=True)
+        new_ids, new_area = np.unique(new[new > 0], return_counts=True)
+        old_ids, old_area = np.unique(old[old > 0], return_counts=True)
+        a = new_area[np.searchsorted(new_ids, pairs[0])]
+        b = old_area[np.searchsorted(old_ids, pairs[1])]
+        iou = overlap / (a + b - overlap)
+        for n, o in pairs[:, iou > self.iou_threshold].T:
+            self._union(n, o)
+
+    def _provisional(self, n: int) -> int:
+        """
+        Reserve `n` new provisional IDs, each its own set; returns the first.
+        """
+        first, self.ids = self.ids, self.ids + n
+        if self.ids > len(self.parent):
+            size = max(self.ids, 2 * len(self.parent))
+            self.parent = np.r_[self.parent, np.zeros(size - len(self.parent), np.int64)]
+            self.final = np.r_[self.final, np.zeros(size - len(self.final), np.int64)]
+        self.parent[first:self.ids] = np.arange(first, self.ids)
+        return first
+
+    def _find(self, ids: np.ndarray) -> np.ndarray:
+        roots = self.parent[ids]
+        while True:
+            up = self.parent[roots]
+            if np.array_equal(up, roots):
+                break
+            roots = up
+        self.parent[ids] = roots
+        return roots
+
+    def _union(self, new: int, old: int) -> None:
+        rn, ro = self._find(np.array([new, old]))
+        if rn == ro or (self.final[rn] and self.final[ro]):
+            return
+        # a set that already has a final ID stays the root, so flushed rows keep their IDs
+        if self.final[rn]:
+            self.parent[ro] = rn
+        else:
+            self.parent[rn] = ro
+        self.merged += 1
+
+    def _flush(self, y: int, last: bool = False) -> None:
+        """
+        Write the final rows above `y` in whole file-tile rows (all of them if
+        `last`).
+        """
+        n = y - self.band_y0 if last else (y - self.band_y0) // self.writer.tile * self.writer.tile
+        if n <= 0:
+            return
+        rows = self.band[:n]
+        out = np.zeros(rows.shape, self.writer.dtype)
+        cells = rows > 0
+        if cells.any():
+            ids = np.unique(rows[cells]).astype(np.int64)
+            roots = self._find(ids)
+            fresh = np.unique(roots[self.final[roots] == 0])
+            self.final[fresh] = np.arange(self.cells + 1, self.cells + 1 + len(fresh))
+            self.cells += len(fresh)
+            out[cells] = self.final[roots][np.searchsorted(ids, rows[cells])]
+        self.writer.write(out)
+        self.band[:-n] = self.band[n:]
+        self.band[-n:] = 0
+        self.band_y0 += n
+
+    def close(self) -> int:
+        """
+        Write the remaining rows once every tile was added; returns the number
+        of cells.
+        """
+        if self.n != self.tiles:
+            raise ValueError(f"Got {self.n} of {self.tiles} tiles")
+        self._flush(self.writer.shape[0], last=True)
+        return self.cells
@@ -0,0 +1,159 @@
+"""
+=====================================================
+ Intensity normalization from sampled statistics
+=====================================================
+The segmentation scripts scale the nuclear plane to [0, 1] before inference:
+StarDist between its 3rd and 99.8th percentiles (csbdeep `normalize`),
+Mesmer between its minimum and maximum. Computing these over the full
+plane with numpy needs float copies and, for percentiles, a sort of every
+pixel. Here the statistics come from one of
+
+    exact    a histogram (8/16-bit) or running min/max over row strips of
+             the plane: the same numbers, bounded memory, every pixel read
+    sample   `sample_size` pixels drawn uniformly at random, strip by strip
+    level    every pixel of a low-resolution pyramid level of the TIFF
+
+and `IntensityScale` applies the result to one tile or block at a time.
+
+Error bound of `sample`: by the Dvoretzky-Kiefer-Wolfowitz inequality, n
+uniform samples estimate every quantile to within a rank error of
+
+    eps = sqrt(ln(2 / delta) / (2 n))
+
+with probability 1 - delta, i.e. the estimated 99.8th percentile lies
+between the true (99.8 - 100 eps)th and (99.8 + 100 eps)th percentiles
+(`rank_error`; 10^6 samples: +-0.27 points at delta = 1e-6, 10^7: +-0.09).
+An estimated minimum/maximum is a quantile with the same bound: at most a
+fraction eps of the pixels lie outside it, and `IntensityScale(clip=True)`
+maps those to 0 or 1. `level` carries the bound only for levels that
+subsample the plane (nearest downsampling, e.g. bioformats2raw SIMPLE or
+pyramid_tiff downsample="nearest"); averaged levels pull the tails in, so
+their percentiles are narrower than the plane's.
+"""
+
+import math
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+METHODS = ("exact", "sample", "level")
+DEFAULT_SAMPLE_SIZE = 1_000_000
+DEFAULT_LEVEL_PIXELS = 4_000_000
+STRIP_ROWS = 1024
+
+
+def rank_error(n: int, delta: float = 1e-6) -> float:
+    """
+    DKW bound on the quantile rank error of `n` uniform samples, holding
+    with probability 1 - `delta`.
+    """
+    return math.sqrt(math.log(2 / delta) / (2 * n))
+
+
+def histogram_percentiles(plane, percentiles: Sequence[float], rows: int = STRIP_ROWS) -> list:
+    """
+    np.percentile(plane, percentiles) of an 8/16-bit unsigned plane from a
+    histogram accumulated over row strips.
+    """
+    counts = np.zeros(1 << (8 * plane.dtype.itemsize), np.int64)
+    for y in range(0, plane.shape[0], rows):
+        counts += np.bincount(np.asarray(plane[y:y + rows]).ravel(), minlength=len(counts))
+    cumulative = np.cumsum(counts)
+    n = int(cumulative[-1])
+    values = []
+    for p in percentiles:
+        rank = p / 100.0 * (n - 1)
+        lo = int(np.floor(rank))
+        v_lo, v_hi = np.searchsorted(cumulative, [lo, min(lo + 1, n - 1)], side="right")
+        values.append(float(v_lo + (rank - lo) * (v_hi - v_lo)))
+    return values
+
+
+def strip_range(plane, rows: int = STRIP_ROWS) -> Tuple[float, float]:
+    """
+    Minimum and maximum of a plane read in row strips.
+    """
+    lo, hi = np.inf, -np.inf
+    for y in range(0, plane.shape[0], rows):
+        strip = np.asarray(plane[y:y + rows])
+        lo, hi = min(lo, strip.min()), max(hi, strip.max())
+    return float(lo), float(hi)
+
+
+def sample_pixels(plane, n: int = DEFAULT_SAMPLE_SIZE, seed: int = 0, rows: int = STRIP_ROWS) -> np.ndarray:
+    """
+    About `n` pixels drawn uniformly at random (with replacement) from a
+    plane read in row strips, each strip contributing its share of pixels.
+    """
+    h, w = plane.shape
+    starts = range(0, h, rows)
+    if n >= h * w:
+        return np.concatenate([np.asarray(plane[y:y + rows]).ravel() for y in starts])
+    rng = np.random.default_rng(seed)
+    sizes = np.array([min(rows, h - y) * w for y in starts])
+    samples = []
+    for y, k in zip(starts, rng.multinomial(n, sizes / sizes.sum())):
+        strip = np.asarray(plane[y:y + rows]).ravel()
+        samples.append(strip[rng.integers(0, strip.size, k)])
+    return np.concatenate(samples)
+
+
+def lowres_plane(tif, channel: int = 0, max_pixels: int = DEFAULT_LEVEL_PIXELS) -> Optional[np.ndarray]:
+    """
+    Channel `channel` of the largest pyramid level of a `tifffile.TiffFile`
+    with at most `max_pixels` pixels, or None if the file has no such level.
+    """
+    series = tif.series[0]
+    for level, data in enumerate(series.levels):
+        if level and data.shape[-2] * data.shape[-1] <= max_pixels:
+            plane = tif.asarray(key=channel if len(data.shape) > 2 else 0, series=0, level=level)
+            return plane.reshape(plane.shape[-2:])
+    return None
+
+
+def estimate(plane,
+             percentiles: Sequence[float],
+             method: str = "exact",
+             sample_size: int = DEFAULT_SAMPLE_SIZE,
+             lowres: Optional[np.ndarray] = None,
+             seed: int = 0) -> Tuple[list, float]:
+    """
+    The `percentiles` of `plane` (0 and 100 for its min/max) by `method`,
+    and their rank error (0 for exact, see `rank_error`). `plane` may be a
+    lazy array (aszarr, memmap); "level" needs `lowres` from `lowres_plane`.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown normalization method {method!r}, choose from {METHODS}")
+    if method == "level":
+        if lowres is None:
+            raise ValueError("The image has no pyramid level to estimate the normalization from")
+        return [float(v) for v in np.percentile(lowres, percentiles)], rank_error(lowres.size)
+    if method == "sample":
+        values = sample_pixels(plane, sample_size, seed)
+        return [float(v) for v in np.percentile(values, percentiles)], rank_error(values.size)
+    if all(p in (0, 100) for p in percentiles):
+        lo, hi = strip_range(plane)
+        return [lo if p == 0 else hi for p in percentiles], 0.0
+    if plane.dtype.kind == "u" and plane.dtype.itemsize <= 2:
+        return histogram_percentiles(plane, percentiles), 0.0
+    return [float(v) for v in np.percentile(np.asarray(plane), percentiles)], 0.0
+
+
+class IntensityScale:
+    """
+    (x - lo) / (hi - lo + eps) in `dtype`, optionally clipped to [0, 1], the
+    arithmetic of csbdeep `normalize_mi_ma`, applied to one tile at a time.
+    """
+
+    def __init__(self, lo: float, hi: float, clip: bool = False, eps: float = 1e-20, dtype=np.float32):
+        self.dtype = np.dtype(dtype).type
+        self.lo, self.hi, self.eps = self.dtype(lo), self.dtype(hi), self.dtype(eps)
+        self.clip = clip
+
+    def __call__(self, tile) -> np.ndarray:
+        x = np.asarray(tile).astype(self.dtype, copy=False)
+        x = (x - self.lo) / (self.hi - self.lo + self.eps)
+        return np.clip(x, 0, 1, out=x) if self.clip else x
+
+    def __repr__(self) -> str:
+        return f"IntensityScale({float(self.lo):g}, {float(self.hi):g})"
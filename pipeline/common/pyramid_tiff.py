@@ -0,0 +1,329 @@
+"""
+=====================================================
+ Tiled, compressed, pyramidal OME-TIFF writer
+=====================================================
+`write_pyramid(path, data, shape, dtype, ...)` writes a (Y, X) or (C, Y, X)
+image as a tiled OME-TIFF:
+
+    compression  zlib (default), zstd, lzw or none, with the horizontal
+                 predictor for integer data (zstd/lzw need imagecodecs)
+    levels       full resolution plus levels-1 sub-resolutions, each half
+                 the size of the previous one, stored in SubIFDs the way
+                 bioformats2raw/raw2ometiff and QuPath write them
+    metadata     OME-XML with channel names and, optionally, colors and
+                 pixel size
+
+`data` is either an array or an iterable of tiles: every plane in order,
+each plane's tiles in row-major order, `tile` x `tile` except at the right
+and bottom edges (the order `tifffile.imwrite` consumes). Tiles go straight
+to the file, and the first sub-resolution level is reduced from them as
+they pass. A TIFF stores a level only after the one above it, so each
+level is held until then: in memory up to SPOOL_BYTES (64 MiB), otherwise
+in an uncompressed temporary file next to the output (a quarter of the
+full-resolution pixels for the first level). It is then written tile by
+tile while the next level is reduced from it. Sub-resolutions are 2x2 means; for label
+images, which must never be averaged, the top-left pixel of each 2x2 block
+(downsample="nearest") or its most frequent value ("mode", ties to the
+first of top-left, bottom-left, top-right, bottom-right). Tiles have even
+sizes, so tile-wise and whole-plane reduction give the same level.
+
+`TileRowWriter` is the same writer fed with full-width bands of rows from
+another thread, for producers that finish an image top to bottom (block-wise
+segmentation, tile stitching) and should not hold the whole plane.
+
+The result opens lazily through aszarr, as in Napari_fast_masking.ipynb:
+
+    tif = tifffile.TiffFile(path)
+    z = zarr.open(tif.aszarr(), mode='r')   # group '0', '1', ... if levels > 1
+"""
+
+import os
+import queue
+import tempfile
+import threading
+from typing import Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import tifffile
+
+COMPRESSIONS = ("zlib", "zstd", "lzw", "none")
+DEFAULT_COMPRESSION = "zlib"
+DEFAULT_TILE = 512
+DOWNSAMPLE = ("mean", "nearest", "mode")
+SPOOL_BYTES = 64 << 20  # larger sub-resolution levels go to a temporary file
+
+
+def level_count(shape: Sequence[int], tile: int = DEFAULT_TILE) -> int:
+    """
+    Levels needed until the whole plane fits in one tile.
+    """
+    h, w = shape[-2:]
+    n = 1
+    while max(h, w) > tile:
+        h, w = (h + 1) // 2, (w + 1) // 2
+        n += 1
+    return n
+
+
+def downsample2(block: np.ndarray, method: str = "mean") -> np.ndarray:
+    """
+    Halve a 2D block. Odd edges repeat their last row/column, so the result
+    has ceil(h/2) x ceil(w/2) pixels.
+    """
+    if method == "nearest":
+        return block[::2, ::2]
+    if method not in DOWNSAMPLE:
+        raise ValueError(f"Unknown downsample method {method!r}, choose from {DOWNSAMPLE}")
+    h, w = block.shape
+    if h % 2 or w % 2:
+        block = np.pad(block, ((0, h % 2), (0, w % 2)), mode="edge")
+    if method == "mode":
+        return mode2(block)
+    acc = np.float64 if block.dtype.kind == "f" else np.uint64
+    total = (block[0::2, 0::2].astype(acc) + block[1::2, 0::2] + block[0::2, 1::2] + block[1::2, 1::2])
+    if block.dtype.kind == "f":
+        return (total / 4).astype(block.dtype)
+    return ((total + 2) // 4).astype(block.dtype)
+
+
+def mode2(block: np.ndarray) -> np.ndarray:
+    """
+    Most frequent value of every 2x2 block of an even-sized 2D block, ties
+    to the earliest of top-left, bottom-left, top-right, bottom-right.
+    """
+    quad = [block[0::2, 0::2], block[1::2, 0::2], block[0::2, 1::2], block[1::2, 1::2]]
+    counts = [sum((q == r).astype(np.uint8) for r in quad) for q in quad]
+    best, count = quad[0].copy(), counts[0]
+    for q, c in zip(quad[1:], counts[1:]):
+        better = c > count
+        best[better], count = q[better], np.maximum(count, c)
+    return best
+
+
+def iter_array_tiles(array: np.ndarray, tile: int) -> Iterator[np.ndarray]:
+    """
+    Tiles of a (..., Y, X) array in the order `write_pyramid` expects.
+    """
+    planes = array.reshape((-1,) + array.shape[-2:])
+    h, w = planes.shape[-2:]
+    for plane in planes:
+        for y0 in range(0, h, tile):
+            for x0 in range(0, w, tile):
+                yield plane[y0:y0 + tile, x0:x0 + tile]
+
+
+class SubLevel:
+    """
+    The sub-resolution level below a (..., Y, X) level, filled tile by tile
+    as the level above streams through `tap` (tiles in `write_pyramid`
+    order), then streamed in turn by `tiles`. A level larger than
+    SPOOL_BYTES is kept in an uncompressed temporary file in `spool_dir`
+    instead of memory. `close` frees it.
+    """
+
+    def __init__(self, shape: Tuple[int, ...], dtype, tile: int, method: str, spool_dir: Optional[str] = None):
+        self.shape = tuple(shape[:-2]) + ((shape[-2] + 1) // 2, (shape[-1] + 1) // 2)
+        planes = (-1,) + self.shape[-2:]
+        dtype = np.dtype(dtype)
+        self._spool = None
+        if int(np.prod(self.shape)) * dtype.itemsize > SPOOL_BYTES:
+            self._spool = tempfile.TemporaryFile(dir=spool_dir, prefix=".pyramid_")
+            self.planes = np.memmap(self._spool, dtype, "w+", shape=self.shape).reshape(planes)
+        else:
+            self.planes = np.zeros(self.shape, dtype).reshape(planes)
+        self.grid = (-(-shape[-2] // tile), -(-shape[-1] // tile))
+        self.tile = tile
+        self.method = method
+        self.n = 0
+
+    @property
+    def expected(self) -> int:
+        """
+        Tiles of the level above.
+        """
+        return self.planes.shape[0] * self.grid[0] * self.grid[1]
+
+    def tap(self, tiles: Iterable[np.ndarray]) -> Iterator[np.ndarray]:
+        per_plane = self.grid[0] * self.grid[1]
+        half = self.tile // 2
+        for t in tiles:
+            c, i = divmod(self.n, per_plane)
+            ty, tx = divmod(i, self.grid[1])
+            small = downsample2(np.asarray(t), self.method)
+            self.planes[c, ty * half:ty * half + small.shape[0], tx * half:tx * half + small.shape[1]] = small
+            self.n += 1
+            yield t
+
+    def tiles(self) -> Iterator[np.ndarray]:
+        if self.n != self.expected:
+            raise ValueError(f"Expected {self.expected} tiles, got {self.n}")
+        return iter_array_tiles(self.planes, self.tile)
+
+    def close(self) -> None:
+        self.planes = None
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+
+def ome_metadata(shape: Sequence[int],
+                 channel_names: Optional[Sequence[str]] = None,
+                 physical_size: Optional[float] = None,
+                 channel_colors: Optional[Sequence[int]] = None) -> dict:
+    """
+    tifffile OME metadata for a (Y, X) or (C, Y, X) image. Colors are OME
+    signed 32-bit RGBA integers (e.g. -16711681 for cyan).
+    """
+    meta = {"axes": "CYX" if len(shape) == 3 else "YX"}
+    if channel_names is not None:
+        meta["Channel"] = {"Name": list(channel_names)}
+    if channel_colors is not None:
+        meta.setdefault("Channel", {})["Color"] = [int(c) for c in channel_colors]
+    if physical_size:
+        meta.update(PhysicalSizeX=physical_size, PhysicalSizeXUnit="µm",
+                    PhysicalSizeY=physical_size, PhysicalSizeYUnit="µm")
+    return meta
+
+
+def write_pyramid(path: str,
+                  data: Union[np.ndarray, Iterable[np.ndarray]],
+                  shape: Optional[Sequence[int]] = None,
+                  dtype=None,
+                  channel_names: Optional[Sequence[str]] = None,
+                  tile: int = DEFAULT_TILE,
+                  levels: Optional[int] = 1,
+                  compression: str = DEFAULT_COMPRESSION,
+                  downsample: str = "mean",
+                  physical_size: Optional[float] = None,
+                  channel_colors: Optional[Sequence[int]] = None) -> None:
+    """
+    Write `data` (array, or tiles with `shape` and `dtype`) as a tiled OME-TIFF
+    with `levels` resolutions (None: down to a single tile, see `level_count`).
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression!r}, choose from {COMPRESSIONS}")
+    if tile % 16:
+        raise ValueError(f"Tile size must be a multiple of 16, got {tile}")
+    if isinstance(data, np.ndarray):
+        shape, dtype = data.shape, data.dtype
+        data = iter_array_tiles(data, tile)
+    shape, dtype = tuple(int(s) for s in shape), np.dtype(dtype)
+    if len(shape) not in (2, 3):
+        raise ValueError(f"Expected a (Y, X) or (C, Y, X) image, got shape {shape}")
+    levels = level_count(shape, tile) if levels is None else max(1, int(levels))
+
+    options = {"tile": (tile, tile), "dtype": dtype, "photometric": "minisblack"}
+    if compression != "none":
+        options["compression"] = compression
+        options["predictor"] = dtype.kind in "iu"
+    spool_dir = os.path.dirname(os.path.abspath(path))
+    level = SubLevel(shape, dtype, tile, downsample, spool_dir) if levels > 1 else None
+
+    with tifffile.TiffWriter(path, bigtiff=True, ome=True) as tif:
+        try:
+            tif.write(level.tap(data) if level else data, shape=shape, subifds=levels - 1,
+                      metadata=ome_metadata(shape, channel_names, physical_size, channel_colors), **options)
+            for i in range(1, levels):
+                # each level is reduced from the one above while that one is written
+                below = SubLevel(level.shape, dtype, tile, downsample, spool_dir) if i < levels - 1 else None
+                tiles = level.tiles()
+                tif.write(below.tap(tiles) if below else tiles, shape=level.shape, subfiletype=1, **options)
+                level.close()
+                level = below
+        finally:
+            if level is not None:
+                level.close()
+
+
+class TileRowWriter:
+    """
+    Writes a (Y, X) image as `write_pyramid` does, from full-width bands of
+    rows handed to `write` from top to bottom. Every band except the last
+    must be a multiple of `tile` rows high. A background thread encodes the
+    tiles, so only about two bands (and sub-levels up to SPOOL_BYTES) are in
+    memory. Use as a context manager;
+    an exception in the block stops the writer and re-raises.
+    """
+
+    _END = object()
+
+    def __init__(self, path: str, shape: Sequence[int], dtype, tile: int = DEFAULT_TILE,
+                 levels: Optional[int] = 1, compression: str = DEFAULT_COMPRESSION,
+                 downsample: str = "mean", channel_names: Optional[Sequence[str]] = None,
+                 physical_size: Optional[float] = None, channel_colors: Optional[Sequence[int]] = None):
+        self.path = path
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.tile = tile
+        self.options = dict(levels=levels, compression=compression, downsample=downsample,
+                            channel_names=channel_names, physical_size=physical_size,
+                            channel_colors=channel_colors)
+        self.rows = 0
+        self._bands: "queue.Queue" = queue.Queue(maxsize=1)
+        self._error: Optional[BaseException] = None
+        self._thread = None
+
+    def __enter__(self) -> "TileRowWriter":
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None and self.rows != self.shape[0]:
+            exc = ValueError(f"{self.path}: got {self.rows} of {self.shape[0]} rows")
+            self._abort(exc)
+            raise exc
+        if exc_type is not None:
+            self._abort(exc)
+            return
+        self._put(self._END)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError(f"Writing {self.path} failed: {self._error}") from self._error
+
+    def _abort(self, exc: BaseException) -> None:
+        try:
+            self._put(exc)
+        except RuntimeError:
+            pass
+        self._thread.join()
+
+    def write(self, band: np.ndarray) -> None:
+        """
+        Append the next `band` of rows (shape (rows, X)). The band is encoded
+        later, so it must not be modified afterwards.
+        """
+        if band.shape[1:] != self.shape[1:] or self.rows + band.shape[0] > self.shape[0]:
+            raise ValueError(f"Band of shape {band.shape} does not fit rows {self.rows}.. of {self.shape}")
+        if self.rows % self.tile:
+            raise ValueError(f"Only the last band may be a partial tile row, got one at row {self.rows}")
+        self.rows += band.shape[0]
+        self._put(band)
+
+    def _put(self, item) -> None:
+        while self._thread.is_alive():
+            try:
+                self._bands.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        if self._error is not None:
+            raise RuntimeError(f"Writing {self.path} failed: {self._error}") from self._error
+
+    def _tiles(self) -> Iterator[np.ndarray]:
+        tile = self.tile
+        while True:
+            band = self._bands.get()
+            if band is self._END:
+                break
+            if isinstance(band, BaseException):
+                raise RuntimeError(f"{self.path} aborted") from band
+            for y0 in range(0, band.shape[0], tile):
+                for x0 in range(0, self.shape[1], tile):
+                    yield band[y0:y0 + tile, x0:x0 + tile]
+
+    def _run(self) -> None:
+        try:
+            write_pyramid(self.path, self._tiles(), self.shape, self.dtype, tile=self.tile, **self.options)
+        except BaseException as e:
+            self._error = e
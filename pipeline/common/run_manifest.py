@@ -0,0 +1,158 @@
+"""
+=====================================================
+ Resumable batch runs: manifest + atomic outputs
+=====================================================
+Every stage keeps a JSON manifest next to its outputs. One entry per unit of
+work (a slide, or a slide/marker pair) records:
+
+    inputs:  path -> size, mtime_ns (and sha256 with hash_inputs)
+    params:  everything that changes the output (channels, tophat size, stats...)
+    outputs: path -> size, mtime_ns
+
+A unit is skipped when its inputs, parameters and outputs are unchanged, so a
+crashed batch restarts where it stopped. An input whose mtime changed but
+whose recorded sha256 still matches counts as unchanged.
+
+Outputs are written through `atomic_output`: to a hidden temporary file in
+the target folder, then renamed over the target. A killed run leaves at most
+a hidden temp file, never a truncated table or TIFF under the final name.
+Hidden ('.' prefix) and '_' files are ignored by Parquet dataset readers.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator
+
+MANIFEST_VERSION = 1
+
+
+def sha256_file(path: str, chunk_size: int = 1 << 24) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_record(path: str, hash_content: bool = False) -> Dict[str, object]:
+    """
+    size and mtime of a file, plus its sha256 if `hash_content`. A directory
+    (e.g. an OME-Zarr store) is recorded by its own stat, never hashed.
+    """
+    st = os.stat(path)
+    rec = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if hash_content and os.path.isfile(path):
+        rec["sha256"] = sha256_file(path)
+    return rec
+
+
+def _unchanged(rec: Dict[str, object], path: str) -> bool:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if st.st_size != rec.get("size"):
+        return False
+    if st.st_mtime_ns == rec.get("mtime_ns"):
+        return True
+    return "sha256" in rec and sha256_file(path) == rec["sha256"]
+
+
+@contextmanager
+def atomic_output(path: str) -> Iterator[str]:
+    """
+    Yield a temporary path next to `path` (same extension, including an
+    .ome. prefix such as .ome.tif, so writers pick the right format) and
+    rename it over `path` once the block succeeds. The temporary path may
+    also become a directory (a Zarr store).
+    """
+    folder, name = os.path.split(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    stem, ext = os.path.splitext(name)
+    if stem.lower().endswith(".ome"):  # tifffile writes OME-XML only to *.ome.tif
+        stem, ext = stem[:-4], stem[-4:] + ext
+    tmp = os.path.join(folder, f".{stem}.partial-{os.getpid()}-{threading.get_ident()}{ext}")
+    try:
+        yield tmp
+        if os.path.isdir(tmp) and os.path.isdir(path):
+            shutil.rmtree(path)  # os.replace cannot replace a non-empty directory
+        os.replace(tmp, path)
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _normalize(params: Dict[str, object]) -> Dict[str, object]:
+    return json.loads(json.dumps(params, sort_keys=True, default=str))
+
+
+class Manifest:
+    """
+    JSON manifest of one stage, safe to update from several threads.
+    """
+
+    def __init__(self, path: str, hash_inputs: bool = False, force: bool = False):
+        self.path = path
+        self.hash_inputs = hash_inputs
+        self.force = force
+        self._lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, object]] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data.get("entries", {})
+
+    def is_current(self, key: str, inputs: Iterable[str], params: Dict[str, object]) -> bool:
+        """
+        True when `key` was completed with the same inputs and parameters and
+        its outputs are still the files that run wrote.
+        """
+        if self.force:
+            return False
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry is None or entry["params"] != _normalize(params):
+            return False
+        inputs = [os.path.abspath(p) for p in inputs]
+        if sorted(entry["inputs"]) != sorted(inputs):
+            return False
+        return (all(_unchanged(entry["inputs"][p], p) for p in inputs)
+                and all(_unchanged(rec, p) for p, rec in entry["outputs"].items()))
+
+    def unrecorded_outputs(self, key: str, outputs: Iterable[str]) -> list:
+        """
+        Existing files among `outputs` that no manifest entry of `key` wrote
+        (e.g. left by an older run), i.e. what running `key` will overwrite.
+        """
+        with self._lock:
+            known = set(self.entries.get(key, {}).get("outputs", {}))
+        return [p for p in outputs if os.path.exists(p) and os.path.abspath(p) not in known]
+
+    def record(self, key: str, inputs: Iterable[str], params: Dict[str, object], outputs: Iterable[str]) -> None:
+        """
+        Mark `key` as done and save the manifest atomically.
+        """
+        entry = {
+            "inputs": {os.path.abspath(p): file_record(p, self.hash_inputs) for p in inputs},
+            "params": _normalize(params),
+            "outputs": {os.path.abspath(p): file_record(p) for p in outputs},
+        }
+        with self._lock:
+            self.entries[key] = entry
+            with atomic_output(self.path) as tmp:
+                with open(tmp, "w") as f:
+                    json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f, indent=1, sort_keys=True)
+
+
+def stage_manifest(folder: str, stage: str, hash_inputs: bool = False, force: bool = False) -> Manifest:
+    """
+    Manifest of `stage` kept in `folder` as _<stage>_manifest.json.
+    """
+    return Manifest(os.path.join(folder, f"_{stage}_manifest.json"), hash_inputs, force)
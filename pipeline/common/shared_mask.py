@@ -0,0 +1,73 @@
+"""
+=====================================================
+ Zero-copy mask sharing for worker pools
+=====================================================
+A label mask is decoded ONCE per slide, straight into a memory-mapped .npy
+file, and pool workers map that file read-only instead of decoding their own
+copy. The file lives in RAM-backed /dev/shm when available, so every worker
+reads the same physical pages and per-worker RSS only grows with the channel
+planes it holds.
+
+Works with both fork and spawn start methods: workers only need the path.
+"""
+
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import tifffile
+
+
+def default_share_root() -> str:
+    """
+    RAM-backed /dev/shm when present, otherwise the system temp directory.
+    """
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+@contextmanager
+def share_dir(root: Optional[str] = None) -> Iterator[str]:
+    """
+    Temporary directory for shared arrays, removed on exit.
+    """
+    path = tempfile.mkdtemp(prefix="quant_share_", dir=root or default_share_root())
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def publish_mask(mask_path: str, directory: str, name: Optional[str] = None) -> str:
+    """
+    Decode the first series (full resolution) of a TIFF mask directly into a
+    memory-mapped .npy under `directory`. Returns the .npy path.
+    """
+    name = name or os.path.basename(mask_path).split('.')[0]
+    npy_path = os.path.join(directory, f"{name}.mask.npy")
+    with tifffile.TiffFile(mask_path) as tif:
+        series = tif.series[0]
+        out = np.lib.format.open_memmap(npy_path, mode='w+', dtype=series.dtype, shape=series.shape)
+        series.asarray(out=out)
+        out.flush()
+        del out
+    return npy_path
+
+
+def create_mask(directory: str, name: str, shape, dtype) -> Tuple[str, np.ndarray]:
+    """
+    Allocate an empty memory-mapped .npy mask (e.g. for a derived
+    compartment) under `directory`. Returns (path, writable array).
+    """
+    npy_path = os.path.join(directory, f"{name}.mask.npy")
+    return npy_path, np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+
+def attach_mask(npy_path: str) -> np.ndarray:
+    """
+    Map a published mask read-only as a 2D array.
+    """
+    mask = np.load(npy_path, mmap_mode='r')
+    return mask.reshape(mask.shape[-2:]) if mask.ndim > 2 else mask
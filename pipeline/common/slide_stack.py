@@ -0,0 +1,276 @@
+"""
+=====================================================
+ One multi-channel container per filtered slide
+=====================================================
+Instead of one TIFF per marker folder, all filtered markers of a slide are
+stored as the channels of a single chunked container:
+
+    <folder>/<SLIDE>.ome.tif    tiled OME-TIFF written by pyramid_tiff,
+                                marker names in the OME-XML Channel names
+    <folder>/<SLIDE>.ome.zarr   OME-Zarr (NGFF 0.4, zarr v2 layout), arrays
+                                '0', '1', ... of shape (C, Y, X) chunked per
+                                channel and tile, marker names in
+                                omero.channels[].label
+
+`StackWriter` takes the channels of one slide in any order, from several
+threads, as whole planes or as tile streams. Zarr channels go to disk as
+they arrive, each resolution reduced tile by tile from the one above. The
+OME-TIFF is written front to back by a writer thread, so a channel that is
+ready before its predecessors waits in memory until they have been
+written. Its sub-resolutions come after every full-resolution channel, so
+they are held as `pyramid_tiff.SubLevel`s: in memory up to SPOOL_BYTES,
+otherwise in a temporary file next to the container. Either container
+appears under its final name only once complete.
+
+`channel_sources(path)` maps marker names to (path, channel index), the
+form `label_quant.PlaneReader` / `quantify_stream` read from, so channels
+are found by name without scanning marker folders.
+"""
+
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import tifffile
+import zarr
+
+import pyramid_tiff
+from run_manifest import atomic_output
+
+STACK_FORMATS = ("ome.tif", "ome.zarr")
+STACK_FOLDER = "filtered"
+
+
+def stack_path(folder: str, slide: str, fmt: str) -> str:
+    if fmt not in STACK_FORMATS:
+        raise ValueError(f"Unknown stack format {fmt!r}, choose from {STACK_FORMATS}")
+    return os.path.join(folder, f"{slide}.{fmt}")
+
+
+def find_stacks(folder: str) -> Dict[str, str]:
+    """
+    { SLIDE: container path } of the stacks in `folder` (empty if none).
+    """
+    stacks = {}
+    if os.path.isdir(folder):
+        for name in sorted(os.listdir(folder)):
+            for fmt in STACK_FORMATS:
+                if name.endswith("." + fmt) and not name.startswith("."):
+                    stacks[name[:-len(fmt) - 1]] = os.path.join(folder, name)
+    return stacks
+
+
+def channel_names(path: str) -> List[str]:
+    """
+    Marker names of the channels of a stack, in channel order.
+    """
+    if os.path.isdir(path):
+        return [c["label"] for c in zarr.open_group(path, mode="r").attrs["omero"]["channels"]]
+    with tifffile.TiffFile(path) as tif:
+        pixels = tifffile.xml2dict(tif.ome_metadata)["OME"]["Image"]["Pixels"]
+    channels = pixels["Channel"]
+    return [c["Name"] for c in (channels if isinstance(channels, list) else [channels])]
+
+
+def channel_sources(path: str) -> Dict[str, Tuple[str, int]]:
+    """
+    { MARKER: (path, channel index) } of a stack.
+    """
+    return {name: (path, c) for c, name in enumerate(channel_names(path))}
+
+
+def _open_zarr_group(path: str):
+    try:
+        return zarr.open_group(path, mode="w", zarr_format=2)  # zarr >= 3
+    except TypeError:
+        return zarr.open_group(path, mode="w")
+
+
+def _create_zarr_array(group, name: str, shape: Tuple[int, ...], chunks: Tuple[int, ...], dtype):
+    if hasattr(group, "create_array"):  # zarr >= 3
+        return group.create_array(name, shape=shape, chunks=chunks, dtype=dtype,
+                                  chunk_key_encoding={"name": "v2", "separator": "/"})
+    return group.create_dataset(name, shape=shape, chunks=chunks, dtype=dtype, dimension_separator="/")
+
+
+def ngff_attrs(names: Sequence[str], levels: int, dtype, name: Optional[str] = None) -> dict:
+    """
+    NGFF 0.4 'multiscales' and 'omero' attributes of a (C, Y, X) stack.
+    """
+    info = np.iinfo(dtype) if np.dtype(dtype).kind in "iu" else np.finfo(dtype)
+    window = {"min": float(info.min), "max": float(info.max), "start": 0.0, "end": float(info.max)}
+    return {
+        "multiscales": [{
+            "version": "0.4",
+            "name": name or "",
+            "axes": [{"name": "c", "type": "channel"},
+                     {"name": "y", "type": "space"},
+                     {"name": "x", "type": "space"}],
+            "datasets": [{"path": str(i),
+                          "coordinateTransformations": [{"type": "scale", "scale": [1.0, 2.0 ** i, 2.0 ** i]}]}
+                         for i in range(levels)],
+        }],
+        "omero": {"channels": [{"label": n, "color": "FFFFFF", "active": True, "window": window} for n in names]},
+    }
+
+
+class StackWriter:
+    """
+    Writes the channels `names` of one slide into a container at `path`
+    (.ome.tif or .ome.zarr). Use as a context manager; the container is
+    renamed into place on a clean exit and discarded on an exception.
+    """
+
+    def __init__(self,
+                 path: str,
+                 names: Sequence[str],
+                 shape: Tuple[int, int],
+                 dtype=np.uint16,
+                 tile: int = pyramid_tiff.DEFAULT_TILE,
+                 levels: Optional[int] = 1,
+                 compression: str = pyramid_tiff.DEFAULT_COMPRESSION):
+        self.path = path
+        self.names = list(names)
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.tile = tile
+        self.levels = pyramid_tiff.level_count(self.shape, tile) if levels is None else max(1, int(levels))
+        self.compression = compression
+        self.is_zarr = path.endswith(".zarr")
+        self._atomic = None
+        self._cond = threading.Condition()
+        self._slots: Dict[int, object] = {}
+        self._consumed = set()
+        self._written = set()
+        self._error: Optional[BaseException] = None
+        self._aborted = False
+        self._thread = None
+
+    def __enter__(self) -> "StackWriter":
+        self._atomic = atomic_output(self.path)
+        tmp = self._atomic.__enter__()
+        if self.is_zarr:
+            group = _open_zarr_group(tmp)
+            group.attrs.update(ngff_attrs(self.names, self.levels, self.dtype,
+                                           os.path.basename(self.path)[:-len(".ome.zarr")]))
+            self._arrays = []
+            shape = self.shape
+            for i in range(self.levels):
+                self._arrays.append(_create_zarr_array(group, str(i), (len(self.names),) + shape,
+                                                       (1, self.tile, self.tile), self.dtype))
+                shape = ((shape[0] + 1) // 2, (shape[1] + 1) // 2)
+        else:
+            self._thread = threading.Thread(target=self._write_tiff, args=(tmp,), daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        aborted, failure = self._aborted, None
+        if exc_type is None and not aborted:
+            missing = [n for c, n in enumerate(self.names) if c not in self._written]
+            if missing:
+                failure = RuntimeError(f"channels {missing} were never written")
+        if exc_type is not None or aborted or failure is not None:
+            self.abort()
+        elif self._thread is not None:
+            self._thread.join()
+            failure = self._error
+        if exc_type is None and not aborted and failure is None:
+            self._atomic.__exit__(None, None, None)
+            return
+        # discard the partial container
+        error = exc or failure or RuntimeError(f"{self.path} aborted")
+        self._atomic.__exit__(type(error), error, None)
+        if failure is not None:
+            raise RuntimeError(f"Writing {self.path} failed: {failure}") from failure
+
+    def abort(self) -> None:
+        """
+        Give up on this container (e.g. a channel failed); nothing is renamed.
+        """
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, name: str, data: Union[np.ndarray, Iterable[np.ndarray]]) -> None:
+        """
+        Store channel `name`: a (Y, X) plane, or its tiles in row-major
+        order. Tile streams are consumed before this returns.
+        """
+        c = self.names.index(name)
+        if self.is_zarr:
+            self._write_zarr(c, data)
+            self._written.add(c)
+            return
+        with self._cond:
+            self._slots[c] = data
+            self._cond.notify_all()
+            if not isinstance(data, np.ndarray):
+                while c not in self._consumed and self._error is None and not self._aborted:
+                    self._cond.wait()
+            if self._error is not None:
+                raise RuntimeError(f"Writing {self.path} failed: {self._error}")
+            self._written.add(c)
+
+    def _write_zarr(self, c: int, data) -> None:
+        if isinstance(data, np.ndarray):
+            data = pyramid_tiff.iter_array_tiles(data, self.tile)
+        spool_dir = os.path.dirname(os.path.abspath(self.path))
+        shape, sublevels = self.shape, []
+        try:
+            for i, array in enumerate(self._arrays):
+                # each level is reduced tile by tile from the one above while that one is stored
+                if i < self.levels - 1:
+                    sublevels.append(pyramid_tiff.SubLevel(shape, self.dtype, self.tile, "mean", spool_dir))
+                    data = sublevels[i].tap(data)
+                origins = ((y, x) for y in range(0, shape[0], self.tile) for x in range(0, shape[1], self.tile))
+                for t, (y0, x0) in zip(data, origins):
+                    array[c, y0:y0 + t.shape[0], x0:x0 + t.shape[1]] = t
+                if i:
+                    sublevels[i - 1].close()
+                if i < self.levels - 1:
+                    data, shape = sublevels[i].tiles(), sublevels[i].shape
+        finally:
+            for level in sublevels:
+                level.close()
+
+    def _next_channel(self, c: int):
+        with self._cond:
+            while c not in self._slots and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                raise RuntimeError(f"{self.path} aborted")
+            return self._slots.pop(c)
+
+    def _done(self, c: int) -> None:
+        with self._cond:
+            self._consumed.add(c)
+            self._cond.notify_all()
+
+    def _write_tiff(self, tmp: str) -> None:
+        per_plane = -(-self.shape[0] // self.tile) * -(-self.shape[1] // self.tile)
+
+        def tiles():
+            for c in range(len(self.names)):
+                data = self._next_channel(c)
+                if isinstance(data, np.ndarray):
+                    data = pyramid_tiff.iter_array_tiles(data, self.tile)
+                data = iter(data)
+                for i in range(per_plane):
+                    t = next(data, None)
+                    if t is None:
+                        raise ValueError(f"{self.names[c]}: expected {per_plane} tiles, got {i}")
+                    if i == per_plane - 1:
+                        self._done(c)  # release the caller before tifffile asks for more
+                    yield t
+
+        try:
+            pyramid_tiff.write_pyramid(tmp, tiles(), (len(self.names),) + self.shape, self.dtype, self.names,
+                                       self.tile, self.levels, self.compression)
+        except BaseException as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
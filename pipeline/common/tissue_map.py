@@ -0,0 +1,136 @@
+"""
+=====================================================
+ Tissue map from a low-resolution nuclear plane
+=====================================================
+Much of a TMA or whole-slide scan is empty glass. `TissueMap` thresholds a
+low-resolution copy of the nuclear (DAPI) plane and answers, for any
+full-resolution window, whether it touches tissue, so the segmenters run
+inference only on occupied tiles:
+
+    lowres    a pyramid level of the TIFF (normalization.lowres_plane) or,
+              without one, every n-th pixel of the plane read in strips
+    threshold Otsu on the Gaussian-smoothed low-res plane, or a fixed
+              intensity in the raw units of the nuclear plane (Mesmer's old
+              tile-mean cut-off of 600 was on gamma-corrected, rescaled
+              tiles and does not carry over)
+    margin    tissue is dilated by `margin` full-resolution pixels, so
+              nuclei at its edge keep their tile
+
+`TriageStats` counts occupied and skipped tiles, the inference throughput
+of the occupied ones and, from their mean time, the time the skipped tiles
+saved.
+"""
+
+import math
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+from scipy import ndimage
+from skimage.filters import gaussian, threshold_otsu
+
+import normalization
+
+
+def lowres_nuclear(tif, plane, channel: int = 0,
+                   max_pixels: int = normalization.DEFAULT_LEVEL_PIXELS,
+                   rows: int = normalization.STRIP_ROWS) -> np.ndarray:
+    """
+    A low-resolution copy of the nuclear plane: the TIFF's pyramid level
+    with at most `max_pixels` pixels, else a strided subsample of `plane`.
+    """
+    lowres = normalization.lowres_plane(tif, channel, max_pixels) if tif is not None else None
+    if lowres is not None:
+        return lowres
+    h, w = plane.shape
+    step = max(1, math.ceil(math.sqrt(h * w / max_pixels)))
+    rows = max(step, rows // step * step)
+    return np.concatenate([np.asarray(plane[y:y + rows])[::step, ::step] for y in range(0, h, rows)])
+
+
+class TissueMap:
+    """
+    Tissue mask of a (Y, X) plane of `shape`, from its low-resolution copy.
+    """
+
+    def __init__(self,
+                 lowres: np.ndarray,
+                 shape: Tuple[int, int],
+                 threshold: Optional[float] = None,
+                 margin: int = 64,
+                 sigma: float = 1.0):
+        self.shape = tuple(int(s) for s in shape)
+        self.scale = (self.shape[0] / lowres.shape[0], self.shape[1] / lowres.shape[1])
+        smooth = gaussian(lowres.astype(np.float32), sigma, preserve_range=True) if sigma else lowres
+        self.threshold = float(threshold_otsu(smooth) if threshold is None else threshold)
+        tissue = smooth > self.threshold
+        grow = math.ceil(margin / min(self.scale))
+        if grow and tissue.any():
+            tissue = ndimage.binary_dilation(tissue, np.ones((2 * grow + 1,) * 2, bool))
+        self.tissue = tissue
+        # summed-area table for O(1) window queries
+        self._sat = np.pad(tissue.cumsum(0, dtype=np.int64).cumsum(1), ((1, 0), (1, 0)))
+
+    @property
+    def fraction(self) -> float:
+        return float(self.tissue.mean())
+
+    def occupied(self, y0: int, y1: int, x0: int, x1: int) -> bool:
+        """
+        Whether the full-resolution window [y0:y1, x0:x1] touches tissue.
+        """
+        sy, sx = self.scale
+        h, w = self.tissue.shape
+        ly0, ly1 = min(h - 1, int(y0 // sy)), min(h, max(int(y0 // sy) + 1, math.ceil(y1 / sy)))
+        lx0, lx1 = min(w - 1, int(x0 // sx)), min(w, max(int(x0 // sx) + 1, math.ceil(x1 / sx)))
+        s = self._sat
+        return bool(s[ly1, lx1] - s[ly0, lx1] - s[ly1, lx0] + s[ly0, lx0] > 0)
+
+    def grid(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """
+        Occupancy of the tiles spanned by `rows` x `cols`, (n, 2) arrays of
+        [start, stop) pixel bounds (the layout of deeptile's tile_indices).
+        """
+        return np.array([[self.occupied(r0, r1, c0, c1) for c0, c1 in cols] for r0, r1 in rows], bool)
+
+
+class TriageStats:
+    """
+    Occupied/skipped tile counts and inference time of the occupied tiles.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+    def skip(self, n: int = 1) -> None:
+        self.total += n
+        self.skipped += n
+
+    def run(self, seconds: float, n: int = 1) -> None:
+        self.total += n
+        self.seconds += seconds
+
+    @contextmanager
+    def timed(self, n: int = 1) -> Iterator[None]:
+        """
+        Count the time of the `with` block as inference of `n` occupied tiles.
+        """
+        start = time.perf_counter()
+        yield
+        self.run(time.perf_counter() - start, n)
+
+    @property
+    def tiles_per_second(self) -> float:
+        return (self.total - self.skipped) / self.seconds if self.seconds else 0.0
+
+    @property
+    def saved_seconds(self) -> float:
+        processed = self.total - self.skipped
+        return self.skipped * self.seconds / processed if processed else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.total - self.skipped} tiles in {self.seconds:.1f}s ({self.tiles_per_second:.2f} tiles/s), "
+                f"{self.skipped} of {self.total} skipped as background, ~{self.saved_seconds:.0f}s saved")